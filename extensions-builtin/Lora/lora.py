@@ -1,13 +1,11 @@
-import glob
+import functools
 import os
 import re
+
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors
-
-import requests
-import json
+from modules import shared, devices, sd_models, errors, network_catalog, cache_utils
 
 metadata_tags_order = {"ss_sd_model_name": 1, "ss_resolution": 2, "ss_clip_skip": 3, "ss_num_train_images": 10, "ss_tag_frequency": 20}
 
@@ -26,6 +24,7 @@ suffix_conversion = {
 }
 
 
+@functools.lru_cache(maxsize=16384)
 def convert_diffusers_name_to_compvis(key, is_sd2):
     def match(match_list, regex_text):
         regex = re_compiled.get(regex_text)
@@ -106,6 +105,7 @@ class LoraModule:
         self.name = name
         self.multiplier = 1.0
         self.modules = {}
+        self.filename = None
         self.mtime = None
 
 
@@ -131,9 +131,13 @@ def assign_lora_names_to_compvis_modules(sd_model):
 
     sd_model.lora_layer_mapping = lora_layer_mapping
 
+    weights_cache.clear()
+    modules_cache.clear()
+
 
 def load_lora(name, filename):
     lora = LoraModule(name)
+    lora.filename = filename
     lora.mtime = os.path.getmtime(filename)
 
     sd = sd_models.read_state_dict(filename)
@@ -202,23 +206,39 @@ def load_loras(names, multipliers=None):
     for lora in loaded_loras:
         if lora.name in names:
             already_loaded[lora.name] = lora
+        else:
+            # unmerged lora_apply_mode moves Lora weights to the device; those kept in modules_cache should only take RAM
+            for module in lora.modules.values():
+                for x in (module.up, module.down):
+                    if x is not None:
+                        x.to(devices.cpu, dtype=devices.dtype)
 
     loaded_loras.clear()
 
     loras_on_disk = [available_loras.get(name, None) for name in names]
-    if any([x is None for x in loras_on_disk]):
-        list_available_loras()
+    if any([x is None and not network_catalog.catalog.recently_missing(name) for x, name in zip(loras_on_disk, names)]):
+        list_available_loras(force=True)
 
         loras_on_disk = [available_loras.get(name, None) for name in names]
 
+        for name, lora_on_disk in zip(names, loras_on_disk):
+            if lora_on_disk is None:
+                network_catalog.catalog.mark_missing(name)
+
     for i, name in enumerate(names):
         lora = already_loaded.get(name, None)
 
         lora_on_disk = loras_on_disk[i]
         if lora_on_disk is not None:
             if lora is None or os.path.getmtime(lora_on_disk.filename) > lora.mtime:
+                lora = modules_cache.get(name, valid=lambda x: x.filename == lora_on_disk.filename and x.mtime == os.path.getmtime(x.filename)) if modules_cache.enabled() else None
+
+            if lora is None:
                 lora = load_lora(name, lora_on_disk.filename)
 
+                if modules_cache.enabled():
+                    modules_cache.put(name, lora, cache_utils.tensors_size([x.weight for module in lora.modules.values() for x in (module.up, module.down) if x is not None]))
+
         if lora is None:
             print(f"Couldn't find Lora with name {name}")
             continue
@@ -227,26 +247,68 @@ def load_loras(names, multipliers=None):
         loaded_loras.append(lora)
 
 
-def lora_calc_updown(lora, module, target):
+def lora_calc_updown(lora, module, target, multiplier=None, dtype=None):
     with torch.no_grad():
-        up = module.up.weight.to(target.device, dtype=target.dtype)
-        down = module.down.weight.to(target.device, dtype=target.dtype)
+        up = module.up.weight.to(target.device, dtype=dtype or target.dtype)
+        down = module.down.weight.to(target.device, dtype=dtype or target.dtype)
 
         if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
             updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
         else:
             updown = up @ down
 
-        updown = updown * lora.multiplier * (module.alpha / module.up.weight.shape[1] if module.alpha else 1.0)
+        updown = updown * (lora.multiplier if multiplier is None else multiplier) * (module.alpha / module.up.weight.shape[1] if module.alpha else 1.0)
 
         return updown
 
 
-def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
+def lora_calc_layer_updowns(self, lora, multiplier=None, dtype=None):
+    """returns a list of changes that lora makes to each of lora_layer_weights(self), or None if lora does not change this layer"""
+
+    lora_layer_name = self.lora_layer_name
+
+    module = lora.modules.get(lora_layer_name, None)
+    if module is not None and hasattr(self, 'weight'):
+        return [lora_calc_updown(lora, module, self.weight, multiplier, dtype)]
+
+    module_q = lora.modules.get(lora_layer_name + "_q_proj", None)
+    module_k = lora.modules.get(lora_layer_name + "_k_proj", None)
+    module_v = lora.modules.get(lora_layer_name + "_v_proj", None)
+    module_out = lora.modules.get(lora_layer_name + "_out_proj", None)
+
+    if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
+        updown_q = lora_calc_updown(lora, module_q, self.in_proj_weight, multiplier, dtype)
+        updown_k = lora_calc_updown(lora, module_k, self.in_proj_weight, multiplier, dtype)
+        updown_v = lora_calc_updown(lora, module_v, self.in_proj_weight, multiplier, dtype)
+        updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
+
+        return [updown_qkv, lora_calc_updown(lora, module_out, self.out_proj.weight, multiplier, dtype)]
+
+    if module is not None:
+        print(f'failed to calculate lora weights for layer {lora_layer_name}')
+
+    return None
+
+
+def lora_merges_weights(self, batch_size=None):
+    """tells whether Loras are merged into weights of layer self, as opposed to being computed separately in forward;
+    in unmerged mode, inputs with batch larger than the setting are still merged, as computing Lora for each of them costs more than merging"""
+
+    if shared.opts.lora_apply_mode != "unmerged" or not isinstance(self, torch.nn.Linear):
+        return True
+
+    return batch_size is not None and batch_size > shared.opts.lora_unmerged_max_batch_size
+
+
+def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention], batch_size=None):
     """
     Applies the currently selected set of Loras to the weights of torch layer self.
     If weights already have this particular set of loras applied, does nothing.
-    If not, restores orginal weights from backup and alters weights according to loras.
+    If not, restores orginal weights and alters weights according to loras.
+
+    Original weights are restored either from a backup in RAM made when the layer is first changed, or, when lora_apply_mode
+    setting asks not to keep backups, by subtracting the changes made by previously applied loras. Subtraction and addition
+    are done together in an fp32 accumulator, so each switch rounds weights to their dtype once.
     """
 
     lora_layer_name = getattr(self, 'lora_layer_name', None)
@@ -254,10 +316,16 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
         return
 
     current_names = getattr(self, "lora_current_names", ())
-    wanted_names = tuple((x.name, x.multiplier) for x in loaded_loras)
+    wanted_names = tuple((x.name, x.multiplier) for x in loaded_loras) if lora_merges_weights(self, batch_size) else ()
+
+    if current_names == wanted_names:
+        return
 
     weights_backup = getattr(self, "lora_weights_backup", None)
-    if weights_backup is None:
+    if weights_backup is None and shared.opts.lora_apply_mode == "merge, keep backup":
+        # weights may have loras applied if the setting was changed; backup must be made of original weights
+        lora_apply_weights_by_subtraction(self, getattr(self, "lora_current_loras", []), [])
+
         if isinstance(self, torch.nn.MultiheadAttention):
             weights_backup = (self.in_proj_weight.to(devices.cpu, copy=True), self.out_proj.weight.to(devices.cpu, copy=True))
         else:
@@ -265,52 +333,120 @@ def lora_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.Mu
 
         self.lora_weights_backup = weights_backup
 
-    if current_names != wanted_names:
-        if weights_backup is not None:
-            if isinstance(self, torch.nn.MultiheadAttention):
-                self.in_proj_weight.copy_(weights_backup[0])
-                self.out_proj.weight.copy_(weights_backup[1])
-            else:
-                self.weight.copy_(weights_backup)
+    wanted_loras = [(lora, lora.multiplier) for lora in loaded_loras] if wanted_names else []
 
-        for lora in loaded_loras:
-            module = lora.modules.get(lora_layer_name, None)
-            if module is not None and hasattr(self, 'weight'):
-                self.weight += lora_calc_updown(lora, module, self.weight)
-                continue
+    # merged weights are only cached when keeping a backup; other modes are there to save memory
+    use_cache = wanted_names and shared.opts.lora_apply_mode == "merge, keep backup" and weights_cache.enabled()
+
+    cache_key = (lora_layer_name, tuple((x.name, x.multiplier, x.mtime) for x in loaded_loras))
+    cached = weights_cache.get(cache_key) if use_cache else None
 
-            module_q = lora.modules.get(lora_layer_name + "_q_proj", None)
-            module_k = lora.modules.get(lora_layer_name + "_k_proj", None)
-            module_v = lora.modules.get(lora_layer_name + "_v_proj", None)
-            module_out = lora.modules.get(lora_layer_name + "_out_proj", None)
+    if cached is not None:
+        # an empty entry means that none of the Loras change this layer
+        for weight, cached_weight in zip(lora_layer_weights(self), cached or lora_layer_weights_backup(self)):
+            weight.copy_(cached_weight)
 
-            if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
-                updown_q = lora_calc_updown(lora, module_q, self.in_proj_weight)
-                updown_k = lora_calc_updown(lora, module_k, self.in_proj_weight)
-                updown_v = lora_calc_updown(lora, module_v, self.in_proj_weight)
-                updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
+        self.lora_current_names = wanted_names
+        self.lora_current_loras = wanted_loras
+        return
+
+    if weights_backup is not None:
+        changed = False
 
-                self.in_proj_weight += updown_qkv
-                self.out_proj.weight += lora_calc_updown(lora, module_out, self.out_proj.weight)
+        for weight, backup in zip(lora_layer_weights(self), lora_layer_weights_backup(self)):
+            weight.copy_(backup)
+
+        for lora, multiplier in wanted_loras:
+            updowns = lora_calc_layer_updowns(self, lora, multiplier)
+            if updowns is None:
                 continue
 
-            if module is None:
+            for weight, updown in zip(lora_layer_weights(self), updowns):
+                weight += updown
+
+            changed = True
+    else:
+        changed = lora_apply_weights_by_subtraction(self, getattr(self, "lora_current_loras", []), wanted_loras)
+
+    if use_cache:
+        stored = tuple(x.to(devices.cpu, copy=True) for x in lora_layer_weights(self)) if changed else ()
+        weights_cache.put(cache_key, stored, cache_utils.tensors_size(stored))
+
+    self.lora_current_names = wanted_names
+    self.lora_current_loras = wanted_loras
+
+
+def lora_apply_weights_by_subtraction(self, current_loras, wanted_loras):
+    """changes weights of layer self from having current_loras applied to having wanted_loras applied without a backup; returns True if wanted_loras change the layer"""
+
+    changed = False
+    accumulators = None
+
+    for loras, sign in ((current_loras, -1), (wanted_loras, 1)):
+        for lora, multiplier in loras:
+            updowns = lora_calc_layer_updowns(self, lora, multiplier * sign, dtype=torch.float32)
+            if updowns is None:
                 continue
 
-            print(f'failed to calculate lora weights for layer {lora_layer_name}')
+            if accumulators is None:
+                accumulators = [weight.to(torch.float32, copy=True) for weight in lora_layer_weights(self)]
+
+            for accumulator, updown in zip(accumulators, updowns):
+                accumulator += updown
+
+            changed = changed or sign > 0
+
+    if accumulators is not None:
+        for weight, accumulator in zip(lora_layer_weights(self), accumulators):
+            weight.copy_(accumulator)
+
+    return changed
+
+
+def lora_layer_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
+    if isinstance(self, torch.nn.MultiheadAttention):
+        return self.in_proj_weight, self.out_proj.weight
+
+    return self.weight,
+
+
+def lora_layer_weights_backup(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.MultiheadAttention]):
+    weights_backup = self.lora_weights_backup
 
-        setattr(self, "lora_current_names", wanted_names)
+    return weights_backup if isinstance(weights_backup, tuple) else (weights_backup, )
+
+
+def lora_forward_unmerged(self: torch.nn.Linear, input, res):
+    """adds outputs of loaded Loras for layer self to res, for layers that do not have Loras merged into weights"""
+
+    lora_layer_name = getattr(self, 'lora_layer_name', None)
+    if lora_layer_name is None or not loaded_loras or lora_merges_weights(self, input.shape[0]):
+        return res
+
+    for lora in loaded_loras:
+        module = lora.modules.get(lora_layer_name, None)
+        if module is None:
+            continue
+
+        module.up.to(input.device, dtype=input.dtype)
+        module.down.to(input.device, dtype=input.dtype)
+
+        scale = lora.multiplier * (module.alpha / module.up.weight.shape[1] if module.alpha else 1.0)
+        res = res + module.up(module.down(input)) * scale
+
+    return res
 
 
 def lora_reset_cached_weight(self: Union[torch.nn.Conv2d, torch.nn.Linear]):
     setattr(self, "lora_current_names", ())
+    setattr(self, "lora_current_loras", [])
     setattr(self, "lora_weights_backup", None)
 
 
 def lora_Linear_forward(self, input):
-    lora_apply_weights(self)
+    lora_apply_weights(self, input.shape[0])
 
-    return torch.nn.Linear_forward_before_lora(self, input)
+    return lora_forward_unmerged(self, input, torch.nn.Linear_forward_before_lora(self, input))
 
 
 def lora_Linear_load_state_dict(self, *args, **kwargs):
@@ -343,39 +479,38 @@ def lora_MultiheadAttention_load_state_dict(self, *args, **kwargs):
     return torch.nn.MultiheadAttention_load_state_dict_before_lora(self, *args, **kwargs)
 
 
-def list_available_loras(sagemaker_endpoint=None, username=None):
-    available_loras.clear()
+def list_available_loras(sagemaker_endpoint=None, username=None, force=False):
+    candidates = []
 
     if shared.cmd_opts.pureui:
         if sagemaker_endpoint:
             api_endpoint = os.environ['api_endpoint']
             params = {'module': 'Lora', 'endpoint_name': sagemaker_endpoint}
-            response = requests.get(url=f'{api_endpoint}/sd/models', params=params)
-
-            if response.status_code == 200:
-                items = json.loads(response.text)
-                for item in items:
-                    filename = item['model_name']
-                    name = os.path.splitext(item['model_name'])[0]
-                    available_loras[name] = LoraOnDisk(name, f'/tmp/models/Lora/{username}/{filename}')
+            items = network_catalog.catalog.list_remote(f'{api_endpoint}/sd/models', params, force=force)
+
+            for item in items or []:
+                filename = item['model_name']
+                candidates.append((os.path.splitext(item['model_name'])[0], f'/tmp/models/Lora/{username}/{filename}'))
     else:
         os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
 
-        candidates = \
-            glob.glob(os.path.join(shared.cmd_opts.lora_dir, '**/*.pt'), recursive=True) + \
-            glob.glob(os.path.join(shared.cmd_opts.lora_dir, '**/*.safetensors'), recursive=True) + \
-            glob.glob(os.path.join(shared.cmd_opts.lora_dir, '**/*.ckpt'), recursive=True)
-
-        for filename in sorted(candidates, key=str.lower):
-            if os.path.isdir(filename):
-                continue
+        for filename in sorted(network_catalog.catalog.list_files(shared.cmd_opts.lora_dir, ['.pt', '.safetensors', '.ckpt'], force=force), key=str.lower):
+            candidates.append((os.path.splitext(os.path.basename(filename))[0], filename))
 
-            name = os.path.splitext(os.path.basename(filename))[0]
+    # reading metadata of a Lora opens its file, so entries that are still listed are kept
+    previous = {lora_on_disk.filename: lora_on_disk for lora_on_disk in available_loras.values()}
+    available_loras.clear()
 
-            available_loras[name] = LoraOnDisk(name, filename)
+    for name, filename in candidates:
+        lora_on_disk = previous.get(filename, None)
+        available_loras[name] = lora_on_disk if lora_on_disk is not None and lora_on_disk.name == name else LoraOnDisk(name, filename)
 
 
 available_loras = {}
 loaded_loras = []
+# Loras read from disk and parsed for the current model, by name
+modules_cache = cache_utils.LruCache("lora_cache_size")
+# layer weights with a combination of Loras merged into them, by layer and combination
+weights_cache = cache_utils.LruCache("lora_weights_cache_size")
 
 list_available_loras()
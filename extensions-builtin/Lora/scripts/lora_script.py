@@ -16,6 +16,10 @@ def unload():
     torch.nn.MultiheadAttention._load_from_state_dict = torch.nn.MultiheadAttention_load_state_dict_before_lora
 
 
+def cache_stats():
+    return {"lora files": lora.modules_cache.stats(), "lora weights": lora.weights_cache.stats()}
+
+
 def before_ui():
     ui_extra_networks.register_page(ui_extra_networks_lora.ExtraNetworksPageLora())
     extra_networks.register_extra_network(extra_networks_lora.ExtraNetworkLora())
@@ -49,8 +53,13 @@ torch.nn.MultiheadAttention._load_from_state_dict = lora.lora_MultiheadAttention
 script_callbacks.on_model_loaded(lora.assign_lora_names_to_compvis_modules)
 script_callbacks.on_script_unloaded(unload)
 script_callbacks.on_before_ui(before_ui)
+script_callbacks.on_cache_stats(cache_stats)
 
 
 shared.options_templates.update(shared.options_section(('extra_networks', "Extra Networks"), {
     "sd_lora": shared.OptionInfo("None", "Add Lora to prompt", gr.Dropdown, lambda: {"choices": [""] + [x for x in lora.available_loras]}, refresh=lora.list_available_loras),
+    "lora_cache_size": shared.OptionInfo(1024, "Lora: RAM used to keep recently used Loras read from disk, in megabytes (0 = disable)"),
+    "lora_weights_cache_size": shared.OptionInfo(1024, "Lora: RAM used to keep layer weights for recently used combinations of Loras, so that switching back to them is a copy, in megabytes; only used in merge, keep backup mode (0 = disable)"),
+    "lora_apply_mode": shared.OptionInfo("merge, keep backup", "Lora: how to apply to model; merge, keep backup - original weights of changed layers are kept in RAM; merge, subtract to restore - no backup, weights are restored by subtracting Lora changes; unmerged - for small batches, Lora is computed separately in linear layers, which is faster to switch; larger batches merge without a backup", gr.Radio, {"choices": ["merge, keep backup", "merge, subtract to restore", "unmerged"]}),
+    "lora_unmerged_max_batch_size": shared.OptionInfo(8, "Lora: largest batch for which unmerged mode computes Lora separately", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
 }))
@@ -10,14 +10,14 @@ from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from secrets import compare_digest
 from modules.shared import de_register_model
 import modules.shared as shared
-from modules import sd_samplers, deepbooru
+from modules import sd_samplers, deepbooru, prompt_parser, sd_hijack_clip, script_callbacks, processing
 from modules.api.models import *
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.extras import run_extras, run_pnginfo
 from PIL import PngImagePlugin,Image
 from modules.sd_models import checkpoints_list
 from modules.realesrgan_model import get_realesrgan_models
-from typing import List
+from typing import Dict, List
 from modules.paths import script_path
 import json
 import os
@@ -164,6 +164,7 @@ class Api:
         self.add_api_route("/sdapi/v1/prompt-styles", self.get_promp_styles, methods=["GET"], response_model=List[PromptStyleItem])
         self.add_api_route("/sdapi/v1/artist-categories", self.get_artists_categories, methods=["GET"], response_model=List[str])
         self.add_api_route("/sdapi/v1/artists", self.get_artists, methods=["GET"], response_model=List[ArtistItem])
+        self.add_api_route("/sdapi/v1/cache-stats", self.get_cache_stats, methods=["GET"], response_model=Dict[str, CacheStatsItem])
         self.app.add_api_route("/invocations", self.invocations, methods=["POST"], response_model=Union[TextToImageResponse, ImageToImageResponse, ExtrasSingleImageResponse, ExtrasBatchImagesResponse, InvocationsErrorResponse, InterrogateResponse])
         self.app.add_api_route("/ping", self.ping, methods=["GET"], response_model=PingResponse)
         self.cache = dict()
@@ -379,6 +380,18 @@ class Api:
     def get_sd_models(self):
         return [{"title":x.title, "model_name":x.model_name, "hash":x.hash, "filename": x.filename, "config": x.config} for x in checkpoints_list.values()]
 
+    def get_cache_stats(self):
+        res = {
+            "conditioning": prompt_parser.conditioning_cache.stats(),
+            "tokenization": sd_hijack_clip.tokenization_cache.stats(),
+            "vae": modules.sd_vae.vae_cache.stats(),
+            "hires first pass": processing.first_pass_cache.stats(),
+        }
+
+        res.update(script_callbacks.cache_stats_callback())
+
+        return res
+
     def get_hypernetworks(self):
         return [{"name": name, "path": shared.hypernetworks[name]} for name in shared.hypernetworks]
 
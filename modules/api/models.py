@@ -241,6 +241,14 @@ class ArtistItem(BaseModel):
     score: float = Field(title="Score")
     category: str = Field(title="Category")
 
+class CacheStatsItem(BaseModel):
+    entries: int = Field(title="Entries")
+    bytes: Optional[int] = Field(title="Size in bytes")
+    hits: int = Field(title="Hits")
+    misses: int = Field(title="Misses")
+    hit_rate: float = Field(title="Hit rate")
+    throughput: Optional[float] = Field(title="Throughput", description="Items computed per second on cache misses, if the cache measures it")
+
 class InvocationsRequest(BaseModel):
     task: str
     username: Optional[str]
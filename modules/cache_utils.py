@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+
+def tensors_size(tensors):
+    """returns bytes taken by tensors"""
+
+    return sum(x.element_size() * x.nelement() for x in tensors)
+
+
+class LruCache:
+    """
+    Process-wide LRU cache kept in RAM and bounded by the total size of its values, in megabytes set by the setting named option;
+    sizes of values are given by callers when they are put. A setting of 0 or less disables the cache.
+    """
+
+    def __init__(self, option):
+        self.option = option
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def limit(self):
+        from modules import shared
+
+        return getattr(shared.opts, self.option) * 1024 * 1024
+
+    def enabled(self):
+        return self.limit() > 0
+
+    def get(self, key, valid=None):
+        """returns value for key, or None if there is none or if valid, a function of the value, says it is outdated"""
+
+        entry = self.entries.get(key, None)
+        if entry is None or valid is not None and not valid(entry[0]):
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[0]
+
+    def put(self, key, value, size):
+        limit = self.limit()
+
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+        if size > limit:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.size > limit:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import traceback
+
+import torch
+
+from modules import devices, shared
+
+attention_forward = None
+attention_name = None
+benchmark_done = False
+settings = {}
+
+
+def enabled():
+    return shared.cmd_opts.cpu_profile and devices.device is not None and devices.device.type == 'cpu'
+
+
+def bf16_supported():
+    try:
+        if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            return False
+
+        a = torch.randn(8, 8)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            res = torch.nn.functional.linear(a, a)
+
+        return res.dtype == torch.bfloat16 and bool(torch.isfinite(res).all())
+    except Exception:
+        return False
+
+
+def setup():
+    """applies process-wide settings of the CPU inference profile; must be called before the model is loaded"""
+
+    if not enabled():
+        return
+
+    if shared.cmd_opts.cpu_threads:
+        torch.set_num_threads(shared.cmd_opts.cpu_threads)
+
+    if shared.cmd_opts.cpu_interop_threads:
+        try:
+            torch.set_num_interop_threads(shared.cmd_opts.cpu_interop_threads)
+        except RuntimeError:
+            print("Could not set the number of inter-op threads because torch has already started parallel work.", file=sys.stderr)
+
+    settings["threads"] = torch.get_num_threads()
+    settings["interop threads"] = torch.get_num_interop_threads()
+
+    if not shared.cmd_opts.cpu_no_bf16 and bf16_supported():
+        devices.dtype_autocast_cpu = torch.bfloat16
+
+    settings["autocast"] = "bf16" if devices.dtype_autocast_cpu == torch.bfloat16 else "fp32"
+    settings["channels last"] = not shared.cmd_opts.cpu_no_channels_last
+    settings["compile"] = shared.cmd_opts.cpu_compile
+
+    if shared.cmd_opts.cpu_compile == "compile":
+        os.makedirs(shared.cmd_opts.cpu_compile_cache_dir, exist_ok=True)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", shared.cmd_opts.cpu_compile_cache_dir)
+
+        try:
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+        except Exception:
+            pass
+
+    select_attention()
+
+
+def attention_candidates():
+    from modules import sd_hijack_optimizations
+    from modules.hypernetworks import hypernetwork
+
+    candidates = [
+        ("InvokeAI", sd_hijack_optimizations.split_cross_attention_forward_invokeAI),
+        ("V1", sd_hijack_optimizations.split_cross_attention_forward_v1),
+        ("none", hypernetwork.attention_CrossAttention_forward),
+    ]
+
+    if sd_hijack_optimizations.scaled_dot_product_attention_available():
+        candidates.append(("sdp", sd_hijack_optimizations.scaled_dot_product_attention_forward))
+
+    return candidates
+
+
+def select_attention():
+    """runs each cross attention implementation on a self-attention layer of the size used by the first UNet block at 512x512 and remembers the fastest one"""
+
+    global attention_forward, attention_name
+
+    import ldm.modules.attention
+
+    layer = ldm.modules.attention.CrossAttention(query_dim=320, heads=8, dim_head=40).eval()
+    x = torch.randn(1, 64 * 64, 320)
+
+    timings = []
+    for name, forward in attention_candidates():
+        try:
+            with torch.no_grad(), devices.autocast():
+                forward(layer, x)
+
+                t0 = time.perf_counter()
+                for _ in range(3):
+                    forward(layer, x)
+                timings.append(((time.perf_counter() - t0) / 3, name, forward))
+        except Exception:
+            print(f"Error benchmarking {name} cross attention for CPU profile:", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+
+    if not timings:
+        return
+
+    elapsed, attention_name, attention_forward = min(timings, key=lambda x: x[0])
+    settings["attention"] = attention_name
+    print("CPU profile attention benchmark: " + ", ".join(f"{name}: {t * 1000:.0f}ms" for t, name, _ in timings))
+
+
+def autocast_enabled():
+    try:
+        return torch.is_autocast_enabled("cpu")
+    except TypeError:
+        # torch before 2.4 only has the deprecated function
+        return torch.is_autocast_cpu_enabled()
+
+
+def trace_state():
+    """returns everything besides inputs that Python code in UNet's forward decides on, and so a TorchScript trace freezes"""
+
+    import ldm.modules.attention
+    from modules import extra_networks
+
+    hypernetwork = shared.loaded_hypernetwork
+
+    return (
+        extra_networks.active_networks_key,
+        None if hypernetwork is None else (hypernetwork.filename, hypernetwork.step),
+        shared.opts.sd_hypernetwork_strength,
+        shared.opts.data.get("lora_apply_mode", None),
+        shared.opts.data.get("lora_unmerged_max_batch_size", None),
+        ldm.modules.attention.CrossAttention.forward,
+    )
+
+
+class CompiledForward:
+    """replaces forward of UNet so that it runs through torch.compile or TorchScript; TorchScript traces are made on first use for each input shape and
+    trace_state(), and cached. The module itself is left in place so that its state dict and module names do not change."""
+
+    max_traces = 16
+
+    def __init__(self, unet, mode):
+        self.original_forward = type(unet).forward.__get__(unet)
+        self.mode = mode
+        self.traced = {}
+        self.compiled = torch.compile(self.original_forward, dynamic=True) if mode == "compile" else None
+
+    def __call__(self, x, timesteps=None, context=None, **kwargs):
+        if kwargs or timesteps is None or context is None:
+            return self.original_forward(x, timesteps, context, **kwargs)
+
+        if self.compiled is not None:
+            return self.compiled(x, timesteps, context)
+
+        # token merging picks random tokens on every call, which a trace can't follow
+        if shared.opts.token_merging_ratio > 0:
+            return self.original_forward(x, timesteps, context)
+
+        key = (tuple(x.shape), tuple(context.shape), x.dtype, autocast_enabled(), trace_state())
+        traced = self.traced.get(key, None)
+        if traced is None:
+            # traces for networks and settings no longer in use would otherwise pile up
+            if len(self.traced) >= self.max_traces:
+                self.traced.clear()
+
+            traced = torch.jit.trace(self.original_forward, (x, timesteps, context), check_trace=False)
+            self.traced[key] = traced
+
+        return traced(x, timesteps, context)
+
+
+def apply(sd_model):
+    """applies memory format and compilation settings of the CPU inference profile to a freshly loaded model"""
+
+    if not enabled():
+        return
+
+    if not shared.cmd_opts.cpu_no_channels_last:
+        sd_model.model.to(memory_format=torch.channels_last)
+        sd_model.first_stage_model.to(memory_format=torch.channels_last)
+
+    undo(sd_model)
+
+    if shared.cmd_opts.cpu_compile != "none":
+        unet = sd_model.model.diffusion_model
+
+        try:
+            unet.forward = CompiledForward(unet, shared.cmd_opts.cpu_compile)
+        except Exception:
+            print(f"Error compiling UNet with {shared.cmd_opts.cpu_compile}; using it as is:", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+
+    benchmark(sd_model)
+
+
+def undo(sd_model):
+    unet = sd_model.model.diffusion_model
+    if type(unet.__dict__.get('forward', None)) == CompiledForward:
+        del unet.forward
+
+
+def benchmark(sd_model):
+    """measures UNet speed at 512x512 once after the first model is loaded and reports it along with the profile's settings"""
+
+    global benchmark_done
+
+    if benchmark_done or shared.cmd_opts.cpu_benchmark_steps <= 0:
+        report()
+        return
+
+    benchmark_done = True
+
+    try:
+        x = torch.randn(2, sd_model.model.diffusion_model.in_channels, 64, 64, device=devices.device).to(memory_format=torch.channels_last)
+        t = torch.full((2,), 999, device=devices.device, dtype=torch.long)
+        c = sd_model.get_learned_conditioning(["", ""])
+
+        with torch.no_grad(), devices.autocast():
+            sd_model.apply_model(x, t, c)
+
+            t0 = time.perf_counter()
+            for _ in range(shared.cmd_opts.cpu_benchmark_steps):
+                sd_model.apply_model(x, t, c)
+            elapsed = time.perf_counter() - t0
+
+        settings["it/s"] = f"{shared.cmd_opts.cpu_benchmark_steps / elapsed:.2f}"
+    except Exception:
+        print("Error running CPU profile benchmark:", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+
+    report()
+
+
+def report():
+    print("CPU inference profile: " + ", ".join(f"{k}: {v}" for k, v in settings.items()))
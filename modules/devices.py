@@ -79,6 +79,7 @@ cpu = torch.device("cpu")
 device = device_interrogate = device_gfpgan = device_esrgan = device_codeformer = None
 dtype = torch.float16
 dtype_vae = torch.float16
+dtype_autocast_cpu = None
 
 
 def randn(seed, shape):
@@ -100,6 +101,9 @@ def autocast(disable=False):
     if disable:
         return contextlib.nullcontext()
 
+    if device.type == 'cpu' and dtype_autocast_cpu is not None:
+        return torch.autocast("cpu", dtype=dtype_autocast_cpu)
+
     if dtype == torch.float32 or shared.cmd_opts.precision == "full":
         return contextlib.nullcontext()
 
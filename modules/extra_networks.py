@@ -5,6 +5,9 @@ from modules import errors
 
 extra_network_registry = {}
 
+# arguments of all extra networks from the last call to activate(), including those added by the networks themselves
+active_networks_key = ()
+
 
 def initialize():
     extra_network_registry.clear()
@@ -65,6 +68,10 @@ def activate(p, extra_network_data):
     """call activate for extra networks in extra_network_data in specified order, then call
     activate for all remaining registered networks with an empty argument list"""
 
+    global active_networks_key
+
+    activated = []
+
     for extra_network_name, extra_network_args in extra_network_data.items():
         extra_network = extra_network_registry.get(extra_network_name, None)
         if extra_network is None:
@@ -76,16 +83,24 @@ def activate(p, extra_network_data):
         except Exception as e:
             errors.display(e, f"activating extra network {extra_network_name} with arguments {extra_network_args}")
 
+        activated.append((extra_network_name, extra_network_args))
+
     for extra_network_name, extra_network in extra_network_registry.items():
         args = extra_network_data.get(extra_network_name, None)
         if args is not None:
             continue
 
+        args = []
+
         try:
-            extra_network.activate(p, [])
+            extra_network.activate(p, args)
         except Exception as e:
             errors.display(e, f"activating extra network {extra_network_name}")
 
+        activated.append((extra_network_name, args))
+
+    active_networks_key = tuple((name, tuple(tuple(x.items) for x in args)) for name, args in activated if len(args) > 0)
+
 
 def deactivate(p, extra_network_data):
     """call deactivate for extra networks in extra_network_data in specified order, then call
@@ -80,6 +80,9 @@ def integrate_settings_paste_fields(component_dict):
         'inpainting_mask_weight': 'Conditional mask weight',
         'sd_model_checkpoint': 'Model hash',
         'eta_noise_seed_delta': 'ENSD',
+        'randn_source': 'RNG',
+        'token_merging_ratio': 'Token merging ratio',
+        'token_merging_schedule': 'Token merging schedule',
     }
     settings_paste_fields = [
         (component_dict[k], lambda d, k=k, v=v: ui.apply_setting(k, d.get(v, None)))
@@ -191,6 +194,10 @@ Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 965400086, Size: 512x512, Model
     if "Clip skip" not in res:
         res["Clip skip"] = "1"
 
+    # Missing RNG means noise was made on the device
+    if "RNG" not in res:
+        res["RNG"] = "device"
+
     return res
 
 
@@ -12,7 +12,7 @@ import torch
 import tqdm
 from einops import rearrange, repeat
 from ldm.util import default
-from modules import devices, processing, sd_models, shared, sd_samplers
+from modules import devices, processing, sd_models, shared, sd_samplers, network_catalog
 from modules.textual_inversion import textual_inversion
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 from torch import einsum
@@ -258,16 +258,15 @@ class Hypernetwork:
 def list_hypernetworks(path):
     res = {}
     if shared.cmd_opts.pureui:
-        response = requests.get(f'{shared.api_endpoint}/sd/hypernetwork')
-        if response.status_code == 200:
-            hypernetwork_names = json.loads(response.text)
+        hypernetwork_names = network_catalog.catalog.list_remote(f'{shared.api_endpoint}/sd/hypernetwork', {})
+        if hypernetwork_names is not None:
             for hypernetwork_name in sorted(hypernetwork_names):
                 filename = 'f{hypernetwork_name}.pt'
                 # Prevent a hypothetical "None.pt" from being listed.
                 if not hypernetwork_name.startswith("None"):
                     res[hypernetwork_name] = filename
     else:
-        for filename in sorted(glob.iglob(os.path.join(path, '**/*.pt'), recursive=True)):
+        for filename in sorted(network_catalog.catalog.list_files(path, ['.pt'])):
             name = os.path.splitext(os.path.basename(filename))[0]
             # Prevent a hypothetical "None.pt" from being listed.
             if name != "None":
@@ -5,7 +5,7 @@ import re
 import gradio as gr
 import modules.textual_inversion.preprocess
 import modules.textual_inversion.textual_inversion
-from modules import devices, sd_hijack, shared
+from modules import devices, sd_hijack, shared, network_catalog
 from modules.hypernetworks import hypernetwork
 
 not_available = ["hardswish", "multiheadattention"]
@@ -33,6 +33,7 @@ def create_hypernetwork(name, enable_sizes, overwrite_old, layer_structure=None,
     )
     hypernet.save(fn)
 
+    network_catalog.catalog.clear()
     shared.reload_hypernetworks()
 
     return gr.Dropdown.update(choices=sorted([x for x in shared.hypernetworks.keys()])), f"Created: {fn}", ""
@@ -1,6 +1,12 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import math
 import os
 import sys
+import time
 import traceback
 
 import numpy as np
@@ -16,47 +22,222 @@ import modules.images as images
 import modules.scripts
 
 
+batch_manifest_filename = "img2img-batch-manifest.json"
+
+
+class BatchManifest:
+    """
+    Record of input files of batch img2img whose outputs have been written, kept in the output directory, so that a run that
+    was interrupted or crashed can be started again and skip files that are done. It is only used by a run with the same settings.
+    """
+
+    save_interval = 10
+
+    def __init__(self, output_dir, settings):
+        self.path = os.path.join(output_dir, batch_manifest_filename)
+        self.output_dir = output_dir
+        self.settings = settings
+        self.files = {}
+        self.saved_at = time.time()
+        self.unsaved = False
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf8") as file:
+                    data = json.load(file)
+
+                if data.get("settings") == settings:
+                    self.files = data.get("files", {})
+            except Exception as e:
+                print(f"Error reading batch img2img manifest {self.path}: {e}", file=sys.stderr)
+
+    def is_done(self, filename):
+        entry = self.files.get(os.path.basename(filename), None)
+        if entry is None or entry["mtime"] != os.path.getmtime(filename):
+            return False
+
+        return all(os.path.exists(os.path.join(self.output_dir, x)) for x in entry["outputs"])
+
+    def mark_done(self, filename, outputs):
+        """records outputs of filename; the file is rewritten at most every save_interval seconds, so call save() at the end"""
+
+        self.files[os.path.basename(filename)] = {"mtime": os.path.getmtime(filename), "outputs": outputs}
+        self.unsaved = True
+
+        if time.time() - self.saved_at >= self.save_interval:
+            self.save()
+
+    def save(self):
+        if not self.unsaved:
+            return
+
+        self.saved_at = time.time()
+        self.unsaved = False
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as file:
+            json.dump({"settings": self.settings, "files": self.files}, file, indent=1)
+        os.replace(tmp, self.path)
+
+
+def batch_settings(p, args):
+    """returns hash of everything that changes outputs of batch img2img, for BatchManifest; taken after seeds are fixed, so that a run with random seeds starts over"""
+
+    settings = [p.prompt, p.negative_prompt, p.styles, p.seed, p.subseed, p.subseed_strength, p.sampler_name, p.steps, p.cfg_scale, p.denoising_strength, p.width, p.height, p.resize_mode, p.batch_size, p.n_iter, p.restore_faces, p.tiling, shared.sd_model.sd_model_hash, args[0] if len(args) > 0 else 0]
+
+    return hashlib.sha256(json.dumps(settings, default=str).encode()).hexdigest()
+
+
+def prefetch_images(filenames, depth):
+    """yields (filename, image) for filenames, while the next depth of them are opened and decoded in background; files that are not images are skipped"""
+
+    def load(filename):
+        try:
+            img = Image.open(filename)
+            # Use the EXIF orientation of photos taken by smartphones.
+            img = ImageOps.exif_transpose(img)
+            img.load()
+            return img
+        except Exception as e:
+            print(f"Error loading image {filename}: {e}", file=sys.stderr)
+            return None
+
+    filenames = iter(filenames)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = collections.deque((filename, executor.submit(load, filename)) for filename in itertools.islice(filenames, max(int(depth), 1)))
+
+        while pending:
+            filename, future = pending.popleft()
+            pending.extend((x, executor.submit(load, x)) for x in itertools.islice(filenames, 1))
+
+            img = future.result()
+            if img is not None:
+                yield filename, img
+
+
+def file_settings(img):
+    """returns what of an input file decides how processing turns it into an init image"""
+
+    return img.size, img.mode
+
+
+def pack_files(files, max_files):
+    """groups consecutive (filename, image) pairs from files into lists of at most max_files whose images have the same file_settings"""
+
+    batch = []
+
+    for filename, img in files:
+        if batch and (len(batch) >= max_files or file_settings(batch[0][1]) != file_settings(img)):
+            yield batch
+            batch = []
+
+        batch.append((filename, img))
+
+    if batch:
+        yield batch
+
+
+def save_batch_outputs(processed_images, filename, output_dir, manifest):
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+
+        outputs = []
+        for n, processed_image in enumerate(processed_images):
+            output = os.path.basename(filename)
+
+            if n > 0:
+                left, right = os.path.splitext(output)
+                output = f"{left}-{n}{right}"
+
+            processed_image.save(os.path.join(output_dir, output))
+            outputs.append(output)
+
+        if manifest is not None:
+            manifest.mark_done(filename, outputs)
+    except Exception as e:
+        print(f"Error saving outputs of batch img2img for {filename}: {e}", file=sys.stderr)
+
+
 def process_batch(p, input_dir, output_dir, args):
+    save_normally = output_dir == ''
+
     processing.fix_seed(p)
 
-    images = shared.listfiles(input_dir)
+    manifest = None if save_normally else BatchManifest(output_dir, batch_settings(p, args))
 
-    print(f"Will process {len(images)} images, creating {p.n_iter * p.batch_size} new images for each.")
+    images = [x for x in shared.listfiles(input_dir) if os.path.basename(x) != batch_manifest_filename]
 
-    save_normally = output_dir == ''
+    if manifest is not None:
+        done = set(x for x in images if manifest.is_done(x))
+        if len(done) > 0:
+            print(f"Skipping {len(done)} images that already have outputs in {output_dir}.")
+            images = [x for x in images if x not in done]
+
+    # every file gets batch_size copies; without a selected script, consecutive files with matching settings share one batch
+    script_selected = len(args) > 0 and args[0] != 0
+    copies = p.batch_size
+    files_per_batch = 1 if script_selected else max(int(opts.img2img_batch_max_batch_size) // copies, 1)
+
+    print(f"Will process {len(images)} images, creating {p.n_iter * copies} new images for each.")
 
     p.do_not_save_grid = True
     p.do_not_save_samples = not save_normally
 
-    state.job_count = len(images) * p.n_iter
+    state.job_count = math.ceil(len(images) / max(files_per_batch, 1)) * p.n_iter
 
-    for i, image in enumerate(images):
-        state.job = f"{i+1} out of {len(images)}"
-        if state.skipped:
-            state.skipped = False
+    seed, subseed, batch_size = p.seed, p.subseed, p.batch_size
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    time_start = time.time()
+    files_done = 0
+    images_done = 0
 
-        if state.interrupted:
-            break
+    try:
+        for batch in pack_files(prefetch_images(images, opts.img2img_batch_prefetch), files_per_batch):
+            state.job = f"{files_done + 1} out of {len(images)}"
+            if state.skipped:
+                state.skipped = False
 
-        img = Image.open(image)
-        # Use the EXIF orientation of photos taken by smartphones.
-        img = ImageOps.exif_transpose(img)
-        p.init_images = [img] * p.batch_size
+            if state.interrupted:
+                break
 
-        proc = modules.scripts.scripts_img2img.run(p, *args)
-        if proc is None:
-            proc = process_images(p)
+            filenames = [filename for filename, _ in batch]
+            imgs = [img for _, img in batch]
 
-        for n, processed_image in enumerate(proc.images):
-            filename = os.path.basename(image)
+            p.color_corrections = None
+            if script_selected:
+                p.init_images = imgs * copies
+            else:
+                # every file gets the seeds it would get if it was processed alone: seed + k for its k-th image over all iterations
+                p.init_images = [img for img in imgs for _ in range(copies)]
+                p.batch_size = len(imgs) * copies
+                p.seed = [seed + (i * copies + j if p.subseed_strength == 0 else 0) for i in range(p.n_iter) for _ in imgs for j in range(copies)]
+                p.subseed = [subseed + i * copies + j for i in range(p.n_iter) for _ in imgs for j in range(copies)]
 
-            if n > 0:
-                left, right = os.path.splitext(filename)
-                filename = f"{left}-{n}{right}"
+            proc = modules.scripts.scripts_img2img.run(p, *args) if script_selected else None
+            if proc is None:
+                proc = process_images(p)
+
+            complete = not state.interrupted and not state.skipped
 
             if not save_normally:
-                os.makedirs(output_dir, exist_ok=True)
-                processed_image.save(os.path.join(output_dir, filename))
+                for f, filename in enumerate(filenames):
+                    outputs = [x for k, x in enumerate(proc.images) if k % (len(filenames) * copies) // copies == f]
+                    writer.submit(save_batch_outputs, outputs, filename, output_dir, manifest if complete else None)
+
+            files_done += len(filenames)
+            images_done += len(proc.images)
+            state.images_per_minute = images_done / max(time.time() - time_start, 1e-6) * 60
+            state.textinfo = f"{files_done} out of {len(images)} images, {state.images_per_minute:.1f} images/minute"
+    finally:
+        writer.shutdown(wait=True)
+
+        if manifest is not None:
+            manifest.save()
+
+        p.seed, p.subseed, p.batch_size = seed, subseed, batch_size
+
+    print(f"Processed {files_done} images in {time.time() - time_start:.1f} seconds, {state.images_per_minute or 0:.1f} images/minute.")
 
 
 def img2img(id_task: str, mode: int, prompt: str, negative_prompt: str, prompt_style: str, prompt_style2: str, init_img, init_img_with_mask, init_img_with_mask_orig, init_img_inpaint, init_mask_inpaint, mask_mode, steps: int, sampler_index: int, mask_blur: int, mask_alpha: float, inpainting_fill: int, restore_faces: bool, tiling: bool, n_iter: int, batch_size: int, cfg_scale: float, denoising_strength: float, seed: int, subseed: int, subseed_strength: float, seed_resize_from_h: int, seed_resize_from_w: int, seed_enable_extras: bool, height: int, width: int, resize_mode: int, inpaint_full_res: bool, inpaint_full_res_padding: int, inpainting_mask_invert: int, img2img_batch_input_dir: str, img2img_batch_output_dir: str, *args):
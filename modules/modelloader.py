@@ -1,4 +1,3 @@
-import glob
 import os
 import shutil
 import importlib
@@ -22,6 +21,7 @@ def load_models(model_path: str, model_url: str = None, command_path: str = None
     @return: A list of paths containing the desired model(s)
     """
     output = []
+    seen = set()
 
     if ext_filter is None:
         ext_filter = []
@@ -41,15 +41,9 @@ def load_models(model_path: str, model_url: str = None, command_path: str = None
 
         for place in places:
             if os.path.exists(place):
-                for file in glob.iglob(place + '**/**', recursive=True):
-                    full_path = file
-                    if os.path.isdir(full_path):
-                        continue
-                    if len(ext_filter) != 0:
-                        model_name, extension = os.path.splitext(file)
-                        if extension not in ext_filter:
-                            continue
-                    if file not in output:
+                for full_path in walk_files(place, ext_filter):
+                    if full_path not in seen:
+                        seen.add(full_path)
                         output.append(full_path)
 
         if model_url is not None and len(output) == 0:
@@ -65,6 +59,29 @@ def load_models(model_path: str, model_url: str = None, command_path: str = None
     return output
 
 
+def walk_files(path: str, ext_filter=None):
+    """
+    Lists files under path recursively in a single directory walk, skipping hidden files and directories.
+
+    @param path: The directory to search in.
+    @param ext_filter: An optional list of filename extensions to filter by
+    @return: A generator of paths to matching files
+    """
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+
+            if ext_filter:
+                _, extension = os.path.splitext(filename)
+                if extension not in ext_filter:
+                    continue
+
+            yield os.path.join(root, filename)
+
+
 def friendly_name(file: str):
     if "http" in file:
         file = urlparse(file).path
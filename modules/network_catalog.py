@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+import time
+
+import requests
+
+from modules import shared
+
+
+class NetworkCatalog:
+    """
+    Keeps listings of files of extra networks, such as Loras and hypernetworks, so that refreshing the lists does not
+    rescan directories or query the API on every call.
+
+    A directory is walked once, and the result is reused for extra_networks_catalog_ttl seconds; after that, mtimes of
+    walked directories are compared to decide whether a new walk is needed. Lists from the API in pureui mode are reused
+    for the same time. Names that could not be found are remembered for the same time too, so that a typo in a prompt
+    does not trigger a rescan on every generation.
+    """
+
+    def __init__(self):
+        self.dirs = {}
+        self.remote = {}
+        self.missing = {}
+
+    def ttl(self):
+        return shared.opts.extra_networks_catalog_ttl
+
+    def list_files(self, path, extensions, force=False):
+        """returns filenames in directory path and its subdirectories that end with one of extensions, in order of the walk;
+        with force, the directory is walked again even if the previous walk is recent"""
+
+        now = time.time()
+        entry = None if force else self.dirs.get(path, None)
+
+        if entry is not None and now - entry["checked"] >= self.ttl():
+            entry["checked"] = now
+            if not self.dirs_unchanged(entry["dirs"]):
+                entry = None
+
+        if entry is None:
+            entry = self.walk(path)
+            entry["checked"] = now
+            self.dirs[path] = entry
+            self.missing.clear()
+
+        return [filename for filename in entry["files"] if filename.lower().endswith(tuple(extensions))]
+
+    def walk(self, path):
+        files = []
+        dirs = {}
+
+        for dirpath, _, filenames in os.walk(path, followlinks=True):
+            dirs[dirpath] = os.path.getmtime(dirpath)
+            files += [os.path.join(dirpath, filename) for filename in filenames]
+
+        return {"files": files, "dirs": dirs}
+
+    def dirs_unchanged(self, dirs):
+        try:
+            return all(os.path.getmtime(dirpath) == mtime for dirpath, mtime in dirs.items())
+        except OSError:
+            return False
+
+    def list_remote(self, url, params, force=False):
+        """returns parsed response of a GET request to url, reusing the previous response for the same request if it is recent enough
+        and not force; None if the request failed"""
+
+        now = time.time()
+        key = (url, tuple(sorted(params.items())))
+        entry = None if force else self.remote.get(key, None)
+
+        if entry is not None and now - entry[0] < self.ttl():
+            return entry[1]
+
+        try:
+            response = requests.get(url=url, params=params)
+        except Exception as e:
+            print(f"Error listing networks from {url}: {e}", file=sys.stderr)
+            return None
+
+        if response.status_code != 200:
+            return None
+
+        items = json.loads(response.text)
+        self.remote[key] = (now, items)
+        self.missing.clear()
+
+        return items
+
+    def recently_missing(self, name):
+        """tells whether name was not found among networks within extra_networks_catalog_ttl seconds"""
+
+        missing_at = self.missing.get(name, None)
+
+        return missing_at is not None and time.time() - missing_at < self.ttl()
+
+    def mark_missing(self, name):
+        self.missing[name] = time.time()
+
+    def clear(self):
+        """forgets all listings, so that the next ones are made anew; used when the user asks for lists to be refreshed"""
+
+        self.dirs.clear()
+        self.remote.clear()
+        self.missing.clear()
+
+
+catalog = NetworkCatalog()
@@ -1,3 +1,6 @@
+import concurrent.futures
+import copy
+import hashlib
 import json
 import math
 import os
@@ -13,8 +16,9 @@ from skimage import exposure
 from typing import Any, Dict, List, Optional
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste,  extra_networks
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste,  extra_networks, sd_vae_tiled, rng, rng_philox, cache_utils
 from modules.sd_hijack import model_hijack
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
 import modules.face_restoration
@@ -78,7 +82,7 @@ class StableDiffusionProcessing():
     """
     The first set of paramaters: sd_models -> do_not_reload_embeddings represent the minimum required to create a StableDiffusionProcessing
     """
-    def __init__(self, sd_model=None, outpath_samples=None, outpath_grids=None, prompt: str = "", styles: List[str] = None, seed: int = -1, subseed: int = -1, subseed_strength: float = 0, seed_resize_from_h: int = -1, seed_resize_from_w: int = -1, seed_enable_extras: bool = True, sampler_name: str = None, batch_size: int = 1, n_iter: int = 1, steps: int = 50, cfg_scale: float = 7.0, width: int = 512, height: int = 512, restore_faces: bool = False, tiling: bool = False, do_not_save_samples: bool = False, do_not_save_grid: bool = False, extra_generation_params: Dict[Any, Any] = None, overlay_images: Any = None, negative_prompt: str = None, eta: float = None, do_not_reload_embeddings: bool = False, denoising_strength: float = 0, ddim_discretize: str = None, s_churn: float = 0.0, s_tmax: float = None, s_tmin: float = 0.0, s_noise: float = 1.0, override_settings: Dict[str, Any] = None, sampler_index: int = None, script_args: str = None):
+    def __init__(self, sd_model=None, outpath_samples=None, outpath_grids=None, prompt: str = "", styles: List[str] = None, seed: int = -1, subseed: int = -1, subseed_strength: float = 0, seed_resize_from_h: int = -1, seed_resize_from_w: int = -1, seed_enable_extras: bool = True, sampler_name: str = None, batch_size: int = 1, n_iter: int = 1, steps: int = 50, cfg_scale: float = 7.0, width: int = 512, height: int = 512, restore_faces: bool = False, tiling: bool = False, do_not_save_samples: bool = False, do_not_save_grid: bool = False, extra_generation_params: Dict[Any, Any] = None, overlay_images: Any = None, negative_prompt: str = None, eta: float = None, do_not_reload_embeddings: bool = False, denoising_strength: float = 0, ddim_discretize: str = None, s_churn: float = 0.0, s_tmax: float = None, s_tmin: float = 0.0, s_noise: float = 1.0, guidance_cutoff: float = 0.0, override_settings: Dict[str, Any] = None, sampler_index: int = None, script_args: str = None):
         if sampler_index is not None:
             print("sampler_index argument for StableDiffusionProcessing does not do anything; use sampler_name", file=sys.stderr)
 
@@ -118,6 +122,7 @@ class StableDiffusionProcessing():
         self.s_tmin = s_tmin or opts.s_tmin
         self.s_tmax = s_tmax or float('inf')  # not representable as a standard ui option
         self.s_noise = s_noise or opts.s_noise
+        self.guidance_cutoff: float = guidance_cutoff or 0.0
         self.override_settings = {k: v for k, v in (override_settings or {}).items() if k not in shared.restricted_opts}
         self.is_using_inpainting_conditioning = False
         self.disable_extra_networks = False
@@ -146,6 +151,7 @@ class StableDiffusionProcessing():
         self.scripts = None
         self.all_prompts = None
         self.all_negative_prompts = None
+        self.negative_prompts = None
         self.all_seeds = None
         self.all_subseeds = None
 
@@ -163,7 +169,7 @@ class StableDiffusionProcessing():
 
         # The "masked-image" in this case will just be all zeros since the entire image is masked.
         image_conditioning = torch.zeros(x.shape[0], 3, height, width, device=x.device)
-        image_conditioning = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image_conditioning)) 
+        image_conditioning = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, image_conditioning)) 
 
         # Add the fake full 1s mask to the first dimension.
         image_conditioning = torch.nn.functional.pad(image_conditioning, (0, 0, 0, 0, 1, 0), value=1.0)
@@ -171,7 +177,7 @@ class StableDiffusionProcessing():
 
         return image_conditioning
 
-    def img2img_image_conditioning(self, source_image, latent_image, image_mask = None):
+    def img2img_image_conditioning(self, source_image, latent_image, image_mask = None, image_index = None):
         if self.sampler.conditioning_key not in {'hybrid', 'concat'}:
             # Dummy zero conditioning if we're not using inpainting model.
             return latent_image.new_zeros(latent_image.shape[0], 5, 1, 1)
@@ -202,7 +208,11 @@ class StableDiffusionProcessing():
         )
         
         # Encode the new masked image using first stage of network.
-        conditioning_image = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(conditioning_image))
+        # If source images are distinct ones of the batch, image_index tells which of them each image of the batch is.
+        encoding = encode_first_stage(self.sd_model, conditioning_image)
+        if image_index is not None:
+            encoding = repeat_first_stage_encoding(encoding, image_index)
+        conditioning_image = self.sd_model.get_first_stage_encoding(encoding)
 
         # Create the concatenated conditioning tensor to be fed to `c_concat`
         conditioning_mask = torch.nn.functional.interpolate(conditioning_mask, size=latent_image.shape[-2:])
@@ -249,6 +259,7 @@ class Processed:
         self.styles = p.styles
         self.job_timestamp = state.job_timestamp
         self.clip_skip = opts.CLIP_stop_at_last_layers
+        self.first_pass_cache_hits = getattr(p, 'first_pass_cache_hits', 0)
 
         self.eta = p.eta
         self.ddim_discretize = p.ddim_discretize
@@ -301,6 +312,7 @@ class Processed:
             "styles": self.styles,
             "job_timestamp": self.job_timestamp,
             "clip_skip": self.clip_skip,
+            "first_pass_cache_hits": self.first_pass_cache_hits,
             "is_using_inpainting_conditioning": self.is_using_inpainting_conditioning,
         }
 
@@ -332,31 +344,39 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
     # enables the generation of additional tensors with noise that the sampler will use during its processing.
     # Using those pre-generated tensors instead of simple torch.randn allows a batch with seeds [100, 101] to
     # produce the same images as with two batches [100], [101].
-    if p is not None and p.sampler is not None and (len(seeds) > 1 and opts.enable_batch_seeds or opts.eta_noise_seed_delta > 0):
-        sampler_noises = [[] for _ in range(p.sampler.number_of_needed_noises(p))]
+    noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
+
+    # with Philox, noise for all seeds is made at once on CPU, so that all devices get the same result, and is moved to device once at the end
+    philox = opts.randn_source == "Philox (CPU)"
+    if philox:
+        philox_noises = torch.from_numpy(rng_philox.randn(seeds, noise_shape))
+        philox_subnoises = torch.from_numpy(rng_philox.randn([0 if i >= len(subseeds) else subseeds[i] for i in range(len(seeds))], noise_shape)) if subseeds is not None else None
+        philox_xs = torch.from_numpy(rng_philox.randn(seeds, shape)) if noise_shape != shape else None
+
+    # with Philox, sampler noise always comes from it, as the device generator would make it differ between devices
+    if p is not None and p.sampler is not None and (philox or len(seeds) > 1 and opts.enable_batch_seeds or opts.eta_noise_seed_delta > 0):
+        sampler_noises = (rng.PhiloxSamplerNoise if philox else rng.SamplerNoise)(p.sampler.number_of_needed_noises(p), noise_shape)
     else:
         sampler_noises = None
 
     for i, seed in enumerate(seeds):
-        noise_shape = shape if seed_resize_from_h <= 0 or seed_resize_from_w <= 0 else (shape[0], seed_resize_from_h//8, seed_resize_from_w//8)
-
         subnoise = None
         if subseeds is not None:
             subseed = 0 if i >= len(subseeds) else subseeds[i]
 
-            subnoise = devices.randn(subseed, noise_shape)
+            subnoise = philox_subnoises[i] if philox else devices.randn(subseed, noise_shape)
 
         # randn results depend on device; gpu and cpu get different results for same seed;
         # the way I see it, it's better to do this on CPU, so that everyone gets same result;
         # but the original script had it like this, so I do not dare change it for now because
         # it will break everyone's seeds.
-        noise = devices.randn(seed, noise_shape)
+        noise = philox_noises[i] if philox else devices.randn(seed, noise_shape)
 
         if subnoise is not None:
             noise = slerp(subseed_strength, noise, subnoise)
 
         if noise_shape != shape:
-            x = devices.randn(seed, shape)
+            x = philox_xs[i] if philox else devices.randn(seed, shape)
             dx = (shape[2] - noise_shape[2]) // 2
             dy = (shape[1] - noise_shape[1]) // 2
             w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
@@ -369,31 +389,148 @@ def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, see
             x[:, ty:ty+h, tx:tx+w] = noise[:, dy:dy+h, dx:dx+w]
             noise = x
 
-        if sampler_noises is not None:
-            cnt = p.sampler.number_of_needed_noises(p)
-
+        if philox and sampler_noises is not None:
+            sampler_noises.add_seed(seed + opts.eta_noise_seed_delta)
+        elif sampler_noises is not None:
             if opts.eta_noise_seed_delta > 0:
                 torch.manual_seed(seed + opts.eta_noise_seed_delta)
 
-            for j in range(cnt):
-                sampler_noises[j].append(devices.randn_without_seed(tuple(noise_shape)))
+            # noise for each step is made when the sampler needs it, from where the global generator is now
+            sampler_noises.add_seed()
 
         xs.append(noise)
 
     if sampler_noises is not None:
-        p.sampler.sampler_noises = [torch.stack(n).to(shared.device) for n in sampler_noises]
+        # later draws from the global generator, such as seeds of noise samplers, must start where they did when all noise was drawn here
+        sampler_noises.finish()
+        p.sampler.sampler_noises = sampler_noises
 
     x = torch.stack(xs).to(shared.device)
     return x
 
 
+def use_tiled_vae(height, width):
+    """tells whether images of this size in pixels should go through VAE in tiles, according to settings"""
+
+    return opts.vae_tiling_threshold > 0 and height * width > opts.vae_tiling_threshold * 1000 * 1000
+
+
 def decode_first_stage(model, x):
     with devices.autocast(disable=x.dtype == devices.dtype_vae):
-        x = model.decode_first_stage(x)
+        if use_tiled_vae(x.shape[2] * opt_f, x.shape[3] * opt_f):
+            x = sd_vae_tiled.decode(model, x, opts.vae_tile_size // opt_f, opts.vae_tile_overlap // opt_f)
+        else:
+            x = model.decode_first_stage(x)
 
     return x
 
 
+def encode_first_stage(model, x):
+    """returns the same as model.encode_first_stage, going through VAE in tiles for large images"""
+
+    if use_tiled_vae(x.shape[2], x.shape[3]):
+        return sd_vae_tiled.encode(model, x, opts.vae_tile_size // opt_f, opts.vae_tile_overlap // opt_f)
+
+    return model.encode_first_stage(x)
+
+
+def unique_images(imgs):
+    """returns indexes of distinct images among numpy arrays imgs, and for each of imgs, the position of its copy among the distinct ones"""
+
+    indexes = []
+    positions = []
+    known = {}
+    keys = {}
+
+    for i, img in enumerate(imgs):
+        # one image repeated for the batch is the same object each time, so it is hashed once
+        key = keys.get(id(img), None)
+        if key is None:
+            key = keys[id(img)] = hashlib.sha256(img.tobytes()).hexdigest() + str(img.shape)
+
+        if key not in known:
+            known[key] = len(indexes)
+            indexes.append(i)
+
+        positions.append(known[key])
+
+    return indexes, positions
+
+
+def repeat_first_stage_encoding(encoding, index):
+    """returns VAE encoder output for a batch of images from encoding, made for distinct images only, and index, the position among them of each image of the batch"""
+
+    if isinstance(encoding, DiagonalGaussianDistribution):
+        return DiagonalGaussianDistribution(encoding.parameters[index], deterministic=encoding.deterministic)
+
+    return encoding[index]
+
+
+# number of images that could be decoded at once without running out of memory, by latent size
+vae_decode_chunk_sizes = {}
+
+
+def vae_decode_chunk_size(samples):
+    """returns how many of samples to decode at once: the setting if set, otherwise as many as fit into free VRAM at this resolution"""
+
+    n = samples.shape[0]
+
+    # settings edited in the UI's number box come as float
+    if opts.vae_decode_batch_size > 0:
+        return min(n, int(opts.vae_decode_batch_size))
+
+    if samples.device.type != 'cuda':
+        return n
+
+    known = vae_decode_chunk_sizes.get(tuple(samples.shape[2:]), None)
+    if known is not None:
+        return min(n, known)
+
+    # the decoder works with 128 channels at full resolution, and holds about ten such tensors at its peak
+    free, _ = torch.cuda.mem_get_info(samples.device)
+    height, width = samples.shape[2] * opt_f, samples.shape[3] * opt_f
+    if use_tiled_vae(height, width):
+        height, width = min(height, opts.vae_tile_size), min(width, opts.vae_tile_size)
+    per_image = height * width * 128 * torch.finfo(devices.dtype_vae).bits // 8 * 10
+
+    return max(1, min(n, int(free * 0.8) // per_image))
+
+
+def decode_first_stage_batch(model, samples):
+    """decodes latents in chunks of as many images as fit into memory, halving the chunk if it runs out of memory; returns images on CPU as floats between 0 and 1"""
+
+    samples = samples.to(dtype=devices.dtype_vae)
+    chunk_size = vae_decode_chunk_size(samples)
+
+    decoded = []
+    i = 0
+    while i < samples.shape[0]:
+        try:
+            x = decode_first_stage(model, samples[i:i + chunk_size])
+        except RuntimeError as e:
+            if chunk_size == 1 or 'out of memory' not in str(e):
+                raise
+
+            chunk_size //= 2
+            vae_decode_chunk_sizes[tuple(samples.shape[2:])] = chunk_size
+            print(f"Out of memory while decoding {chunk_size * 2} images with VAE; retrying with {chunk_size}", file=sys.stderr)
+            devices.torch_gc()
+            continue
+
+        decoded.append(x.cpu())
+        i += chunk_size
+
+    x = torch.cat(decoded).float()
+
+    return torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
+
+
+def images_to_uint8(x):
+    """converts a batch of CHW images with values between 0 and 1 to a numpy array of HWC uint8 images"""
+
+    return (255. * x.cpu()).to(torch.uint8).permute(0, 2, 3, 1).contiguous().numpy()
+
+
 def get_fixed_seed(seed):
     if seed is None or seed == '' or seed == -1:
         return int(random.randrange(4294967294))
@@ -431,7 +568,11 @@ def create_infotext(p, all_prompts, all_seeds, all_subseeds, comments, iteration
         "Conditional mask weight": getattr(p, "inpainting_mask_weight", shared.opts.inpainting_mask_weight) if p.is_using_inpainting_conditioning else None,
         "Eta": (None if p.sampler is None or p.sampler.eta == p.sampler.default_eta else p.sampler.eta),
         "Clip skip": None if clip_skip <= 1 else clip_skip,
+        "Guidance cutoff": None if getattr(getattr(p.sampler, 'model_wrap_cfg', None), 'guidance_cutoff_sigma', None) is None else p.guidance_cutoff,
         "ENSD": None if opts.eta_noise_seed_delta == 0 else opts.eta_noise_seed_delta,
+        "RNG": None if opts.randn_source == "device" else opts.randn_source,
+        "Token merging ratio": None if opts.token_merging_ratio <= 0 else opts.token_merging_ratio,
+        "Token merging schedule": None if opts.token_merging_ratio <= 0 or opts.token_merging_schedule == opts.data_labels["token_merging_schedule"].default else opts.token_merging_schedule,
     }
 
     generation_params.update(p.extra_generation_params)
@@ -461,6 +602,73 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
     return res
 
 
+postprocessing_executor = None
+
+
+def get_postprocessing_executor():
+    global postprocessing_executor
+
+    # a single worker keeps images saved in order, so that their sequence numbers in filenames do not collide
+    if postprocessing_executor is None:
+        postprocessing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocessing")
+
+    return postprocessing_executor
+
+
+def snapshot_processing(p):
+    """returns a copy of p for saving images of one batch in background, so that image_saved callbacks see fields of that batch
+    and not those the next batch sets meanwhile"""
+
+    res = copy.copy(p)
+    res.extra_generation_params = dict(p.extra_generation_params)
+
+    return res
+
+
+def restore_faces_batch(x_samples):
+    """returns decoded uint8 images of one batch with faces restored"""
+
+    res = []
+
+    for x_sample in x_samples:
+        devices.torch_gc()
+
+        res.append(modules.face_restoration.restore_faces(x_sample))
+        devices.torch_gc()
+
+    return res
+
+
+def postprocess_batch(p, x_samples, seeds, prompts, texts, unrestored=None):
+    """corrects colors, applies overlays and saves decoded uint8 images of one batch, along with unrestored, the same images before face
+    restoration, if any; returns them as PIL images"""
+
+    batch_images = []
+
+    for i, x_sample in enumerate(x_samples):
+        if unrestored is not None and opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
+            images.save_image(Image.fromarray(unrestored[i]), p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=texts[i], p=p, suffix="-before-face-restoration")
+
+        image = Image.fromarray(x_sample)
+
+        if p.color_corrections is not None and i < len(p.color_corrections):
+            if opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction:
+                image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
+                images.save_image(image_without_cc, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=texts[i], p=p, suffix="-before-color-correction")
+            image = apply_color_correction(p.color_corrections[i], image)
+
+        image = apply_overlay(image, p.paste_to, i, p.overlay_images)
+
+        if opts.samples_save and not p.do_not_save_samples:
+            images.save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=texts[i], p=p)
+
+        if opts.enable_pnginfo:
+            image.info["parameters"] = texts[i]
+        batch_images.append(image)
+
+    return batch_images
+
+
 def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
 
@@ -515,121 +723,127 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     infotexts = []
     output_images = []
 
-    with torch.no_grad(), p.sd_model.ema_scope():
-        with devices.autocast():
-            p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
+    # color correction, overlays and saving of batches waiting in pending run in background while the next batch is sampled
+    pipeline_depth = opts.postprocessing_pipeline_depth
+    pending = []
 
-        if state.job_count == -1:
-            state.job_count = p.n_iter
+    def collect_batch(texts, batch_images):
+        if isinstance(batch_images, concurrent.futures.Future):
+            batch_images = batch_images.result()
 
-        for n in range(p.n_iter):
-            if state.skipped:
-                state.skipped = False
-            
-            if state.interrupted:
-                break
+        infotexts.extend(texts)
+        output_images.extend(batch_images)
 
-            prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-            negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-            seeds = p.all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
-            subseeds = p.all_subseeds[n * p.batch_size:(n + 1) * p.batch_size]
+    try:
+        with torch.no_grad(), p.sd_model.ema_scope():
+            with devices.autocast():
+                p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
 
-            if len(prompts) == 0:
-                break
+            if state.job_count == -1:
+                state.job_count = p.n_iter
 
-            prompts, extra_network_data = extra_networks.parse_prompts(prompts)
+            for n in range(p.n_iter):
+                if state.skipped:
+                    state.skipped = False
 
-            if not p.disable_extra_networks:
-                with devices.autocast():
-                    extra_networks.activate(p, extra_network_data)
+                if state.interrupted:
+                    break
 
-            if p.scripts is not None:
-                p.scripts.process_batch(p, batch_number=n, prompts=prompts, seeds=seeds, subseeds=subseeds)
+                prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                seeds = p.all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
+                subseeds = p.all_subseeds[n * p.batch_size:(n + 1) * p.batch_size]
 
-            with devices.autocast():
-                uc = prompt_parser.get_learned_conditioning(shared.sd_model, negative_prompts, p.steps)
-                c = prompt_parser.get_multicond_learned_conditioning(shared.sd_model, prompts, p.steps)
+                if len(prompts) == 0:
+                    break
 
-            if len(model_hijack.comments) > 0:
-                for comment in model_hijack.comments:
-                    comments[comment] = 1
+                prompts, extra_network_data = extra_networks.parse_prompts(prompts)
 
-            if p.n_iter > 1:
-                shared.state.job = f"Batch {n+1} out of {p.n_iter}"
+                if not p.disable_extra_networks:
+                    with devices.autocast():
+                        extra_networks.activate(p, extra_network_data)
 
-            with devices.autocast():
-                samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
+                if p.scripts is not None:
+                    p.scripts.process_batch(p, batch_number=n, prompts=prompts, seeds=seeds, subseeds=subseeds)
 
-            x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-            x_samples_ddim = torch.stack(x_samples_ddim).float()
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                with devices.autocast():
+                    uc = prompt_parser.get_learned_conditioning(shared.sd_model, negative_prompts, p.steps)
+                    c = prompt_parser.get_multicond_learned_conditioning(shared.sd_model, prompts, p.steps)
 
-            del samples_ddim
+                p.negative_prompts = negative_prompts
 
-            if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-                lowvram.send_everything_to_cpu()
+                if len(model_hijack.comments) > 0:
+                    for comment in model_hijack.comments:
+                        comments[comment] = 1
 
-            devices.torch_gc()
+                if p.n_iter > 1:
+                    shared.state.job = f"Batch {n+1} out of {p.n_iter}"
 
-            if opts.filter_nsfw:
-                import modules.safety as safety
-                x_samples_ddim = modules.safety.censor_batch(x_samples_ddim)
+                with devices.autocast():
+                    samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
 
-            for i, x_sample in enumerate(x_samples_ddim):
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
+                x_samples_ddim = decode_first_stage_batch(p.sd_model, samples_ddim)
 
-                if p.restore_faces:
-                    if opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
-                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-face-restoration")
+                del samples_ddim
 
-                    devices.torch_gc()
+                if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+                    lowvram.send_everything_to_cpu()
 
-                    x_sample = modules.face_restoration.restore_faces(x_sample)
-                    devices.torch_gc()
+                devices.torch_gc()
 
-                image = Image.fromarray(x_sample)
+                if opts.filter_nsfw:
+                    import modules.safety as safety
+                    x_samples_ddim = modules.safety.censor_batch(x_samples_ddim)
 
-                if p.color_corrections is not None and i < len(p.color_corrections):
-                    if opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction:
-                        image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                        images.save_image(image_without_cc, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-color-correction")
-                    image = apply_color_correction(p.color_corrections[i], image)
+                x_samples = images_to_uint8(x_samples_ddim)
+                texts = [infotext(n, i) for i in range(len(x_samples))]
 
-                image = apply_overlay(image, p.paste_to, i, p.overlay_images)
+                del x_samples_ddim
 
-                if opts.samples_save and not p.do_not_save_samples:
-                    images.save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p)
+                devices.torch_gc()
 
-                text = infotext(n, i)
-                infotexts.append(text)
-                if opts.enable_pnginfo:
-                    image.info["parameters"] = text
-                output_images.append(image)
+                # face restoration uses the GPU, so it stays out of background post-processing
+                unrestored = None
+                if p.restore_faces:
+                    unrestored = x_samples
+                    x_samples = restore_faces_batch(x_samples)
 
-            del x_samples_ddim 
+                if pipeline_depth > 0:
+                    pending.append((texts, get_postprocessing_executor().submit(postprocess_batch, snapshot_processing(p), x_samples, seeds, prompts, texts, unrestored)))
 
-            devices.torch_gc()
+                    while len(pending) > pipeline_depth:
+                        collect_batch(*pending.pop(0))
+                else:
+                    collect_batch(texts, postprocess_batch(p, x_samples, seeds, prompts, texts, unrestored))
 
-            state.nextjob()
+                state.nextjob()
 
-        p.color_corrections = None
+            while pending:
+                collect_batch(*pending.pop(0))
 
-        index_of_first_image = 0
-        unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
-        if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
-            grid = images.image_grid(output_images, p.batch_size)
+            p.color_corrections = None
 
-            if opts.return_grid:
-                text = infotext()
-                infotexts.insert(0, text)
-                if opts.enable_pnginfo:
-                    grid.info["parameters"] = text
-                output_images.insert(0, grid)
-                index_of_first_image = 1
+            index_of_first_image = 0
+            unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
+            if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
+                grid = images.image_grid(output_images, p.batch_size)
 
-            if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+                if opts.return_grid:
+                    text = infotext()
+                    infotexts.insert(0, text)
+                    if opts.enable_pnginfo:
+                        grid.info["parameters"] = text
+                    output_images.insert(0, grid)
+                    index_of_first_image = 1
+
+                if opts.grid_save:
+                    images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+    finally:
+        # if generation fails, batches still waiting must not be saved after process_images restores override_settings
+        for _, future in pending:
+            future.cancel()
+
+        concurrent.futures.wait([future for _, future in pending])
 
     if not p.disable_extra_networks and extra_network_data:
         extra_networks.deactivate(p, extra_network_data)
@@ -644,6 +858,67 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     return res
 
 
+# latents made by the first pass of hires. fix
+first_pass_cache = cache_utils.LruCache("hires_first_pass_cache_size")
+
+
+def script_args_digest(script_args):
+    """returns hash of script arguments, or None if some of them, such as images, are not plain values that stay the same between runs"""
+
+    try:
+        return hashlib.sha256(json.dumps(script_args).encode()).hexdigest()
+    except (TypeError, ValueError):
+        return None
+
+
+def first_pass_cache_key(p, prompts, seeds, subseeds):
+    """returns key for first_pass_cache: everything that changes latents made by hires. fix first pass; None if they can't be cached"""
+
+    script_args = script_args_digest(p.script_args)
+    if p.sampler_noise_scheduler_override is not None or script_args is None or p.negative_prompts is None:
+        return None
+
+    checkpoint_info = getattr(p.sd_model, 'sd_checkpoint_info', None)
+
+    return (
+        getattr(p.sd_model, 'sd_model_hash', None),
+        getattr(checkpoint_info, 'filename', None),
+        extra_networks.active_networks_key,
+        None if shared.loaded_hypernetwork is None else (shared.loaded_hypernetwork.filename, shared.loaded_hypernetwork.step),
+        opts.sd_hypernetwork_strength,
+        # conditioning is made from prompts and steps, with settings in the key of prompt_parser.conditioning_cache
+        prompt_parser.conditioning_cache_key(p.sd_model, [tuple(prompts), tuple(p.negative_prompts)]),
+        script_args,
+        tuple(seeds),
+        tuple(subseeds),
+        p.subseed_strength,
+        p.seed_resize_from_h,
+        p.seed_resize_from_w,
+        p.sampler_name,
+        p.steps,
+        p.cfg_scale,
+        p.guidance_cutoff,
+        p.eta,
+        p.ddim_discretize,
+        p.s_churn,
+        p.s_tmin,
+        p.s_tmax,
+        p.s_noise,
+        p.tiling,
+        p.firstphase_width,
+        p.firstphase_height,
+        p.truncate_x,
+        p.truncate_y,
+        opts.eta_ancestral,
+        opts.eta_ddim,
+        opts.eta_noise_seed_delta,
+        opts.randn_source,
+        opts.enable_batch_seeds,
+        opts.token_merging_ratio,
+        opts.token_merging_schedule,
+    )
+
+
 class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
     sampler = None
 
@@ -655,6 +930,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
         self.firstphase_height = firstphase_height
         self.truncate_x = 0
         self.truncate_y = 0
+        self.first_pass_cache_hits = 0
         self.scripts = modules.scripts.scripts_txt2img
 
     def init(self, all_prompts, all_seeds, all_subseeds):
@@ -698,10 +974,22 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             samples = self.sampler.sample(self, x, conditioning, unconditional_conditioning, image_conditioning=self.txt2img_image_conditioning(x))
             return samples
 
-        x = create_random_tensors([opt_C, self.firstphase_height // opt_f, self.firstphase_width // opt_f], seeds=seeds, subseeds=subseeds, subseed_strength=self.subseed_strength, seed_resize_from_h=self.seed_resize_from_h, seed_resize_from_w=self.seed_resize_from_w, p=self)
-        samples = self.sampler.sample(self, x, conditioning, unconditional_conditioning, image_conditioning=self.txt2img_image_conditioning(x, self.firstphase_width, self.firstphase_height))
+        # when only second pass settings change, latents from the first pass are the same, so they are taken from cache if enabled
+        first_pass_key = first_pass_cache_key(self, prompts, seeds, subseeds) if first_pass_cache.enabled() else None
+        samples = first_pass_cache.get(first_pass_key) if first_pass_key is not None else None
+
+        if samples is not None:
+            self.first_pass_cache_hits += 1
+            samples = samples.to(shared.device, copy=True)
+        else:
+            x = create_random_tensors([opt_C, self.firstphase_height // opt_f, self.firstphase_width // opt_f], seeds=seeds, subseeds=subseeds, subseed_strength=self.subseed_strength, seed_resize_from_h=self.seed_resize_from_h, seed_resize_from_w=self.seed_resize_from_w, p=self)
+            samples = self.sampler.sample(self, x, conditioning, unconditional_conditioning, image_conditioning=self.txt2img_image_conditioning(x, self.firstphase_width, self.firstphase_height))
+
+            samples = samples[:, :, self.truncate_y//2:samples.shape[2]-self.truncate_y//2, self.truncate_x//2:samples.shape[3]-self.truncate_x//2]
 
-        samples = samples[:, :, self.truncate_y//2:samples.shape[2]-self.truncate_y//2, self.truncate_x//2:samples.shape[3]-self.truncate_x//2]
+            if first_pass_key is not None and not state.interrupted and not state.skipped:
+                stored = samples.detach().to(devices.cpu, copy=True)
+                first_pass_cache.put(first_pass_key, stored, cache_utils.tensors_size([stored]))
 
         """saves image before applying hires fix, if enabled in options; takes as an arguyment either an image or batch with latent space images"""
         def save_intermediate(image, index):
@@ -726,13 +1014,10 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             else:
                 image_conditioning = self.txt2img_image_conditioning(samples)
         else:
-            decoded_samples = decode_first_stage(self.sd_model, samples)
-            lowres_samples = torch.clamp((decoded_samples + 1.0) / 2.0, min=0.0, max=1.0)
+            lowres_samples = decode_first_stage_batch(self.sd_model, samples)
 
             batch_images = []
-            for i, x_sample in enumerate(lowres_samples):
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
+            for i, x_sample in enumerate(images_to_uint8(lowres_samples)):
                 image = Image.fromarray(x_sample)
 
                 save_intermediate(image, i)
@@ -746,7 +1031,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             decoded_samples = decoded_samples.to(shared.device)
             decoded_samples = 2. * decoded_samples - 1.
 
-            samples = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(decoded_samples))
+            samples = self.sd_model.get_first_stage_encoding(encode_first_stage(self.sd_model, decoded_samples))
 
             image_conditioning = self.img2img_image_conditioning(decoded_samples, samples)
 
@@ -856,7 +1141,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
             imgs.append(image)
 
         if len(imgs) == 1:
-            batch_images = np.expand_dims(imgs[0], axis=0).repeat(self.batch_size, axis=0)
+            imgs = imgs * self.batch_size
             if self.overlay_images is not None:
                 self.overlay_images = self.overlay_images * self.batch_size
 
@@ -865,15 +1150,22 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
 
         elif len(imgs) <= self.batch_size:
             self.batch_size = len(imgs)
-            batch_images = np.array(imgs)
         else:
             raise RuntimeError(f"bad number of images passed: {len(imgs)}; expecting {self.batch_size} or less")
 
-        image = torch.from_numpy(batch_images)
+        # each distinct image goes through VAE once, and its latent distribution is repeated for its copies;
+        # latents are still sampled from it for the whole batch, so images with different seeds stay different
+        indexes, positions = unique_images(imgs)
+        image_index = None if len(indexes) == len(imgs) else torch.tensor(positions, device=shared.device)
+
+        image = torch.from_numpy(np.array([imgs[i] for i in indexes]))
         image = 2. * image - 1.
         image = image.to(shared.device)
 
-        self.init_latent = self.sd_model.get_first_stage_encoding(self.sd_model.encode_first_stage(image))
+        encoding = encode_first_stage(self.sd_model, image)
+        if image_index is not None:
+            encoding = repeat_first_stage_encoding(encoding, image_index)
+        self.init_latent = self.sd_model.get_first_stage_encoding(encoding)
 
         if image_mask is not None:
             init_mask = latent_mask
@@ -892,7 +1184,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
             elif self.inpainting_fill == 3:
                 self.init_latent = self.init_latent * self.mask
 
-        self.image_conditioning = self.img2img_image_conditioning(image, self.init_latent, image_mask)
+        self.image_conditioning = self.img2img_image_conditioning(image, self.init_latent, image_mask, image_index)
 
     def sample(self, conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts):
         x = create_random_tensors([opt_C, self.height // opt_f, self.width // opt_f], seeds=seeds, subseeds=subseeds, subseed_strength=self.subseed_strength, seed_resize_from_h=self.seed_resize_from_h, seed_resize_from_w=self.seed_resize_from_w, p=self)
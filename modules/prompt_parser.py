@@ -1,8 +1,12 @@
+import bisect
+import functools
 import re
 from collections import namedtuple
 from typing import List
 import lark
 
+from modules import cache_utils
+
 # a prompt like this: "fantasy landscape with a [mountain:lake:0.25] and [an oak:a christmas tree:0.75][ in foreground::0.6][ in background:0.25] [shoddy:masterful:0.5]"
 # will be represented with prompt_schedule like this (assuming steps=100):
 # [25, 'fantasy landscape with a mountain and an oak in foreground shoddy']
@@ -51,59 +55,137 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
     [[3, '((a][:b:c '], [10, '((a][:b:c d']]
     """
 
-    def collect_steps(steps, tree):
-        l = [steps]
-        class CollectSteps(lark.Visitor):
-            def scheduled(self, tree):
-                tree.children[-1] = float(tree.children[-1])
-                if tree.children[-1] < 1:
-                    tree.children[-1] *= steps
-                tree.children[-1] = min(steps, int(tree.children[-1]))
-                l.append(tree.children[-1])
-            def alternate(self, tree):
-                l.extend(range(1, steps+1))
-        CollectSteps().visit(tree)
-        return sorted(set(l))
-
-    def at_step(step, tree):
-        class AtStep(lark.Transformer):
-            def scheduled(self, args):
-                before, after, _, when = args
-                yield before or () if step <= when else after
-            def alternate(self, args):
-                yield next(args[(step - 1)%len(args)])
-            def start(self, args):
-                def flatten(x):
-                    if type(x) == str:
-                        yield x
-                    else:
-                        for gen in x:
-                            yield from flatten(gen)
-                return ''.join(flatten(args))
-            def plain(self, args):
-                yield args[0].value
-            def __default__(self, data, children, meta):
-                for child in children:
-                    yield from child
-        return AtStep().transform(tree)
-
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError as e:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
-    return [promptdict[prompt] for prompt in prompts]
+    promptdict = {prompt: get_schedule(prompt, steps) for prompt in set(prompts)}
+    return [[[t, text] for t, text in promptdict[prompt]] for prompt in prompts]
+
+
+def scheduled_step(when, steps):
+    when = float(when)
+    if when < 1:
+        when *= steps
+
+    return min(steps, int(when))
+
+
+class CollectSteps(lark.Visitor):
+    def __init__(self, steps):
+        self.steps = steps
+        self.collected = [steps]
+
+    def scheduled(self, tree):
+        self.collected.append(scheduled_step(tree.children[-1], self.steps))
+
+    def alternate(self, tree):
+        self.collected.extend(range(1, self.steps + 1))
+
+
+class AtStep(lark.Transformer):
+    def __init__(self, step, steps):
+        super().__init__()
+        self.step = step
+        self.steps = steps
+
+    def scheduled(self, args):
+        before, after, _, when = args
+        yield before or () if self.step <= scheduled_step(when, self.steps) else after
+
+    def alternate(self, args):
+        yield next(args[(self.step - 1) % len(args)])
+
+    def start(self, args):
+        def flatten(x):
+            if type(x) == str:
+                yield x
+            else:
+                for gen in x:
+                    yield from flatten(gen)
+        return ''.join(flatten(args))
+
+    def plain(self, args):
+        yield args[0].value
+
+    def __default__(self, data, children, meta):
+        for child in children:
+            yield from child
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_schedule(prompt):
+    """returns parsed tree for the prompt, or None if it can't be parsed; trees are shared between callers and must not be modified"""
+
+    try:
+        return schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def get_schedule(prompt, steps):
+    tree = parse_schedule(prompt)
+    if tree is None:
+        return ((steps, prompt), )
+
+    collector = CollectSteps(steps)
+    collector.visit(tree)
+
+    return tuple((t, AtStep(t, steps).transform(tree)) for t in sorted(set(collector.collected)))
 
 
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
 
 
+# text encoder outputs for prompt schedules
+conditioning_cache = cache_utils.LruCache("cond_cache_size")
+
+
+def conditioning_cache_key(model, texts):
+    """returns the key for conditioning_cache: everything besides the text that changes what the text encoder produces, and the texts themselves"""
+
+    from modules import shared, sd_hijack, extra_networks
+
+    checkpoint_info = getattr(model, 'sd_checkpoint_info', None)
+
+    return (
+        getattr(model, 'sd_model_hash', None),
+        getattr(checkpoint_info, 'filename', None),
+        shared.opts.CLIP_stop_at_last_layers,
+        shared.opts.enable_emphasis,
+        shared.opts.use_old_emphasis_implementation,
+        shared.opts.comma_padding_backtrack,
+        sd_hijack.model_hijack.embedding_db.version,
+        extra_networks.active_networks_key,
+        tuple(texts),
+    )
+
+
+def get_cached_learned_conditioning(model, texts):
+    """same as model.get_learned_conditioning(texts), but reuses results of previous calls with same texts and settings;
+    comments about used embeddings made by the text encoder are stored along with the result and restored on cache hit"""
+
+    from modules import shared, sd_hijack, devices
+
+    if not conditioning_cache.enabled() or torch.is_grad_enabled():
+        return model.get_learned_conditioning(texts)
+
+    key = conditioning_cache_key(model, texts)
+
+    cached = conditioning_cache.get(key)
+    if cached is not None:
+        conds, comments = cached
+        sd_hijack.model_hijack.comments.extend(comments)
+        return [x.to(devices.device) for x in conds]
+
+    comments_start = len(sd_hijack.model_hijack.comments)
+    conds = model.get_learned_conditioning(texts)
+    comments = sd_hijack.model_hijack.comments[comments_start:]
+
+    storage_device = devices.cpu if shared.opts.cond_cache_on_cpu else conds.device
+    stored = [x.to(storage_device) for x in conds]
+    conditioning_cache.put(key, (stored, comments), cache_utils.tensors_size(stored))
+
+    return conds
+
+
 def get_learned_conditioning(model, prompts, steps):
     """converts a list of prompts into a list of prompt schedules - each schedule is a list of ScheduledPromptConditioning, specifying the comdition (cond),
     and the sampling step at which this condition is to be replaced by the next one.
@@ -135,7 +217,7 @@ def get_learned_conditioning(model, prompts, steps):
             continue
 
         texts = [x[1] for x in prompt_schedule]
-        conds = model.get_learned_conditioning(texts)
+        conds = get_cached_learned_conditioning(model, texts)
 
         cond_schedule = []
         for i, (end_at_step, text) in enumerate(prompt_schedule):
@@ -256,6 +338,43 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
     return conds_list, torch.stack(tensors).to(device=param.device, dtype=param.dtype)
 
 
+class CondBatchTable:
+    """remembers results of reconstruct_cond_batch or reconstruct_multicond_batch for conditioning c, so that during a sampling run
+    the batch is built once for each segment between schedule boundaries, and every other step is a lookup"""
+
+    def __init__(self, c, reconstruct):
+        self.c = c
+        self.reconstruct = reconstruct
+        self.segments = {}
+
+        if isinstance(c, MulticondLearnedConditioning):
+            schedules = [composable_prompt.schedules for composable_prompts in c.batch for composable_prompt in composable_prompts]
+        else:
+            schedules = c
+
+        self.boundaries = sorted(set(end_at for schedule in schedules for end_at, _ in schedule))
+
+    def get(self, current_step):
+        # all steps after boundary k-1 and up to boundary k select the same conds; steps after the last boundary form their own segment
+        segment = bisect.bisect_left(self.boundaries, current_step)
+
+        res = self.segments.get(segment, None)
+        if res is None:
+            res = self.reconstruct(self.c, current_step)
+            self.segments[segment] = res
+
+        return res
+
+
+def cond_batch_table(table, c, reconstruct):
+    """returns table if it was made for c, or a new table for c otherwise"""
+
+    if table is not None and table.c is c and table.reconstruct is reconstruct:
+        return table
+
+    return CondBatchTable(c, reconstruct)
+
+
 re_attention = re.compile(r"""
 \\\(|
 \\\)|
@@ -0,0 +1,110 @@
+import torch
+
+from modules import devices, rng_philox
+
+
+def generator_device():
+    """device of the generator that devices.randn draws from; on MPS, noise is made on CPU"""
+
+    return devices.cpu if devices.device.type == 'mps' else devices.device
+
+
+def get_global_state():
+    device = generator_device()
+
+    if device.type == 'cuda':
+        return torch.cuda.get_rng_state(device)
+
+    return torch.get_rng_state()
+
+
+def set_global_state(state):
+    device = generator_device()
+
+    if device.type == 'cuda':
+        torch.cuda.set_rng_state(state, device)
+    else:
+        torch.set_rng_state(state)
+
+
+class SamplerNoise:
+    """
+    Noise that ancestral samplers add at each step, for every seed of a batch, made one step at a time when the sampler asks for it.
+
+    Each seed gets its own generator, starting from where the global generator was when noise for that seed used to be drawn from it
+    in advance, so the k-th noise for a seed is the same as the k-th of the count tensors that were drawn for it.
+    """
+
+    def __init__(self, count, shape):
+        self.count = count
+        self.shape = tuple(shape)
+        self.generators = []
+        self.drawn = 0
+        self.finished = False
+
+    def add_seed(self):
+        """adds generator for the next seed of the batch, in the current state of the global generator"""
+
+        generator = torch.Generator(device=generator_device())
+        generator.set_state(get_global_state())
+
+        self.generators.append(generator)
+
+    def randn(self, generator):
+        return torch.randn(self.shape, generator=generator, device=generator.device).to(devices.device)
+
+    def __len__(self):
+        return self.count - self.drawn
+
+    def popleft(self):
+        """returns noise for the next step for all seeds, stacked into a batch"""
+
+        assert self.drawn < self.count, "all sampler noise has been used"
+        self.drawn += 1
+
+        return torch.stack([self.randn(generator) for generator in self.generators])
+
+    def finish(self):
+        """puts the global generator into the state it would be in if all noise was drawn from it in advance, for everything that draws from it later"""
+
+        if self.finished or not self.generators:
+            return
+
+        self.finished = True
+
+        generator = torch.Generator(device=generator_device())
+        generator.set_state(self.generators[-1].get_state())
+
+        for _ in range(self.drawn, self.count):
+            torch.randn(self.shape, generator=generator, device=generator.device)
+
+        set_global_state(generator.get_state())
+
+
+class PhiloxSamplerNoise(SamplerNoise):
+    """SamplerNoise made on CPU by rng_philox for all seeds at once; noise for the k-th step comes from stream k of each seed"""
+
+    def __init__(self, count, shape):
+        super().__init__(count, shape)
+        self.seeds = []
+        self.extra = 0
+
+    def add_seed(self, seed):
+        self.seeds.append(seed)
+
+    def popleft(self):
+        assert self.drawn < self.count, "all sampler noise has been used"
+        self.drawn += 1
+
+        return torch.from_numpy(rng_philox.randn(self.seeds, self.shape, offset=self.drawn)).to(devices.device)
+
+    def randn_like(self, x):
+        """returns noise shaped like x for samplers that need more than count noises or noise of another shape, from streams after count"""
+
+        self.extra += 1
+        seeds = self.seeds if len(self.seeds) == x.shape[0] else [self.seeds[0] + i for i in range(x.shape[0])]
+
+        return torch.from_numpy(rng_philox.randn(seeds, x.shape[1:], offset=self.count + self.extra)).to(x.device)
+
+    def finish(self):
+        pass
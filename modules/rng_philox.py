@@ -0,0 +1,63 @@
+"""
+Counter-based Philox4x32-10 generator of normally distributed noise, computed with numpy on CPU so that the same seed gives the
+same noise on every device. Noise for all seeds of a batch is made in one vectorized call.
+
+Each element of noise is made from its own counter: (index of element, 0, offset, 0), with the seed as the key; offset separates
+independent streams for the same seed, such as noise for each sampling step.
+"""
+
+import numpy as np
+
+philox_m = (0xD2511F53, 0xCD9E8D57)
+philox_w = (0x9E3779B9, 0xBB67AE85)
+
+two_pow32_inv = np.array(1.0 / 2.0 ** 32, dtype=np.float64)
+two_pow32_inv_2pi = np.array(2.0 * np.pi / 2.0 ** 32, dtype=np.float64)
+
+
+def mulhilo(a, b):
+    product = a.astype(np.uint64) * np.uint64(b)
+    return (product >> np.uint64(32)).astype(np.uint32), product.astype(np.uint32)
+
+
+def philox4x32(counter, key, rounds=10):
+    """applies Philox4x32 to counter, an array of four uint32 words along the first axis, with key, an array of two uint32 words; both are broadcast together"""
+
+    counter = [x.astype(np.uint32) for x in counter]
+    key = [x.astype(np.uint32) for x in key]
+
+    for i in range(rounds):
+        if i > 0:
+            key = [key[0] + np.uint32(philox_w[0]), key[1] + np.uint32(philox_w[1])]
+
+        hi0, lo0 = mulhilo(counter[0], philox_m[0])
+        hi1, lo1 = mulhilo(counter[2], philox_m[1])
+        counter = [hi1 ^ counter[1] ^ key[0], lo1, hi0 ^ counter[3] ^ key[1], lo0]
+
+    return np.stack(counter)
+
+
+def box_muller(x, y):
+    """converts two arrays of uniformly distributed uint32 into one array of normally distributed float32"""
+
+    u = x * two_pow32_inv + two_pow32_inv / 2
+    v = y * two_pow32_inv_2pi + two_pow32_inv_2pi / 2
+
+    return (np.sqrt(-2.0 * np.log(u)) * np.sin(v)).astype(np.float32)
+
+
+def randn(seeds, shape, offset=0):
+    """returns an array of shape (len(seeds), *shape) of normally distributed noise, one item for each seed"""
+
+    with np.errstate(over='ignore'):
+        seeds = np.array([seed & 0xffffffffffffffff for seed in seeds], dtype=np.uint64)[:, None]
+        key = np.stack([(seeds & np.uint64(0xffffffff)).astype(np.uint32), (seeds >> np.uint64(32)).astype(np.uint32)])
+
+        n = int(np.prod(shape))
+        index = np.arange(n, dtype=np.uint32)[None, :]
+        zero = np.zeros_like(index)
+        counter = np.stack([index, zero, np.full_like(index, offset), zero])
+
+        g = philox4x32(counter, key)
+
+    return box_muller(g[0], g[1]).reshape((len(seeds), *shape))
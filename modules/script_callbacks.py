@@ -72,7 +72,8 @@ callback_map = dict(
     callbacks_infotext_pasted=[],
     callbacks_script_unloaded=[],
     callbacks_before_ui=[],
-    callbacks_update_cn_models=[]
+    callbacks_update_cn_models=[],
+    callbacks_cache_stats=[],
 )
 
 
@@ -109,6 +110,18 @@ def ui_tabs_callback():
     return res
 
 
+def cache_stats_callback():
+    res = {}
+
+    for c in callback_map['callbacks_cache_stats']:
+        try:
+            res.update(c.callback() or {})
+        except Exception:
+            report_exception(c, 'cache_stats_callback')
+
+    return res
+
+
 def ui_train_tabs_callback(params: UiTrainTabParams):
     for c in callback_map['callbacks_ui_train_tabs']:
         try:
@@ -253,6 +266,14 @@ def on_ui_tabs(callback):
     add_callback(callback_map['callbacks_ui_tabs'], callback)
 
 
+def on_cache_stats(callback):
+    """register a function to be called when statistics of caches are requested through API.
+    The function must return a dict where keys are names of caches and values are dicts with
+    entries, bytes, hits, misses and hit_rate.
+    """
+    add_callback(callback_map['callbacks_cache_stats'], callback)
+
+
 def on_ui_train_tabs(callback):
     """register a function to be called when the UI is creating new tabs for the train tab.
     Create your new tabs with gr.Tab.
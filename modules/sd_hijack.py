@@ -8,7 +8,7 @@ from torch import einsum
 from torch.nn.functional import silu
 
 import modules.textual_inversion.textual_inversion
-from modules import prompt_parser, devices, sd_hijack_optimizations, shared, sd_hijack_checkpoint
+from modules import prompt_parser, devices, sd_hijack_optimizations, shared, sd_hijack_checkpoint, cpu_profile, sd_hijack_tome
 from modules.hypernetworks import hypernetwork
 from modules.shared import opts, device, cmd_opts
 from modules import sd_hijack_clip, sd_hijack_open_clip
@@ -38,15 +38,30 @@ ldm.modules.diffusionmodules.model.print = lambda *args: None
 def apply_optimizations():
     undo_optimizations()
 
+    if cmd_opts.opt_sdp_attention and not sd_hijack_optimizations.scaled_dot_product_attention_available():
+        print("Scaled dot product attention requires PyTorch 2.0 or newer; ignoring --opt-sdp-attention.", file=sys.stderr)
+
     ldm.modules.diffusionmodules.model.nonlinearity = silu
+    ldm.modules.attention.BasicTransformerBlock._forward = sd_hijack_tome.BasicTransformerBlock_forward
 
     if cmd_opts.force_enable_xformers or (cmd_opts.xformers and shared.xformers_available and torch.version.cuda and (6, 0) <= torch.cuda.get_device_capability(shared.device) <= (9, 0)):
         print("Applying xformers cross attention optimization.")
         ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.xformers_attention_forward
         ldm.modules.diffusionmodules.model.AttnBlock.forward = sd_hijack_optimizations.xformers_attnblock_forward
+    elif cmd_opts.opt_sdp_attention and sd_hijack_optimizations.scaled_dot_product_attention_available():
+        print("Applying scaled dot product cross attention optimization.")
+        ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.scaled_dot_product_attention_forward
+        ldm.modules.diffusionmodules.model.AttnBlock.forward = sd_hijack_optimizations.scaled_dot_product_attention_attnblock_forward
+    elif cpu_profile.attention_forward is not None and not (cmd_opts.opt_split_attention_v1 or cmd_opts.opt_split_attention_invokeai or cmd_opts.disable_opt_split_attention):
+        print(f"Applying cross attention optimization ({cpu_profile.attention_name}) selected by CPU profile benchmark.")
+        ldm.modules.attention.CrossAttention.forward = cpu_profile.attention_forward
     elif cmd_opts.opt_split_attention_v1:
         print("Applying v1 cross attention optimization.")
         ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.split_cross_attention_forward_v1
+    elif not (cmd_opts.disable_opt_split_attention or cmd_opts.opt_split_attention or cmd_opts.opt_split_attention_invokeai) and sd_hijack_optimizations.scaled_dot_product_attention_available():
+        print("Applying scaled dot product cross attention optimization, selected automatically for PyTorch 2.0.")
+        ldm.modules.attention.CrossAttention.forward = sd_hijack_optimizations.scaled_dot_product_attention_forward
+        ldm.modules.diffusionmodules.model.AttnBlock.forward = sd_hijack_optimizations.scaled_dot_product_attention_attnblock_forward
     elif not cmd_opts.disable_opt_split_attention and (cmd_opts.opt_split_attention_invokeai or not torch.cuda.is_available()):
         if not invokeAI_mps_available and shared.device.type == 'mps':
             print("The InvokeAI cross attention optimization for MPS requires the psutil package which is not installed.")
@@ -65,6 +80,7 @@ def undo_optimizations():
     ldm.modules.attention.CrossAttention.forward = hypernetwork.attention_CrossAttention_forward
     ldm.modules.diffusionmodules.model.nonlinearity = diffusionmodules_model_nonlinearity
     ldm.modules.diffusionmodules.model.AttnBlock.forward = diffusionmodules_model_AttnBlock_forward
+    ldm.modules.attention.BasicTransformerBlock._forward = sd_hijack_tome.BasicTransformerBlock_forward_original
 
 
 def fix_checkpoint():
@@ -97,6 +113,7 @@ class StableDiffusionModelHijack:
 
         apply_optimizations()
         fix_checkpoint()
+        sd_hijack_tome.add_hook(m.model.diffusion_model)
 
         def flatten(el):
             flattened = [flatten(children) for children in el.children()]
@@ -118,6 +135,8 @@ class StableDiffusionModelHijack:
             m.cond_stage_model.wrapped.model.token_embedding = m.cond_stage_model.wrapped.model.token_embedding.wrapped
             m.cond_stage_model = m.cond_stage_model.wrapped
 
+        sd_hijack_tome.remove_hook(m.model.diffusion_model)
+
         self.apply_circular(False)
         self.layers = None
         self.clip = None
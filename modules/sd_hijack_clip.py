@@ -1,4 +1,6 @@
 import math
+import time
+from collections import OrderedDict
 
 import torch
 
@@ -10,6 +12,54 @@ def get_target_prompt_token_count(token_count):
     return math.ceil(max(token_count, 1) / 75) * 75
 
 
+class TokenizationCache:
+    """process-wide LRU cache of results of tokenize_line; everything is dropped when the embedding database changes"""
+
+    def __init__(self, max_entries=4096):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.embeddings_version = None
+        self.hits = 0
+        self.misses = 0
+        self.tokenize_time = 0.0
+
+    def get(self, key, embeddings_version):
+        if embeddings_version != self.embeddings_version:
+            self.entries.clear()
+            self.embeddings_version = embeddings_version
+
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return entry
+
+    def put(self, key, entry, elapsed):
+        self.tokenize_time += elapsed
+        self.entries[key] = entry
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "throughput": self.misses / self.tokenize_time if self.tokenize_time > 0 else 0.0,
+        }
+
+
+tokenization_cache = TokenizationCache()
+
+
 class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
     def __init__(self, wrapped, hijack):
         super().__init__()
@@ -99,7 +149,17 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
             if line in cache:
                 remade_tokens, fixes, multipliers = cache[line]
             else:
-                remade_tokens, fixes, multipliers, current_token_count = self.tokenize_line(line, used_custom_terms, hijack_comments)
+                key = (type(self), line, opts.enable_emphasis, opts.comma_padding_backtrack)
+                entry = tokenization_cache.get(key, self.hijack.embedding_db.version)
+
+                if entry is None:
+                    t0 = time.perf_counter()
+                    line_custom_terms = []
+                    entry = self.tokenize_line(line, line_custom_terms, hijack_comments) + (line_custom_terms, )
+                    tokenization_cache.put(key, entry, time.perf_counter() - t0)
+
+                remade_tokens, fixes, multipliers, current_token_count, line_custom_terms = entry
+                used_custom_terms += line_custom_terms
                 token_count = max(current_token_count, token_count)
 
                 cache[line] = (remade_tokens, fixes, multipliers)
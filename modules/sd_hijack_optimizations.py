@@ -1,4 +1,5 @@
 import math
+import os
 import sys
 import traceback
 import importlib
@@ -213,6 +214,173 @@ def split_cross_attention_forward_invokeAI(self, x, context=None, mask=None):
 
 # -- End of code from https://github.com/invoke-ai/InvokeAI --
 
+def scaled_dot_product_attention_available():
+    return hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+
+sdp_memory_factors = {}
+sdp_logged_choices = set()
+
+
+def get_available_memory(device):
+    """returns bytes of memory free for tensors on device, or None if it can't be found out"""
+
+    if device.type == 'cuda':
+        stats = torch.cuda.memory_stats(device)
+        mem_active = stats['active_bytes.all.current']
+        mem_reserved = stats['reserved_bytes.all.current']
+        mem_free_cuda, _ = torch.cuda.mem_get_info(device)
+        mem_free_torch = mem_reserved - mem_active
+        return mem_free_cuda + mem_free_torch
+
+    # CPU and MPS allocate from system RAM
+    if invokeAI_mps_available:
+        return psutil.virtual_memory().available
+
+    # no os.sysconf on Windows, and no SC_AVPHYS_PAGES on macOS
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def measure_sdp_memory(q):
+    """returns bytes of memory that scaled_dot_product_attention(q, q, q) takes besides its inputs, or None if it can't be measured on q's device"""
+
+    device = q.device
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        mem_before = torch.cuda.memory_allocated(device)
+
+        torch.nn.functional.scaled_dot_product_attention(q, q, q)
+        torch.cuda.synchronize(device)
+
+        return torch.cuda.max_memory_allocated(device) - mem_before
+
+    if device.type == 'mps':
+        # memory freed by the kernel stays cached by the driver, so growth of the cache is the peak
+        torch.mps.empty_cache()
+        mem_before = torch.mps.driver_allocated_memory()
+
+        torch.nn.functional.scaled_dot_product_attention(q, q, q)
+        torch.mps.synchronize()
+
+        return torch.mps.driver_allocated_memory() - mem_before
+
+    if device.type == 'cpu':
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            torch.nn.functional.scaled_dot_product_attention(q, q, q)
+
+        # an op's own allocations are counted when it starts and its frees when it ends; the peak of the running total is the kernel's peak
+        changes = []
+        for event in prof.events():
+            usage = event.self_cpu_memory_usage
+            if usage != 0:
+                changes.append((event.time_range.start if usage > 0 else event.time_range.end, usage))
+
+        mem_used = mem_peak = 0
+        for _, usage in sorted(changes):
+            mem_used += usage
+            mem_peak = max(mem_peak, mem_used)
+
+        return mem_peak
+
+    return None
+
+
+def sdp_memory_factor(device, dtype):
+    """measures, once per device and dtype, how many bytes of memory scaled_dot_product_attention needs per attention score;
+    memory-efficient kernels need much less than the size of the full attention matrix, the math kernel needs more"""
+
+    key = (device.type, dtype)
+    factor = sdp_memory_factors.get(key, None)
+    if factor is not None:
+        return factor
+
+    # size of the full attention matrix with a copy for softmax, if the kernel's memory can't be measured
+    factor = 2.5
+
+    try:
+        q = torch.randn(8, 1024, 64, device=device, dtype=dtype)
+        mem_used = measure_sdp_memory(q)
+
+        if mem_used is not None:
+            mem_used -= q.numel() * q.element_size()
+            factor = max(mem_used, 0) / (q.shape[0] * q.shape[1] * q.shape[1] * q.element_size())
+
+        del q
+    except Exception:
+        print(f"Error measuring memory of scaled dot product attention on {device.type}:", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+
+    print(f"Scaled dot product attention on {device.type} with {dtype} takes {factor:.2f} times the size of attention scores in memory.")
+
+    sdp_memory_factors[key] = factor
+    return factor
+
+
+def sdp_slice_size(q, k):
+    """returns how many query tokens to process at once so that attention fits into available memory"""
+
+    tokens_q, tokens_k = q.shape[-2], k.shape[-2]
+    batch_heads = q.numel() // (tokens_q * q.shape[-1])
+
+    mem_required = batch_heads * tokens_q * tokens_k * q.element_size() * sdp_memory_factor(q.device, q.dtype)
+    mem_available = get_available_memory(q.device)
+
+    # without knowing free memory, attention is not sliced
+    slice_size = tokens_q
+    if mem_available is not None and mem_required > mem_available / 2:
+        steps = 2 ** math.ceil(math.log(mem_required / (mem_available / 2), 2))
+        slice_size = max(tokens_q // steps, 1)
+
+    choice = (q.device.type, q.dtype, batch_heads, tokens_q, tokens_k, slice_size)
+    if choice not in sdp_logged_choices:
+        sdp_logged_choices.add(choice)
+        slices = math.ceil(tokens_q / slice_size)
+        print(f"Scaled dot product attention for {batch_heads}x{tokens_q}x{tokens_k} tokens: {'unsliced' if slices == 1 else f'{slices} slices of {slice_size} tokens'}")
+
+    return slice_size
+
+
+def sliced_scaled_dot_product_attention(q, k, v, mask=None):
+    slice_size = sdp_slice_size(q, k)
+    if slice_size >= q.shape[-2]:
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+    r = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for i in range(0, q.shape[-2], slice_size):
+        end = i + slice_size
+        r[..., i:end, :] = torch.nn.functional.scaled_dot_product_attention(q[..., i:end, :], k, v, attn_mask=mask)
+
+    return r
+
+
+def scaled_dot_product_attention_forward(self, x, context=None, mask=None):
+    h = self.heads
+
+    q_in = self.to_q(x)
+    context = default(context, x)
+
+    context_k, context_v = hypernetwork.apply_hypernetwork(shared.loaded_hypernetwork, context)
+    k_in = self.to_k(context_k)
+    v_in = self.to_v(context_v)
+    del context, context_k, context_v, x
+
+    q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q_in, k_in, v_in))
+    del q_in, k_in, v_in
+
+    if mask is not None:
+        mask = rearrange(mask, 'b ... -> b () () (...)')
+
+    r = sliced_scaled_dot_product_attention(q, k, v, mask)
+    del q, k, v
+
+    return self.to_out(rearrange(r, 'b h n d -> b n (h d)', h=h))
+
+
 def xformers_attention_forward(self, x, context=None, mask=None):
     h = self.heads
     q_in = self.to_q(x)
@@ -292,6 +460,19 @@ def cross_attention_attnblock_forward(self, x):
 
         return h3
     
+def scaled_dot_product_attention_attnblock_forward(self, x):
+    h_ = self.norm(x)
+    q = self.q(h_)
+    k = self.k(h_)
+    v = self.v(h_)
+    b, c, h, w = q.shape
+    q, k, v = map(lambda t: rearrange(t, 'b c h w -> b () (h w) c').contiguous(), (q, k, v))
+    out = sliced_scaled_dot_product_attention(q, k, v)
+    out = rearrange(out, 'b () (h w) c -> b c h w', h=h)
+    out = self.proj_out(out)
+    return x + out
+
+
 def xformers_attnblock_forward(self, x):
     try:
         h_ = x
@@ -0,0 +1,189 @@
+import math
+import re
+
+import torch
+
+import ldm.modules.attention
+
+from modules import shared
+
+re_number = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)")
+
+BasicTransformerBlock_forward_original = ldm.modules.attention.BasicTransformerBlock._forward
+
+# latent height and width of the current UNet call, set by a forward pre-hook on the UNet
+latent_size = None
+
+# matching uses its own generator, reseeded on every UNet call, so that it neither changes global RNG state nor depends on it
+generator = None
+
+
+def parse_schedule(text):
+    """parses a list of ratio multipliers for UNet levels at 1x, 2x, 4x and 8x downsampling; separators and quotes around the list are ignored"""
+
+    return [max(0.0, float(x)) for x in re_number.findall(text)]
+
+
+def ratio_for_level(level):
+    ratio = shared.opts.token_merging_ratio
+    if ratio <= 0:
+        return 0
+
+    multipliers = parse_schedule(shared.opts.token_merging_schedule)
+    multiplier = multipliers[level] if level < len(multipliers) else 0
+
+    return min(ratio * multiplier, 0.95)
+
+
+def unet_forward_pre_hook(module, args):
+    global latent_size, generator
+
+    x = args[0]
+    latent_size = (x.shape[-2], x.shape[-1])
+
+    if shared.opts.token_merging_ratio <= 0:
+        return
+
+    device = torch.device("cpu") if x.device.type == "mps" else x.device
+    if generator is None or generator.device != device:
+        generator = torch.Generator(device=device)
+
+    generator.manual_seed(0)
+
+
+def add_hook(unet):
+    remove_hook(unet)
+    unet.tome_hook = unet.register_forward_pre_hook(unet_forward_pre_hook)
+
+
+def remove_hook(unet):
+    hook = getattr(unet, 'tome_hook', None)
+    if hook is not None:
+        hook.remove()
+        del unet.tome_hook
+
+
+def do_nothing(x):
+    return x
+
+
+def bipartite_soft_matching_random2d(metric, w, h, sx, sy, r):
+    """
+    Partitions the tokens into src and dst and merges r tokens from src to dst; dst tokens are picked randomly, one in each sx by sy region.
+    Returns a pair of functions: merge, which reduces the number of tokens in a tensor by r, and unmerge, which restores it.
+    Based on "Token Merging for Fast Stable Diffusion" by Daniel Bolya and Judy Hoffman.
+    """
+
+    B, N, _ = metric.shape
+
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        hsy, wsx = h // sy, w // sx
+
+        rand_idx = torch.randint(sy * sx, size=(hsy, wsx, 1), device=generator.device, generator=generator).to(metric.device)
+
+        # -1 marks dst tokens, 0 marks src tokens
+        idx_buffer_view = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+        idx_buffer_view.scatter_(dim=2, index=rand_idx, src=-torch.ones_like(rand_idx, dtype=rand_idx.dtype))
+        idx_buffer_view = idx_buffer_view.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+
+        # tokens that do not fit into whole regions at the edges are always src
+        if (hsy * sy) < h or (wsx * sx) < w:
+            idx_buffer = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+            idx_buffer[:(hsy * sy), :(wsx * sx)] = idx_buffer_view
+        else:
+            idx_buffer = idx_buffer_view
+
+        rand_idx = idx_buffer.reshape(1, -1, 1).argsort(dim=1)
+        del idx_buffer, idx_buffer_view
+
+        num_dst = hsy * wsx
+        a_idx = rand_idx[:, num_dst:, :]
+        b_idx = rand_idx[:, :num_dst, :]
+
+        def split(x):
+            C = x.shape[-1]
+            src = torch.gather(x, dim=1, index=a_idx.expand(B, N - num_dst, C))
+            dst = torch.gather(x, dim=1, index=b_idx.expand(B, num_dst, C))
+            return src, dst
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        scores = a @ b.transpose(-1, -2)
+
+        r = min(a.shape[1], r)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+
+        unm_idx = edge_idx[..., r:, :]
+        src_idx = edge_idx[..., :r, :]
+        dst_idx = torch.gather(node_idx[..., None], dim=-2, index=src_idx)
+
+    def merge(x, mode="mean"):
+        src, dst = split(x)
+        n, t1, c = src.shape
+
+        unm = torch.gather(src, dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = torch.gather(src, dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce=mode)
+
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        _, _, c = unm.shape
+
+        src = torch.gather(dst, dim=-2, index=dst_idx.expand(B, r, c))
+
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out.scatter_(dim=-2, index=b_idx.expand(B, num_dst, c), src=dst)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=unm_idx).expand(B, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=torch.gather(a_idx.expand(B, a_idx.shape[1], 1), dim=1, index=src_idx).expand(B, r, c), src=src)
+
+        return out
+
+    return merge, unmerge
+
+
+def compute_merge(x):
+    """returns merge and unmerge functions for the tokens of a transformer block according to the ratio and schedule in settings"""
+
+    if latent_size is None or generator is None:
+        return do_nothing, do_nothing
+
+    original_h, original_w = latent_size
+    original_tokens = original_h * original_w
+    downsample = int(math.ceil(math.sqrt(original_tokens // x.shape[1])))
+    level = int(math.log2(downsample)) if downsample > 0 else 0
+
+    ratio = ratio_for_level(level)
+    if ratio <= 0:
+        return do_nothing, do_nothing
+
+    w = int(math.ceil(original_w / downsample))
+    h = int(math.ceil(original_h / downsample))
+    if w * h != x.shape[1]:
+        return do_nothing, do_nothing
+
+    r = int(x.shape[1] * ratio)
+
+    return bipartite_soft_matching_random2d(x, w, h, 2, 2, r)
+
+
+def BasicTransformerBlock_forward(self, x, context=None):
+    """BasicTransformerBlock's _forward with tokens merged for self-attention when token merging is enabled in settings"""
+
+    if shared.opts.token_merging_ratio <= 0:
+        return BasicTransformerBlock_forward_original(self, x, context)
+
+    merge, unmerge = compute_merge(x)
+
+    x = unmerge(self.attn1(merge(self.norm1(x)), context=context if getattr(self, 'disable_self_attn', False) else None)) + x
+    x = self.attn2(self.norm2(x), context=context) + x
+    x = self.ff(self.norm3(x)) + x
+
+    return x
@@ -1,16 +1,22 @@
 import collections
+import concurrent.futures
+import copy
+import functools
 import os.path
 import sys
 import gc
+import threading
+import time
 from collections import namedtuple
 import torch
 import re
 import safetensors.torch
 from omegaconf import OmegaConf
 
+import ldm.util
 from ldm.util import instantiate_from_config
 
-from modules import shared, modelloader, devices, script_callbacks, sd_vae
+from modules import shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, hashes, cpu_profile
 from modules.paths import models_path
 from modules.sd_hijack_inpainting import do_inpainting_hijack, should_hijack_inpainting
 import requests
@@ -22,7 +28,15 @@ model_path = os.path.abspath(os.path.join(models_path, model_dir))
 
 CheckpointInfo = namedtuple("CheckpointInfo", ['filename', 'title', 'hash', 'model_name', 'config'])
 checkpoints_list = {}
+checkpoint_aliases = {}
 checkpoints_loaded = collections.OrderedDict()
+sd_configs_loaded = {}
+
+checkpoint_hash_pending = "pending"
+checkpoint_hash_futures = {}
+checkpoint_hash_executor = None
+checkpoint_tiles_cached = None
+checkpoints_lock = threading.RLock()
 
 if shared.cmd_opts.pureui:
     api_endpoint = os.environ['api_endpoint'] if 'api_endpoint' in os.environ else ''
@@ -44,6 +58,26 @@ except Exception:
     pass
 
 
+get_obj_from_str_uncached = ldm.util.get_obj_from_str
+
+
+@functools.lru_cache(maxsize=None)
+def get_obj_from_str_cached(string):
+    return get_obj_from_str_uncached(string)
+
+
+def get_obj_from_str(string, reload=False):
+    """memoized replacement for ldm.util.get_obj_from_str so that instantiate_from_config does not import and look up model classes again on every load"""
+
+    if reload:
+        return get_obj_from_str_uncached(string, reload=True)
+
+    return get_obj_from_str_cached(string)
+
+
+ldm.util.get_obj_from_str = get_obj_from_str
+
+
 def setup_model():
     if not os.path.exists(model_path):
         os.makedirs(model_path)
@@ -51,34 +85,74 @@ def setup_model():
     list_models()
 
 
-def checkpoint_tiles(): 
-    convert = lambda name: int(name) if name.isdigit() else name.lower() 
-    alphanumeric_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)] 
-    return sorted([x.title for x in checkpoints_list.values()], key = alphanumeric_key)
+def natural_sort_key(s, regex=re.compile('([0-9]+)')):
+    return [int(text) if text.isdigit() else text.lower() for text in regex.split(s)]
 
 
-def list_models(sagemaker_endpoint=None,username=''):
-    global checkpoints_list
+def checkpoint_tiles():
+    global checkpoint_tiles_cached
+
+    with checkpoints_lock:
+        if checkpoint_tiles_cached is None:
+            checkpoint_tiles_cached = sorted([x.title for x in checkpoints_list.values()], key=natural_sort_key)
+
+        return list(checkpoint_tiles_cached)
+
+
+def invalidate_checkpoint_tiles():
+    global checkpoint_tiles_cached
+
+    with checkpoints_lock:
+        checkpoint_tiles_cached = None
+
 
-    checkpoints_list.clear()
+def modelname(path):
+    abspath = os.path.abspath(path)
 
-    def modeltitle(path, shorthash):
-        abspath = os.path.abspath(path)
+    if shared.cmd_opts.ckpt_dir is not None and abspath.startswith(shared.cmd_opts.ckpt_dir):
+        name = abspath.replace(shared.cmd_opts.ckpt_dir, '')
+    elif abspath.startswith(model_path):
+        name = abspath.replace(model_path, '')
+    else:
+        name = os.path.basename(path)
+
+    if name.startswith("\\") or name.startswith("/"):
+        name = name[1:]
+
+    return name
+
+
+def modeltitle(path, shorthash):
+    name = modelname(path)
+    shortname = os.path.splitext(name.replace("/", "_").replace("\\", "_"))[0]
 
-        if shared.cmd_opts.ckpt_dir is not None and abspath.startswith(shared.cmd_opts.ckpt_dir):
-            name = abspath.replace(shared.cmd_opts.ckpt_dir, '')
-        elif abspath.startswith(model_path):
-            name = abspath.replace(model_path, '')
-        else:
-            name = os.path.basename(path)
+    return f'{name} [{shorthash}]', shortname
 
-        if name.startswith("\\") or name.startswith("/"):
-            name = name[1:]
 
-        shortname = os.path.splitext(name.replace("/", "_").replace("\\", "_"))[0]
+def register_checkpoint(checkpoint_info, replaced_title=None):
+    with checkpoints_lock:
+        if replaced_title is not None:
+            checkpoints_list.pop(replaced_title, None)
+
+        checkpoints_list[checkpoint_info.title] = checkpoint_info
+        checkpoint_aliases[modelname(checkpoint_info.filename)] = checkpoint_info
+
+
+def list_models(sagemaker_endpoint=None,username=''):
+    global checkpoints_list
 
-        return f'{name} [{shorthash}]', shortname
+    with checkpoints_lock:
+        previous_titles = set(checkpoints_list)
+        checkpoints_list.clear()
+        checkpoint_aliases.clear()
 
+        list_models_unlocked(sagemaker_endpoint, username)
+
+        if set(checkpoints_list) != previous_titles:
+            invalidate_checkpoint_tiles()
+
+
+def list_models_unlocked(sagemaker_endpoint=None, username=''):
     if shared.cmd_opts.pureui:
         if sagemaker_endpoint:
             params = {
@@ -131,13 +205,13 @@ def list_models(sagemaker_endpoint=None,username=''):
         if os.path.exists(cmd_ckpt):
             h = model_hash(cmd_ckpt)
             title, short_model_name = modeltitle(cmd_ckpt, h)
-            checkpoints_list[title] = CheckpointInfo(cmd_ckpt, title, h, short_model_name, shared.cmd_opts.config)
+            register_checkpoint(CheckpointInfo(cmd_ckpt, title, h, short_model_name, shared.cmd_opts.config))
             shared.opts.data['sd_model_checkpoint'] = title
         elif cmd_ckpt is not None and cmd_ckpt != shared.default_sd_model_file:
             print(f"Checkpoint in --ckpt argument not found (Possible it was moved to {model_path}: {cmd_ckpt}", file=sys.stderr)
 
         for filename in model_list:
-            h = model_hash(filename)
+            h = checkpoint_hash(filename)
             title, short_model_name = modeltitle(filename, h)
 
             basename, _ = os.path.splitext(filename)
@@ -145,7 +219,7 @@ def list_models(sagemaker_endpoint=None,username=''):
             if not os.path.exists(config):
                 config = shared.cmd_opts.config
 
-            checkpoints_list[title] = CheckpointInfo(filename, title, h, short_model_name, config)
+            register_checkpoint(CheckpointInfo(filename, title, h, short_model_name, config))
 
 def get_closet_checkpoint_match(searchString):
     applicable = sorted([info for info in checkpoints_list.values() if searchString in info.title], key = lambda x:len(x.title))
@@ -170,11 +244,83 @@ def model_hash(filename):
         return 'NOFILE'
 
 
+def checkpoint_hash(filename):
+    """returns model_hash of the file from the on-disk hash cache if the file has not been modified since it was hashed;
+    otherwise schedules the hash to be calculated in background and returns checkpoint_hash_pending"""
+
+    global checkpoint_hash_executor
+
+    mtime = os.path.getmtime(filename)
+
+    with checkpoints_lock:
+        cached = hashes.cache("model_hash").get(filename, None)
+        if cached is not None and cached.get("mtime", None) == mtime:
+            return cached["hash"]
+
+        if filename not in checkpoint_hash_futures:
+            if checkpoint_hash_executor is None:
+                checkpoint_hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="checkpoint_hash")
+
+            checkpoint_hash_futures[filename] = checkpoint_hash_executor.submit(calculate_checkpoint_hash, filename, mtime)
+
+    return checkpoint_hash_pending
+
+
+def calculate_checkpoint_hash(filename, mtime):
+    h = model_hash(filename)
+
+    with checkpoints_lock:
+        hashes.cache("model_hash")[filename] = {"mtime": mtime, "hash": h}
+        checkpoint_hash_futures.pop(filename, None)
+
+        pending = [info for info in checkpoints_list.values() if info.filename == filename and info.hash == checkpoint_hash_pending]
+        for info in pending:
+            title, _ = modeltitle(filename, h)
+            register_checkpoint(info._replace(title=title, hash=h), replaced_title=info.title)
+
+            if shared.opts.data.get('sd_model_checkpoint', None) == info.title:
+                shared.opts.data['sd_model_checkpoint'] = title
+
+        if pending:
+            invalidate_checkpoint_tiles()
+
+        if len(checkpoint_hash_futures) == 0:
+            hashes.dump_cache()
+
+    return h
+
+
+def wait_for_checkpoint_hash(checkpoint_info):
+    """returns checkpoint_info with its hash filled in, calculating it now if it's still pending"""
+
+    if checkpoint_info.hash != checkpoint_hash_pending:
+        return checkpoint_info
+
+    with checkpoints_lock:
+        future = checkpoint_hash_futures.get(checkpoint_info.filename, None)
+
+    h = future.result() if future is not None else calculate_checkpoint_hash(checkpoint_info.filename, os.path.getmtime(checkpoint_info.filename))
+    title, _ = modeltitle(checkpoint_info.filename, h)
+
+    return checkpoint_info._replace(title=title, hash=h)
+
+
+def get_checkpoint_info(title):
+    """finds checkpoint by its title; if that fails, by its name without the hash, so that titles remembered while the hash was pending still work"""
+
+    with checkpoints_lock:
+        checkpoint_info = checkpoints_list.get(title, None)
+        if checkpoint_info is None and title is not None:
+            checkpoint_info = checkpoint_aliases.get(title, None) or checkpoint_aliases.get(get_sd_model_checkpoint_from_title(title), None)
+
+    return checkpoint_info
+
+
 def select_checkpoint():
     ##add log by Rive
     print('checkpoints_list:',checkpoints_list)
     model_checkpoint = shared.opts.sd_model_checkpoint
-    checkpoint_info = checkpoints_list.get(model_checkpoint, None)
+    checkpoint_info = get_checkpoint_info(model_checkpoint)
     if checkpoint_info is not None:
         return checkpoint_info
 
@@ -264,6 +410,7 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
 
 
 def load_model_weights(model, checkpoint_info, vae_file="auto"):
+    checkpoint_info = wait_for_checkpoint_hash(checkpoint_info)
     checkpoint_file = checkpoint_info.filename
     sd_model_hash = checkpoint_info.hash
 
@@ -272,15 +419,19 @@ def load_model_weights(model, checkpoint_info, vae_file="auto"):
     if cache_enabled and checkpoint_info in checkpoints_loaded:
         # use checkpoint cache
         print(f"Loading weights [{sd_model_hash}] from cache")
-        model.load_state_dict(checkpoints_loaded[checkpoint_info])
+        sd = checkpoints_loaded[checkpoint_info].copy()
+        with sd_disable_initialization.LoadStateDictOnMeta(sd):
+            model.load_state_dict(sd)
+        del sd
     else:
         # load from file
         print(f"Loading weights [{sd_model_hash}] from {checkpoint_file}")
 
         sd = read_state_dict(checkpoint_file)
-        model.load_state_dict(sd, strict=False)
+        with sd_disable_initialization.LoadStateDictOnMeta(sd):
+            model.load_state_dict(sd, strict=False)
         del sd
-        
+
         if cache_enabled:
             # cache newly loaded model
             checkpoints_loaded[checkpoint_info] = model.state_dict().copy()
@@ -316,6 +467,18 @@ def load_model_weights(model, checkpoint_info, vae_file="auto"):
     sd_vae.load_vae(model, vae_file)
 
 
+def load_config(config_path):
+    """returns a copy of the OmegaConf config at config_path; parsed configs are cached until the file's mtime changes"""
+
+    mtime = os.path.getmtime(config_path)
+    cached = sd_configs_loaded.get(config_path, None)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, OmegaConf.load(config_path))
+        sd_configs_loaded[config_path] = cached
+
+    return copy.deepcopy(cached[1])
+
+
 def load_model(checkpoint_info=None):
     from modules import lowvram, sd_hijack
     checkpoint_info = checkpoint_info or select_checkpoint()
@@ -329,8 +492,10 @@ def load_model(checkpoint_info=None):
         gc.collect()
         devices.torch_gc()
 
-    sd_config = OmegaConf.load(checkpoint_info.config)
-    
+    t0 = time.time()
+
+    sd_config = load_config(checkpoint_info.config)
+
     if should_hijack_inpainting(checkpoint_info):
         # Hardcoded config for now...
         sd_config.model.target = "ldm.models.diffusion.ddpm.LatentInpaintDiffusion"
@@ -346,9 +511,23 @@ def load_model(checkpoint_info=None):
     if shared.cmd_opts.no_half:
         sd_config.model.params.unet_config.params.use_fp16 = False
 
-    sd_model = instantiate_from_config(sd_config.model)
+    sd_model = None
+    try:
+        with sd_disable_initialization.DisableInitialization(), sd_disable_initialization.InitializeOnMeta():
+            sd_model = instantiate_from_config(sd_config.model)
+    except Exception:
+        pass
+
+    if sd_model is None:
+        print('Failed to create model quickly; will retry using slow method.', file=sys.stderr)
+        sd_model = instantiate_from_config(sd_config.model)
+
+    t1 = time.time()
+
     load_model_weights(sd_model, checkpoint_info)
 
+    t2 = time.time()
+
     if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
         lowvram.setup_for_low_vram(sd_model, shared.cmd_opts.medvram)
     else:
@@ -359,11 +538,13 @@ def load_model(checkpoint_info=None):
     sd_model.eval()
     shared.sd_model = sd_model
 
+    cpu_profile.apply(sd_model)
+
     sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)  # Reload embeddings after model load as they may or may not fit the model
 
     script_callbacks.model_loaded_callback(sd_model)
 
-    print(f"Model loaded.")
+    print(f"Model loaded in {time.time() - t0:.1f}s (create model: {t1 - t0:.1f}s, load weights: {t2 - t1:.1f}s).")
     return sd_model
 
 
@@ -393,6 +574,7 @@ def reload_model_weights(sd_model=None, info=None):
         sd_model.to(devices.cpu)
 
     sd_hijack.model_hijack.undo_hijack(sd_model)
+    cpu_profile.undo(sd_model)
 
     load_model_weights(sd_model, checkpoint_info)
 
@@ -402,5 +584,7 @@ def reload_model_weights(sd_model=None, info=None):
     if not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram:
         sd_model.to(devices.device)
 
+    cpu_profile.apply(sd_model)
+
     print(f"Weights loaded.")
     return sd_model
@@ -9,7 +9,7 @@ import k_diffusion.sampling
 import torchsde._brownian.brownian_interval
 import ldm.models.diffusion.ddim
 import ldm.models.diffusion.plms
-from modules import prompt_parser, devices, processing, images
+from modules import prompt_parser, devices, processing, images, rng, script_callbacks
 
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
@@ -106,6 +106,15 @@ def setup_img2img_steps(p, steps=None):
     return steps, t_enc
 
 
+def guidance_cutoff_sigma(guidance_cutoff, sigmas):
+    """returns sigma at and below which only conditional prompts are denoised, guidance_cutoff being a fraction of sigmas; None if there is no cutoff"""
+
+    if not 0 < guidance_cutoff < 1:
+        return None
+
+    return sigmas[round(guidance_cutoff * (len(sigmas) - 1))].item()
+
+
 def single_sample_to_image(sample):
     x_sample = processing.decode_first_stage(shared.sd_model, sample.unsqueeze(0))[0]
     x_sample = torch.clamp((x_sample + 1.0) / 2.0, min=0.0, max=1.0)
@@ -147,6 +156,8 @@ class VanillaStableDiffusionSampler:
         self.stop_at = None
         self.eta = None
         self.default_eta = 0.0
+        self.cond_table = None
+        self.uncond_table = None
         self.config = None
         self.last_latent = None
 
@@ -178,8 +189,10 @@ class VanillaStableDiffusionSampler:
             cond = cond["c_crossattn"][0]
             unconditional_conditioning = unconditional_conditioning["c_crossattn"][0]
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        unconditional_conditioning = prompt_parser.reconstruct_cond_batch(unconditional_conditioning, self.step)
+        self.cond_table = prompt_parser.cond_batch_table(self.cond_table, cond, prompt_parser.reconstruct_multicond_batch)
+        self.uncond_table = prompt_parser.cond_batch_table(self.uncond_table, unconditional_conditioning, prompt_parser.reconstruct_cond_batch)
+        conds_list, tensor = self.cond_table.get(self.step)
+        unconditional_conditioning = self.uncond_table.get(self.step)
 
         assert all([len(conds) == 1 for conds in conds_list]), 'composition via AND is not supported for DDIM/PLMS samplers'
         cond = tensor
@@ -287,20 +300,41 @@ class CFGDenoiser(torch.nn.Module):
         self.nmask = None
         self.init_latent = None
         self.step = 0
+        self.cond_table = None
+        self.uncond_table = None
+        self.guidance_cutoff_sigma = None
+
+    def can_skip_uncond(self, conds_list, sigma, cond_scale):
+        """tells whether denoising with conditional prompts alone is enough for this step: either it gives the same result because cfg scale is 1, or guidance is cut off at this sigma;
+        never when cfg_denoiser callbacks are registered, since they expect the uncond half of the batch"""
+
+        if script_callbacks.callback_map['callbacks_cfg_denoiser']:
+            return False
+
+        totals = [sum(weight for _, weight in conds) for conds in conds_list]
+
+        if cond_scale == 1 and all(abs(total - 1) < 1e-6 for total in totals):
+            return True
+
+        return self.guidance_cutoff_sigma is not None and all(total > 0 for total in totals) and sigma.max().item() <= self.guidance_cutoff_sigma
 
     def forward(self, x, sigma, uncond, cond, cond_scale, image_cond):
         if state.interrupted or state.skipped:
             raise InterruptedException
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        self.cond_table = prompt_parser.cond_batch_table(self.cond_table, cond, prompt_parser.reconstruct_multicond_batch)
+        self.uncond_table = prompt_parser.cond_batch_table(self.uncond_table, uncond, prompt_parser.reconstruct_cond_batch)
+        conds_list, tensor = self.cond_table.get(self.step)
+        uncond = self.uncond_table.get(self.step)
 
         batch_size = len(conds_list)
         repeats = [len(conds_list[i]) for i in range(batch_size)]
 
-        x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
-        image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_cond])
-        sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
+        skip_uncond = self.can_skip_uncond(conds_list, sigma, cond_scale)
+
+        x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + ([] if skip_uncond else [x]))
+        image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + ([] if skip_uncond else [image_cond]))
+        sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + ([] if skip_uncond else [sigma]))
 
         denoiser_params = CFGDenoiserParams(x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps)
         cfg_denoiser_callback(denoiser_params)
@@ -308,7 +342,14 @@ class CFGDenoiser(torch.nn.Module):
         image_cond_in = denoiser_params.image_cond
         sigma_in = denoiser_params.sigma
 
-        if tensor.shape[1] == uncond.shape[1]:
+        if skip_uncond:
+            x_out = torch.zeros_like(x_in)
+            batch_size = batch_size*2 if shared.batch_cond_uncond else batch_size
+            for batch_offset in range(0, tensor.shape[0], batch_size):
+                a = batch_offset
+                b = min(a + batch_size, tensor.shape[0])
+                x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond={"c_crossattn": [tensor[a:b]], "c_concat": [image_cond_in[a:b]]})
+        elif tensor.shape[1] == uncond.shape[1]:
             cond_in = torch.cat([tensor, uncond])
 
             if shared.batch_cond_uncond:
@@ -329,12 +370,20 @@ class CFGDenoiser(torch.nn.Module):
 
             x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond={"c_crossattn": [uncond], "c_concat": [image_cond_in[-uncond.shape[0]:]]})
 
-        denoised_uncond = x_out[-uncond.shape[0]:]
-        denoised = torch.clone(denoised_uncond)
+        if skip_uncond:
+            denoised = torch.zeros_like(x_out[:len(conds_list)])
+
+            for i, conds in enumerate(conds_list):
+                total = sum(weight for _, weight in conds)
+                for cond_index, weight in conds:
+                    denoised[i] += x_out[cond_index] * (weight / total)
+        else:
+            denoised_uncond = x_out[-uncond.shape[0]:]
+            denoised = torch.clone(denoised_uncond)
 
-        for i, conds in enumerate(conds_list):
-            for cond_index, weight in conds:
-                denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale)
+            for i, conds in enumerate(conds_list):
+                for cond_index, weight in conds:
+                    denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale)
 
         if self.mask is not None:
             denoised = self.init_latent * self.mask + self.nmask * denoised
@@ -347,8 +396,8 @@ class CFGDenoiser(torch.nn.Module):
 class TorchHijack:
     def __init__(self, sampler_noises):
         # Using a deque to efficiently receive the sampler_noises in the same order as the previous index-based
-        # implementation.
-        self.sampler_noises = deque(sampler_noises)
+        # implementation; rng.SamplerNoise makes them one at a time in the same order.
+        self.sampler_noises = sampler_noises if isinstance(sampler_noises, rng.SamplerNoise) else deque(sampler_noises)
 
     def __getattr__(self, item):
         if item == 'randn_like':
@@ -365,6 +414,12 @@ class TorchHijack:
             if noise.shape == x.shape:
                 return noise
 
+        if isinstance(self.sampler_noises, rng.PhiloxSamplerNoise):
+            return self.sampler_noises.randn_like(x)
+
+        if isinstance(self.sampler_noises, rng.SamplerNoise):
+            self.sampler_noises.finish()
+
         if x.device.type == 'mps':
             return torch.randn_like(x, device=devices.cpu).to(x.device)
         else:
@@ -471,6 +526,7 @@ class KDiffusionSampler:
             extra_params_kwargs['sigmas'] = sigma_sched
 
         self.model_wrap_cfg.init_latent = x
+        self.model_wrap_cfg.guidance_cutoff_sigma = guidance_cutoff_sigma(p.guidance_cutoff, sigma_sched)
         self.last_latent = x
 
         samples = self.launch_sampling(t_enc + 1, lambda: self.func(self.model_wrap_cfg, xi, extra_args={
@@ -503,6 +559,7 @@ class KDiffusionSampler:
         else:
             extra_params_kwargs['sigmas'] = sigmas
 
+        self.model_wrap_cfg.guidance_cutoff_sigma = guidance_cutoff_sigma(p.guidance_cutoff, sigmas)
         self.last_latent = x
         samples = self.launch_sampling(steps, lambda: self.func(self.model_wrap_cfg, x, extra_args={
             'cond': conditioning, 
@@ -1,12 +1,9 @@
 import torch
+import safetensors.torch
 import os
 from collections import namedtuple
-from modules import shared, devices, script_callbacks
+from modules import shared, devices, network_catalog, cache_utils
 from modules.paths import models_path
-import glob
-
-import requests
-import json
 
 model_dir = "Stable-diffusion"
 model_path = os.path.abspath(os.path.join(models_path, model_dir))
@@ -32,6 +29,10 @@ loaded_vae_file = None
 checkpoint_info = None
 
 
+# VAE state dicts read from files, with unused keys removed and converted to VAE dtype, as (mtime, state dict)
+vae_cache = cache_utils.LruCache("sd_vae_cache_size")
+
+
 def get_base_vae(model):
     if base_vae is not None and checkpoint_info == model.sd_checkpoint_info and model:
         return base_vae
@@ -41,7 +42,8 @@ def get_base_vae(model):
 def store_base_vae(model):
     global base_vae, checkpoint_info
     if checkpoint_info != model.sd_checkpoint_info:
-        base_vae = model.first_stage_model.state_dict().copy()
+        # state_dict() shares storage with parameters, which are overwritten by the VAE being loaded
+        base_vae = {k: v.to(devices.cpu, copy=True) for k, v in model.first_stage_model.state_dict().items()}
         checkpoint_info = model.sd_checkpoint_info
 
 
@@ -52,10 +54,12 @@ def delete_base_vae():
 
 
 def restore_base_vae(model):
-    global base_vae, checkpoint_info
+    """loads VAE weights of model's checkpoint back; the copy is kept so that switching between VAEs does not copy them again"""
+
     if base_vae is not None and checkpoint_info == model.sd_checkpoint_info:
-        load_vae_dict(model, base_vae)
-    delete_base_vae()
+        model.first_stage_model.load_state_dict(base_vae)
+    else:
+        delete_base_vae()
 
 
 def get_filename(filepath):
@@ -73,17 +77,13 @@ def refresh_vae_list(vae_path=vae_path, model_path=model_path, sagemaker_endpoin
                 'module': 'VAE',
                 'endpoint_name': sagemaker_endpoint
             }
-            response = requests.get(url=f'{api_endpoint}/sd/models', params=params)
-            if response.status_code == 200:
-                model_list = json.loads(response.text)
-                for model in model_list:
-                    candidates.append(model['path'])
+            model_list = network_catalog.catalog.list_remote(f'{api_endpoint}/sd/models', params)
+            for model in model_list or []:
+                candidates.append(model['path'])
     else:
         candidates = [
-            *glob.iglob(os.path.join(model_path, '**/*.vae.ckpt'), recursive=True),
-            *glob.iglob(os.path.join(model_path, '**/*.vae.pt'), recursive=True),
-            *glob.iglob(os.path.join(vae_path, '**/*.ckpt'), recursive=True),
-            *glob.iglob(os.path.join(vae_path, '**/*.pt'), recursive=True)
+            *network_catalog.catalog.list_files(model_path, ['.vae.ckpt', '.vae.pt', '.vae.safetensors']),
+            *network_catalog.catalog.list_files(vae_path, ['.ckpt', '.pt', '.safetensors'])
         ]
         if shared.cmd_opts.vae_path is not None and os.path.isfile(shared.cmd_opts.vae_path):
             candidates.append(shared.cmd_opts.vae_path)
@@ -147,6 +147,12 @@ def resolve_vae(checkpoint_file=None, vae_file="auto"):
         if os.path.isfile(vae_file_try):
             vae_file = vae_file_try
             print(f"Using VAE found similar to selected model: {vae_file}")
+    # if still not found, try look for ".vae.safetensors" beside model
+    if vae_file == "auto":
+        vae_file_try = model_path + ".vae.safetensors"
+        if os.path.isfile(vae_file_try):
+            vae_file = vae_file_try
+            print(f"Using VAE found similar to selected model: {vae_file}")
     # No more fallbacks for auto
     if vae_file == "auto":
         vae_file = None
@@ -157,16 +163,41 @@ def resolve_vae(checkpoint_file=None, vae_file="auto"):
     return vae_file
 
 
+def read_vae_dict(vae_file):
+    """returns state dict of VAE in file, without unused keys and converted to VAE dtype; recently used ones are taken from vae_cache"""
+
+    mtime = os.path.getmtime(vae_file)
+    cached = vae_cache.get(vae_file, valid=lambda x: x[0] == mtime)
+    if cached is not None:
+        print(f"Loading VAE weights from cache: {vae_file}")
+        return cached[1]
+
+    print(f"Loading VAE weights from: {vae_file}")
+
+    _, extension = os.path.splitext(vae_file)
+    if extension.lower() == ".safetensors":
+        # memory mapped, so only tensors that are kept are read from disk
+        vae_ckpt = safetensors.torch.load_file(vae_file, device=shared.weight_load_location or "cpu")
+    else:
+        vae_ckpt = torch.load(vae_file, map_location=shared.weight_load_location)
+
+    vae_ckpt = vae_ckpt.get("state_dict", vae_ckpt)
+    vae_dict_1 = {k: v.to(devices.dtype_vae) for k, v in vae_ckpt.items() if k[0:4] != "loss" and k not in vae_ignore_keys}
+    del vae_ckpt
+
+    if vae_cache.enabled():
+        vae_cache.put(vae_file, (mtime, vae_dict_1), cache_utils.tensors_size(vae_dict_1.values()))
+
+    return vae_dict_1
+
+
 def load_vae(model, vae_file=None):
     global first_load, vae_dict, vae_list, loaded_vae_file
     # save_settings = False
 
     if vae_file:
         assert os.path.isfile(vae_file), f"VAE file doesn't exist: {vae_file}"
-        print(f"Loading VAE weights from: {vae_file}")
-        vae_ckpt = torch.load(vae_file, map_location=shared.weight_load_location)
-        vae_dict_1 = {k: v for k, v in vae_ckpt["state_dict"].items() if k[0:4] != "loss" and k not in vae_ignore_keys}
-        load_vae_dict(model, vae_dict_1)
+        load_vae_dict(model, read_vae_dict(vae_file))
 
         # If vae used is not in dict, update it
         # It will be removed on refresh though
@@ -174,6 +205,8 @@ def load_vae(model, vae_file=None):
         if vae_opt not in vae_dict:
             vae_dict[vae_opt] = vae_file
             vae_list.append(vae_opt)
+    elif loaded_vae_file:
+        restore_base_vae(model)
 
     loaded_vae_file = vae_file
 
@@ -195,13 +228,11 @@ def load_vae_dict(model, vae_dict_1=None):
         store_base_vae(model)
         model.first_stage_model.load_state_dict(vae_dict_1)
     else:
-        restore_base_vae()
+        restore_base_vae(model)
     model.first_stage_model.to(devices.dtype_vae)
 
 
 def reload_vae_weights(sd_model=None, vae_file="auto"):
-    from modules import lowvram, devices, sd_hijack
-
     if not sd_model:
         sd_model = shared.sd_model
 
@@ -212,20 +243,8 @@ def reload_vae_weights(sd_model=None, vae_file="auto"):
     if loaded_vae_file == vae_file:
         return
 
-    if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-        lowvram.send_everything_to_cpu()
-    else:
-        sd_model.to(devices.cpu)
-
-    sd_hijack.model_hijack.undo_hijack(sd_model)
-
+    # weights are copied into parameters wherever they are; the rest of the model is not affected by the VAE, so it is neither moved nor re-hijacked
     load_vae(sd_model, vae_file)
 
-    sd_hijack.model_hijack.hijack(sd_model)
-    script_callbacks.model_loaded_callback(sd_model)
-
-    if not shared.cmd_opts.lowvram and not shared.cmd_opts.medvram:
-        sd_model.to(devices.device)
-
     print(f"VAE Weights loaded.")
     return sd_model
@@ -0,0 +1,163 @@
+import torch
+
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+
+opt_f = 8
+
+
+class GroupNormStats:
+    """
+    Makes all GroupNorm layers of a module normalize with statistics recorded once for the whole image rather than computed for each tile,
+    so that tiles processed separately get the same brightness and contrast.
+    Statistics are recorded from a pass over a downscaled copy of the image, and are replayed in the order in which layers were called.
+    """
+
+    def __init__(self, module):
+        self.layers = [x for x in module.modules() if isinstance(x, torch.nn.GroupNorm)]
+        self.stats = []
+        self.index = 0
+        self.recording = True
+
+    def __enter__(self):
+        for layer in self.layers:
+            layer.forward = self.forward_for(layer)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for layer in self.layers:
+            del layer.forward
+
+    def replay(self):
+        self.recording = False
+        self.index = 0
+
+    def forward_for(self, layer):
+        def forward(x):
+            b, c = x.shape[:2]
+            groups = x.reshape(b, layer.num_groups, -1).float()
+
+            if self.recording:
+                var, mean = torch.var_mean(groups, dim=2, unbiased=False, keepdim=True)
+                self.stats.append((mean, var))
+            else:
+                mean, var = self.stats[self.index]
+                self.index += 1
+
+            x = ((groups - mean) * torch.rsqrt(var + layer.eps)).reshape(x.shape).to(x.dtype)
+
+            if layer.affine:
+                x = x * layer.weight.view(1, c, *([1] * (x.dim() - 2))) + layer.bias.view(1, c, *([1] * (x.dim() - 2)))
+
+            return x
+
+        return forward
+
+
+def tile_positions(length, tile, overlap):
+    """returns starts of tiles of size tile that cover length with at least overlap between neighbours"""
+
+    if length <= tile:
+        return [0]
+
+    starts = list(range(0, length - tile, tile - overlap))
+
+    return starts + [length - tile]
+
+
+def feather(length, at_start, at_end, overlap, device):
+    """returns 1D weights for a tile: ramping up over overlap at the side facing a neighbour, and 1 at edges of the image"""
+
+    weights = torch.ones(length, device=device)
+    ramp = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+
+    if not at_start and overlap > 0:
+        weights[:overlap] = ramp
+    if not at_end and overlap > 0:
+        weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+
+    return weights
+
+
+def process_tiled(fn, x, tile, overlap, scale):
+    """
+    Runs fn, which maps a tensor to one scale times larger or smaller, over overlapping tiles of x of size tile with overlap in x's units,
+    and blends results with feathered weights.
+    """
+
+    # neighbouring tiles must be at least one latent pixel apart
+    overlap = max(min(overlap, tile - max(1, round(1 / scale))), 0)
+
+    h, w = x.shape[2:]
+    ys = tile_positions(h, tile, overlap)
+    xs = tile_positions(w, tile, overlap)
+
+    res = None
+    weights = None
+
+    for y in ys:
+        for x0 in xs:
+            th, tw = min(tile, h), min(tile, w)
+            out = fn(x[:, :, y:y + th, x0:x0 + tw]).float()
+
+            if res is None:
+                res = torch.zeros(out.shape[0], out.shape[1], round(h * scale), round(w * scale), device=out.device)
+                weights = torch.zeros(1, 1, res.shape[2], res.shape[3], device=out.device)
+
+            oy, ox, oh, ow = round(y * scale), round(x0 * scale), out.shape[2], out.shape[3]
+            out_overlap = round(overlap * scale)
+
+            mask = feather(oh, y == 0, y + th >= h, out_overlap, out.device)[:, None] * feather(ow, x0 == 0, x0 + tw >= w, out_overlap, out.device)[None, :]
+
+            res[:, :, oy:oy + oh, ox:ox + ow] += out * mask
+            weights[:, :, oy:oy + oh, ox:ox + ow] += mask
+
+    return res / weights
+
+
+def downscale_to_tile(x, tile):
+    """returns x subsampled so that it fits into a single tile, for recording GroupNorm statistics"""
+
+    h, w = x.shape[2:]
+    factor = max(h / tile, w / tile)
+    if factor <= 1:
+        return x
+
+    return torch.nn.functional.interpolate(x, size=(max(1, int(h / factor)), max(1, int(w / factor))), mode="nearest")
+
+
+def decode(model, z, tile_size=64, overlap=8):
+    """decodes latents z with model's VAE in tiles of tile_size latent pixels overlapping by overlap; returns the same as model.decode_first_stage"""
+
+    first_stage_model = model.first_stage_model
+    z = 1. / model.scale_factor * z
+
+    with torch.no_grad(), GroupNormStats(first_stage_model.decoder) as stats:
+        first_stage_model.decode(downscale_to_tile(z, tile_size))
+        stats.replay()
+
+        def decode_tile(tile):
+            stats.index = 0
+            return first_stage_model.decode(tile)
+
+        res = process_tiled(decode_tile, z, tile_size, overlap, opt_f)
+
+    return res.to(z.dtype)
+
+
+def encode(model, x, tile_size=64, overlap=8):
+    """encodes images x with model's VAE in tiles of tile_size latent pixels overlapping by overlap; returns the same as model.encode_first_stage"""
+
+    first_stage_model = model.first_stage_model
+
+    with torch.no_grad(), GroupNormStats(first_stage_model.encoder) as stats:
+        first_stage_model.encode(downscale_to_tile(x, tile_size * opt_f))
+        stats.replay()
+
+        def encode_tile(tile):
+            stats.index = 0
+            return first_stage_model.encode(tile).parameters
+
+        moments = process_tiled(encode_tile, x, tile_size * opt_f, overlap * opt_f, 1 / opt_f)
+
+    return DiagonalGaussianDistribution(moments.to(x.dtype))
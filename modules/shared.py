@@ -52,6 +52,7 @@ parser.add_argument("--allow-code", action='store_true', help="allow custom scri
 parser.add_argument("--medvram", action='store_true', help="enable stable diffusion model optimizations for sacrificing a little speed for low VRM usage")
 parser.add_argument("--lowvram", action='store_true', help="enable stable diffusion model optimizations for sacrificing a lot of speed for very low VRM usage")
 parser.add_argument("--lowram", action='store_true', help="load stable diffusion checkpoint weights to VRAM instead of RAM")
+parser.add_argument("--disable-model-loading-ram-optimization", action='store_true', help="disable an optimization that creates the model on the meta device and loads weights into it directly, reducing time and RAM needed to load a model")
 parser.add_argument("--always-batch-cond-uncond", action='store_true', help="disables cond/uncond batching that is enabled to save memory with --medvram or --lowvram")
 parser.add_argument("--unload-gfpgan", action='store_true', help="does not do anything.")
 parser.add_argument("--precision", type=str, help="evaluate at this precision", choices=["full", "autocast"], default="autocast")
@@ -71,6 +72,7 @@ parser.add_argument("--deepdanbooru", action='store_true', help="does not do any
 parser.add_argument("--opt-split-attention", action='store_true', help="force-enables Doggettx's cross-attention layer optimization. By default, it's on for torch cuda.")
 parser.add_argument("--opt-split-attention-invokeai", action='store_true', help="force-enables InvokeAI's cross-attention layer optimization. By default, it's on when cuda is unavailable.")
 parser.add_argument("--opt-split-attention-v1", action='store_true', help="enable older version of split attention optimization that does not consume all the VRAM it can find")
+parser.add_argument("--opt-sdp-attention", action='store_true', help="force-enables scaled dot product cross-attention layer optimization (requires PyTorch 2.0); slices attention automatically based on sequence length and available memory. By default, it's on with PyTorch 2.0 unless another optimization is selected.")
 parser.add_argument("--disable-opt-split-attention", action='store_true', help="force-disables cross-attention layer optimization")
 parser.add_argument("--use-cpu", nargs='+', help="use CPU as torch device for specified modules", default=[], type=str.lower)
 parser.add_argument("--listen", action='store_true', help="launch gradio with 0.0.0.0 as server name, allowing to respond to network requests")
@@ -85,6 +87,14 @@ parser.add_argument("--gradio-auth", type=str, help='set gradio authentication l
 parser.add_argument("--gradio-img2img-tool", type=str, help='gradio image uploader tool: can be either editor for ctopping, or color-sketch for drawing', choices=["color-sketch", "editor"], default="editor")
 parser.add_argument("--gradio-inpaint-tool", type=str, choices=["sketch", "color-sketch"], default="sketch", help="gradio inpainting editor: can be either sketch to only blur/noise the input, or color-sketch to paint over it")
 parser.add_argument("--opt-channelslast", action='store_true', help="change memory type for stable diffusion to channels last")
+parser.add_argument("--cpu-profile", action='store_true', help="enable CPU inference profile when running on CPU: bf16 autocast where supported, thread settings, channels last memory format and benchmark-based choice of cross attention optimization")
+parser.add_argument("--cpu-threads", type=int, help="CPU inference profile: number of threads used for intra-op parallelism; default is chosen by torch", default=None)
+parser.add_argument("--cpu-interop-threads", type=int, help="CPU inference profile: number of threads used for inter-op parallelism; default is chosen by torch", default=None)
+parser.add_argument("--cpu-no-bf16", action='store_true', help="CPU inference profile: do not use bf16 autocast even if the CPU supports it")
+parser.add_argument("--cpu-no-channels-last", action='store_true', help="CPU inference profile: do not change memory format of UNet and VAE to channels last")
+parser.add_argument("--cpu-compile", type=str, help="CPU inference profile: compile UNet using torch.compile or TorchScript", choices=["none", "compile", "torchscript"], default="none")
+parser.add_argument("--cpu-compile-cache-dir", type=str, help="CPU inference profile: directory for torch.compile cache", default=os.path.join(script_path, "cache", "cpu-compile"))
+parser.add_argument("--cpu-benchmark-steps", type=int, help="CPU inference profile: number of UNet steps to run at startup to measure it/s; 0 to disable", default=3)
 parser.add_argument("--styles-file", type=str, help="filename to use for styles", default=os.path.join(script_path, 'styles.csv'))
 parser.add_argument("--autolaunch", action='store_true', help="open the webui URL in the system's default browser upon launch", default=False)
 parser.add_argument("--theme", type=str, help="launches the UI with light or dark theme", default=None)
@@ -213,6 +223,7 @@ def reload_embeddings(request: gr.Request):
 
 
 def reload_hypernetworks(request: gr.Request = None):
+    from modules import network_catalog
     from modules.hypernetworks import hypernetwork
     global hypernetworks
 
@@ -225,9 +236,9 @@ def reload_hypernetworks(request: gr.Request = None):
                 'module': 'hypernetwork',
                 'username': username
             }
-            response = requests.get(url=f'{api_endpoint}/sd/models', params=params)
-            if response.status_code == 200:
-                for hypernetwork_item in json.loads(response.text):
+            hypernetwork_items = network_catalog.catalog.list_remote(f'{api_endpoint}/sd/models', params)
+            if hypernetwork_items is not None:
+                for hypernetwork_item in hypernetwork_items:
                     basename, fullname = os.path.split(hypernetwork_item)
                     hypernetworks[os.path.splitext(hypernetwork_item)[0]] = f'/tmp/models/hypernetworks/{fullname}'
     else:
@@ -248,6 +259,7 @@ class State:
     current_image_sampling_step = 0
     textinfo = None
     time_start = None
+    images_per_minute = None
     need_restart = False
 
     def skip(self):
@@ -273,6 +285,7 @@ class State:
             "job_no": self.job_no,
             "sampling_step": self.sampling_step,
             "sampling_steps": self.sampling_steps,
+            "images_per_minute": self.images_per_minute,
         }
 
         return obj
@@ -289,6 +302,7 @@ class State:
         self.interrupted = False
         self.textinfo = None
         self.time_start = time.time()
+        self.images_per_minute = None
 
         devices.torch_gc()
 
@@ -535,11 +549,18 @@ options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     "sd_vae": OptionInfo("auto", "SD VAE", gr.Dropdown, lambda: {"choices": sd_vae.vae_list}, refresh=sd_vae.refresh_vae_list),
     "sd_vae_as_default": OptionInfo(False, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
+    "vae_decode_batch_size": OptionInfo(0, "Number of images to decode with VAE at once (0 = as many as fit into free VRAM)"),
+    "vae_tiling_threshold": OptionInfo(2.5, "Pass images through VAE in tiles when they are larger than this many megapixels (0 = never)", gr.Slider, {"minimum": 0.0, "maximum": 16.0, "step": 0.5}),
+    "vae_tile_size": OptionInfo(512, "Tiled VAE: tile size in pixels", gr.Slider, {"minimum": 256, "maximum": 1024, "step": 64}),
+    "vae_tile_overlap": OptionInfo(64, "Tiled VAE: overlap between tiles in pixels", gr.Slider, {"minimum": 0, "maximum": 256, "step": 8}),
+    "sd_vae_cache_size": OptionInfo(1024, "RAM used to keep recently used VAEs, so that switching back to them does not read the file again, in megabytes (0 = disable)"),
     "sd_hypernetwork": OptionInfo("None", "Hypernetwork", gr.Dropdown, lambda: {"choices": ["None"] + [x for x in hypernetworks.keys()]}, refresh=reload_hypernetworks),
     "sd_hypernetwork_strength": OptionInfo(1.0, "Hypernetwork strength", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.001}),
     "inpainting_mask_weight": OptionInfo(1.0, "Inpainting conditioning mask strength", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     "img2img_color_correction": OptionInfo(False, "Apply color correction to img2img results to match original colors."),
     "img2img_fix_steps": OptionInfo(False, "With img2img, do exactly the amount of steps the slider specifies (normally you'd do less with less denoising)."),
+    "img2img_batch_prefetch": OptionInfo(4, "Number of input images that batch img2img loads in background ahead of the ones being processed", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}),
+    "img2img_batch_max_batch_size": OptionInfo(8, "Largest batch that batch img2img makes by packing consecutive input files of the same size, each with batch size copies; not used with scripts", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds. Requires restart to apply."),
     "enable_emphasis": OptionInfo(True, "Emphasis: use (text) to make model pay more attention to text and [text] to make it pay less attention"),
     "use_old_emphasis_implementation": OptionInfo(False, "Use old emphasis implementation. Can be useful to reproduce old seeds."),
@@ -547,7 +568,11 @@ options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "comma_padding_backtrack": OptionInfo(20, "Increase coherency by padding from the last comma within n tokens when using more than 75 tokens", gr.Slider, {"minimum": 0, "maximum": 74, "step": 1 }),
     "filter_nsfw": OptionInfo(False, "Filter NSFW content"),
     'CLIP_stop_at_last_layers': OptionInfo(1, "Clip skip", gr.Slider, {"minimum": 1, "maximum": 12, "step": 1}),
+    "cond_cache_size": OptionInfo(256, "Size of cache for text encoder results shared between requests, in megabytes (0 = disable)"),
+    "cond_cache_on_cpu": OptionInfo(False, "Keep cached text encoder results in RAM instead of VRAM"),
     "random_artist_categories": OptionInfo([], "Allowed categories for random artists selection when using the Roll button", gr.CheckboxGroup, {"choices": artist_db.categories()}),
+    "token_merging_ratio": OptionInfo(0.0, "Token merging ratio: fraction of tokens merged in self-attention of UNet transformer blocks; speeds up large images at the cost of detail (0 = disable)", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.05}),
+    "token_merging_schedule": OptionInfo("1, 0, 0, 0", "Token merging schedule: ratio multipliers for UNet blocks at 1x, 2x, 4x and 8x downsampling"),
 }))
 
 options_templates.update(options_section(('saving-images', "Saving images/grids"), {
@@ -606,6 +631,7 @@ options_templates.update(options_section(('upscaling', "Upscaling"), {
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI. (Requires restart)", gr.CheckboxGroup, lambda: {"choices": realesrgan_models_names()}),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in sd_upscalers]}),
     "use_scale_latent_for_hires_fix": OptionInfo(False, "Upscale latent space image when doing hires. fix"),
+    "hires_first_pass_cache_size": OptionInfo(0, "RAM used to keep latents from first pass of hires. fix, so that changing only second pass settings for the same seeds and prompts skips the first pass, in megabytes (0 = disable)"),
 }))
 
 options_templates.update(options_section(('face-restoration', "Face restoration"), {
@@ -618,6 +644,7 @@ options_templates.update(options_section(('system', "System"), {
     "memmon_poll_rate": OptionInfo(8, "VRAM usage polls per second during generation. Set to 0 to disable.", gr.Slider, {"minimum": 0, "maximum": 40, "step": 1}),
     "samples_log_stdout": OptionInfo(False, "Always print all generation info to standard output"),
     "multiple_tqdm": OptionInfo(True, "Add a second progress bar to the console that shows progress for an entire job."),
+    "postprocessing_pipeline_depth": OptionInfo(2, "Batches whose saving can run in background while the next batch is generated (0 = disable)"),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -651,6 +678,7 @@ options_templates.update(options_section(('extra_networks', "Extra Networks"), {
     "extra_networks_card_width": OptionInfo(0, "Card width for Extra Networks (px)"),
     "extra_networks_card_height": OptionInfo(0, "Card height for Extra Networks (px)"),
     "extra_networks_add_text_separator": OptionInfo(" ", "Extra text to add before <...> when adding extra network to prompt"),
+    "extra_networks_catalog_ttl": OptionInfo(10, "Seconds to reuse lists of extra network files before checking directories for changes again"),
     "sd_hypernetwork": OptionInfo("None", "Add hypernetwork to prompt", gr.Dropdown, lambda: {"choices": [""] + [x for x in hypernetworks.keys()]}, refresh=reload_hypernetworks),
 }))
 
@@ -682,6 +710,7 @@ options_templates.update(options_section(('sampler-params', "Sampler parameters"
     's_tmin':  OptionInfo(0.0, "sigma tmin",  gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     's_noise': OptionInfo(1.0, "sigma noise", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     'eta_noise_seed_delta': OptionInfo(0, "Eta noise seed delta", gr.Number, {"precision": 0}),
+    'randn_source': OptionInfo("device", "Random number generator for noise; Philox (CPU) makes the same images for a seed on all devices", gr.Radio, {"choices": ["device", "Philox (CPU)"]}),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
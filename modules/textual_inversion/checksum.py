@@ -0,0 +1,23 @@
+import torch
+
+
+def embedding_checksum(vec):
+    """
+    Returns the 4 hex digit checksum of embedding vectors shown in "Used embeddings" comments.
+
+    The value is r = (r * 281 ^ int(v * 100) * 997) & 0xFFFFFFFF folded over all floats of vec, of which only the low 16 bits are shown.
+    Since 281 is odd, bit j of r * 281 is bit j of r plus a carry that only depends on lower bits of r; so once lower bits of r are known
+    after every float, bit j after every float is a running XOR, computed for all floats at once with a cumulative sum. This is done
+    for each of the 16 bits in turn.
+    """
+
+    scaled = vec.detach().reshape(-1).cpu() * 100
+    terms = (scaled.to(torch.int64) * 997) & 0xFFFF
+
+    # low[i] holds bits found so far of r after i floats
+    low = torch.zeros(terms.shape[0] + 1, dtype=torch.int64)
+    for bit in range(16):
+        carry = ((low[:-1] * 281) >> bit) & 1
+        low[1:] |= (torch.cumsum(carry ^ ((terms >> bit) & 1), 0) & 1) << bit
+
+    return f'{int(low[-1]):04x}'
@@ -13,20 +13,50 @@ from PIL import Image, PngImagePlugin
 
 from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers
 import modules.textual_inversion.dataset
+from modules.textual_inversion.checksum import embedding_checksum
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
 from modules.textual_inversion.image_embedding import (embedding_to_b64, embedding_from_b64,
                                                        insert_image_data_embed, extract_image_data_embed,
                                                        caption_image_overlay)
 
+def load_torch_file(path):
+    """loads a file saved with torch.save, mapping its tensors from disk rather than reading them where torch and the file format allow it"""
+
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location="cpu")
+
+
 class Embedding:
     def __init__(self, vec, name, step=None):
         self.vec = vec
+        self.load_vec = None
         self.name = name
         self.step = step
         self.cached_checksum = None
         self.sd_checkpoint = None
         self.sd_checkpoint_name = None
+        self.filename = None
+
+    @property
+    def vec(self):
+        """vectors of the embedding; for embeddings read from disk, they are only read by load_vec and moved to the device on first use"""
+
+        if not self.vec_on_device:
+            if self._vec is None:
+                self._vec = self.load_vec()
+
+            self._vec = self._vec.to(devices.device)
+            self.vec_on_device = True
+
+        return self._vec
+
+    @vec.setter
+    def vec(self, value):
+        self._vec = value
+        self.vec_on_device = False
 
     def save(self, filename):
         embedding_data = {
@@ -44,50 +74,31 @@ class Embedding:
         if self.cached_checksum is not None:
             return self.cached_checksum
 
-        def const_hash(a):
-            r = 0
-            for v in a:
-                r = (r * 281 ^ int(v) * 997) & 0xFFFFFFFF
-            return r
-
-        self.cached_checksum = f'{const_hash(self.vec.reshape(-1) * 100) & 0xffff:04x}'
+        self.cached_checksum = embedding_checksum(self.vec)
         return self.cached_checksum
 
-class DirWithTextualInversionEmbeddings:
-    def __init__(self, path):
-        self.path = path
-        self.mtime = None
-
-    def has_changed(self):
-        if not os.path.isdir(self.path):
-            return False
-
-        mt = os.path.getmtime(self.path)
-        if self.mtime is None or mt > self.mtime:
-            return True
-
-    def update(self):
-        if not os.path.isdir(self.path):
-            return
-
-        self.mtime = os.path.getmtime(self.path)
-
 class EmbeddingDatabase:
     def __init__(self):
         self.ids_lookup = {}
         self.word_embeddings = {}
         self.skipped_embeddings = {}
         self.expected_shape = -1
-        self.embedding_dirs = {}
+        self.embedding_dirs = []
+        self.version = 0
+
+        # path -> (size, mtime, Embedding or None) for every file seen in embedding dirs
+        self.files = {}
 
     def add_embedding_dir(self, path):
-        self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
+        if path not in self.embedding_dirs:
+            self.embedding_dirs.append(path)
 
     def clear_embedding_dirs(self):
         self.embedding_dirs.clear()
 
     def register_embedding(self, embedding, model):
         self.word_embeddings[embedding.name] = embedding
+        self.version += 1
 
         ids = model.cond_stage_model.tokenize([embedding.name])[0]
 
@@ -99,18 +110,46 @@ class EmbeddingDatabase:
 
         return embedding
 
+    def unregister_embedding(self, embedding):
+        if self.word_embeddings.get(embedding.name, None) is embedding:
+            del self.word_embeddings[embedding.name]
+        elif self.skipped_embeddings.get(embedding.name, None) is embedding:
+            del self.skipped_embeddings[embedding.name]
+        else:
+            return
+
+        self.version += 1
+
+        for first_id, matches in list(self.ids_lookup.items()):
+            matches = [x for x in matches if x[1] is not embedding]
+            if matches:
+                self.ids_lookup[first_id] = matches
+            else:
+                del self.ids_lookup[first_id]
+
+    def add_embedding(self, embedding):
+        """registers embedding if it fits the current model, or remembers it as skipped otherwise"""
+
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.register_embedding(embedding, shared.sd_model)
+        else:
+            self.skipped_embeddings[embedding.name] = embedding
+
     def get_expected_shape(self):
         vec = shared.sd_model.cond_stage_model.encode_embedding_init_text(",", 1)
         return vec.shape[1]
 
-    def load_from_file(self, path, filename):
+    def read_embedding_file(self, path, filename):
+        """reads name and shape of embedding from file; its vectors are read on first use, except for embeddings stored in images,
+        which have to be decoded right away; returns None for files that are not embeddings"""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -120,11 +159,22 @@ class EmbeddingDatabase:
                 data = extract_image_data_embed(embed_image)
                 name = data.get('name', name)
         elif ext in ['.BIN', '.PT']:
-            data = torch.load(path, map_location="cpu")
+            data = load_torch_file(path)
         elif ext in ['.SAFETENSORS']:
-            data = safetensors.torch.load_file(path, device="cpu")
+            with safetensors.safe_open(path, framework="pt", device="cpu") as file:
+                keys = list(file.keys())
+                assert len(keys) == 1, 'embedding file has multiple terms in it'
+                shape = file.get_slice(keys[0]).get_shape()
+
+            embedding = Embedding(None, name)
+            embedding.load_vec = lambda: safetensors.torch.load_file(path, device="cpu")[keys[0]].to(dtype=torch.float32).reshape(-1, shape[-1])
+            embedding.vectors = 1 if len(shape) == 1 else shape[0]
+            embedding.shape = shape[-1]
+            embedding.filename = path
+
+            return embedding
         else:
-            return
+            return None
 
         # textual inversion embeddings
         if 'string_to_param' in data:
@@ -143,56 +193,96 @@ class EmbeddingDatabase:
         else:
             raise Exception(f"Couldn't identify {filename} as neither textual inversion embedding nor diffuser concept.")
 
-        vec = emb.detach().to(devices.device, dtype=torch.float32)
-        embedding = Embedding(vec, name)
+        # tensors of .pt files may be mapped from disk; they are copied, and so read, on first use
+        embedding = Embedding(None, name)
+        embedding.load_vec = lambda: emb.detach().to(devices.cpu, dtype=torch.float32, copy=True)
         embedding.step = data.get('step', None)
         embedding.sd_checkpoint = data.get('sd_checkpoint', None)
         embedding.sd_checkpoint_name = data.get('sd_checkpoint_name', None)
-        embedding.vectors = vec.shape[0]
-        embedding.shape = vec.shape[-1]
+        embedding.vectors = emb.shape[0]
+        embedding.shape = emb.shape[-1]
+        embedding.filename = path
 
-        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-            self.register_embedding(embedding, shared.sd_model)
-        else:
-            self.skipped_embeddings[name] = embedding
+        return embedding
 
-    def load_from_dir(self, embdir):
-        if not os.path.isdir(embdir.path):
-            return
+    def load_from_file(self, path, filename):
+        embedding = self.read_embedding_file(path, filename)
+        if embedding is not None:
+            self.add_embedding(embedding)
+
+        return embedding
 
-        for root, dirs, fns in os.walk(embdir.path):
-            for fn in fns:
-                try:
+    def list_files(self):
+        """returns {path: (filename, size, mtime)} for all non-empty files in embedding dirs"""
+
+        res = {}
+        for embdir in self.embedding_dirs:
+            if not os.path.isdir(embdir):
+                continue
+
+            for root, dirs, fns in os.walk(embdir):
+                for fn in fns:
                     fullfn = os.path.join(root, fn)
 
-                    if os.stat(fullfn).st_size == 0:
+                    try:
+                        stat = os.stat(fullfn)
+                    except OSError:
                         continue
 
-                    self.load_from_file(fullfn, fn)
-                except Exception:
-                    print(f"Error loading embedding {fn}:", file=sys.stderr)
-                    print(traceback.format_exc(), file=sys.stderr)
-                    continue
+                    if stat.st_size == 0:
+                        continue
+
+                    res[fullfn] = (fn, stat.st_size, stat.st_mtime)
+
+        return res
 
     def load_textual_inversion_embeddings(self, force_reload=False):
-        if not force_reload:
-            need_reload = False
-            for path, embdir in self.embedding_dirs.items():
-                if embdir.has_changed():
-                    need_reload = True
-                    break
+        """brings the database in line with files in embedding dirs, reading only files that were added or changed since the last call.
+        With force_reload, all embeddings are registered again for the current model, reusing what was already read from unchanged files."""
+
+        files = self.list_files()
+        version = self.version
+        register_all = force_reload or self.expected_shape == -1
+
+        if register_all:
+            self.ids_lookup.clear()
+            self.word_embeddings.clear()
+            self.skipped_embeddings.clear()
+            self.version += 1
+            self.expected_shape = self.get_expected_shape()
+
+        for path in [path for path in self.files if path not in files]:
+            _, _, embedding = self.files.pop(path)
+            if embedding is not None:
+                self.unregister_embedding(embedding)
 
-            if not need_reload:
-                return
+        for path, (fn, size, mtime) in files.items():
+            previous = self.files.get(path, None)
+            unchanged = previous is not None and previous[0] == size and previous[1] == mtime
 
-        self.ids_lookup.clear()
-        self.word_embeddings.clear()
-        self.skipped_embeddings.clear()
-        self.expected_shape = self.get_expected_shape()
+            if unchanged and not register_all:
+                continue
 
-        for path, embdir in self.embedding_dirs.items():
-            self.load_from_dir(embdir)
-            embdir.update()
+            if previous is not None and previous[2] is not None:
+                self.unregister_embedding(previous[2])
+
+            embedding = previous[2] if unchanged else None
+
+            try:
+                if embedding is None and not unchanged:
+                    embedding = self.read_embedding_file(path, fn)
+
+                if embedding is not None:
+                    self.add_embedding(embedding)
+            except Exception:
+                print(f"Error loading embedding {fn}:", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+                embedding = None
+
+            self.files[path] = (size, mtime, embedding)
+
+        if self.version == version:
+            return
 
         print(f"Textual inversion embeddings loaded({len(self.word_embeddings)}): {', '.join(self.word_embeddings.keys())}")
         if len(self.skipped_embeddings) > 0:
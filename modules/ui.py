@@ -21,7 +21,7 @@ import numpy as np
 from PIL import Image, PngImagePlugin
 from modules.call_queue import wrap_gradio_gpu_call, wrap_queued_call, wrap_gradio_call
 
-from modules import sd_hijack, sd_models, localization, script_callbacks, ui_extensions, deepbooru
+from modules import sd_hijack, sd_models, localization, script_callbacks, ui_extensions, deepbooru, network_catalog
 from modules.ui_components import FormRow, FormGroup, ToolButton, FormHTML
 from modules.paths import script_path
 
@@ -493,7 +493,9 @@ def update_generation_info(generation_info, html_info, img_index):
     return html_info
 
 def create_refresh_button(refresh_component, refresh_method, refreshed_args, elem_id):
+    # listings of networks are made anew rather than taken from network_catalog, so that files the user just added show up
     def refresh():
+        network_catalog.catalog.clear()
         refresh_method()
         args = refreshed_args() if callable(refreshed_args) else refreshed_args
 
@@ -523,6 +525,7 @@ def create_refresh_button(refresh_component, refresh_method, refreshed_args, ele
         return gr.update(**(args or {}))
 
     def refresh_lora_models(sagemaker_endpoint,request:gr.Request):
+        network_catalog.catalog.clear()
         username = shared.get_webui_username(request)
         refresh_method(sagemaker_endpoint,username)
         args = refreshed_args() if callable(refreshed_args) else refreshed_args
@@ -533,6 +536,7 @@ def create_refresh_button(refresh_component, refresh_method, refreshed_args, ele
         return gr.update(**(args or {}))
 
     def refresh_vae_models(sagemaker_endpoint):
+        network_catalog.catalog.clear()
         refresh_method(sagemaker_endpoint=sagemaker_endpoint)
         args = refreshed_args() if callable(refreshed_args) else refreshed_args
 
@@ -4,7 +4,7 @@ import urllib.parse
 from pathlib import Path
 from PIL import PngImagePlugin
 
-from modules import shared
+from modules import shared, network_catalog
 from modules.images import read_info_from_image
 import gradio as gr
 import json
@@ -269,6 +269,7 @@ def create_ui(container, button, tabname):
     button.click(fn=toggle_visibility, inputs=[state_visible], outputs=[state_visible, container, button])
 
     def refresh(sagemaker_endpoint, request: gr.Request):
+        network_catalog.catalog.clear()
         res = []
 
         for pg in ui.stored_extra_pages:
@@ -0,0 +1,49 @@
+import unittest
+
+import torch
+
+from modules import cache_utils
+
+
+class LruCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache_utils.LruCache("test_cache_size")
+        self.cache.limit = lambda: 3 * 1024
+
+    def put(self, key):
+        value = torch.zeros(256)
+        self.cache.put(key, value, cache_utils.tensors_size([value]))
+        return value
+
+    def test_evicts_least_recently_used(self):
+        a = self.put("a")
+        self.put("b")
+        self.put("c")
+
+        self.assertIs(self.cache.get("a"), a)
+        self.put("d")
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.size, 3 * 1024)
+        self.assertEqual(self.cache.stats()["entries"], 3)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_replace_and_too_large(self):
+        self.put("a")
+        self.put("a")
+        self.assertEqual(self.cache.size, 1024)
+
+        self.cache.put("a", torch.zeros(2048), 8 * 1024)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_invalid_entry_is_a_miss(self):
+        self.put("a")
+
+        self.assertIsNone(self.cache.get("a", valid=lambda x: False))
+        self.assertIsNotNone(self.cache.get("a", valid=lambda x: True))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
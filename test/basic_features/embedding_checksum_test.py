@@ -0,0 +1,32 @@
+import unittest
+
+import torch
+
+from modules.textual_inversion.checksum import embedding_checksum
+
+
+def reference_checksum(vec):
+    def const_hash(a):
+        r = 0
+        for v in a:
+            r = (r * 281 ^ int(v) * 997) & 0xFFFFFFFF
+        return r
+
+    return f'{const_hash(vec.reshape(-1) * 100) & 0xffff:04x}'
+
+
+class EmbeddingChecksumTests(unittest.TestCase):
+    def test_matches_reference_on_random_vectors(self):
+        generator = torch.Generator().manual_seed(0)
+
+        for vectors, size, scale in [(1, 768, 1.0), (4, 768, 0.05), (2, 1024, 10.0), (8, 1024, 1e6), (3, 7, 1e-4)]:
+            vec = torch.randn(vectors, size, generator=generator) * scale
+            self.assertEqual(embedding_checksum(vec), reference_checksum(vec))
+
+    def test_matches_reference_on_edge_values(self):
+        vec = torch.tensor([[0.0, -0.0, 0.009, -0.009, 0.01, -0.01, 0.999, -0.999, 21474836.47, -21474836.48, 1e7, -1e7]])
+        self.assertEqual(embedding_checksum(vec), reference_checksum(vec))
+
+
+if __name__ == "__main__":
+    unittest.main()
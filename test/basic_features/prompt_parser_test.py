@@ -0,0 +1,88 @@
+import unittest
+
+import torch
+
+from modules import prompt_parser
+
+
+class PromptScheduleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.prompts = [
+            f"a [photo:painting:{i % 7 + 1}] of a [cat|dog|fox] in the [forest:city:0.{i % 9 + 1}], (detailed:1.{i % 5}), [[old]] [house:{i % 11 + 2}] variant {i}"
+            for i in range(50)
+        ]
+
+    def test_prompt_schedules_are_cached(self):
+        prompt_parser.parse_schedule.cache_clear()
+        prompt_parser.get_schedule.cache_clear()
+
+        first = prompt_parser.get_learned_conditioning_prompt_schedules(self.prompts, 30)
+        self.assertEqual(prompt_parser.parse_schedule.cache_info().misses, len(self.prompts))
+        self.assertEqual(prompt_parser.get_schedule.cache_info().misses, len(self.prompts))
+
+        second = prompt_parser.get_learned_conditioning_prompt_schedules(self.prompts, 30)
+        self.assertEqual(first, second)
+        self.assertEqual(prompt_parser.get_schedule.cache_info().hits, len(self.prompts))
+
+        # a different number of steps makes new schedules from trees parsed before
+        prompt_parser.get_learned_conditioning_prompt_schedules(self.prompts, 20)
+        self.assertEqual(prompt_parser.parse_schedule.cache_info().hits, len(self.prompts))
+        self.assertEqual(prompt_parser.parse_schedule.cache_info().misses, len(self.prompts))
+
+    def test_cached_schedules_are_not_shared(self):
+        first = prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:5]"], 10)
+        first[0][0][1] = "changed"
+
+        second = prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:5]"], 10)
+        self.assertEqual(second, [[[5, 'a b'], [10, 'a c']]])
+
+
+class CondBatchTableTest(unittest.TestCase):
+    def setUp(self):
+        self.steps = 150
+
+        def schedule(n, vary_length=False):
+            return [prompt_parser.ScheduledPromptConditioning(end_at, torch.randn(77 * (1 + end_at % 2 * vary_length), 64)) for end_at in range(self.steps // n, self.steps + 1, self.steps // n)]
+
+        self.uncond = [schedule(3) for _ in range(8)]
+        self.cond = prompt_parser.MulticondLearnedConditioning(shape=(8,), batch=[
+            [prompt_parser.ComposableScheduledPromptConditioning(schedule(5 + i, vary_length=True), 1.0), prompt_parser.ComposableScheduledPromptConditioning(schedule(2), 0.5)]
+            for i in range(8)
+        ])
+
+    def test_per_step_lookup(self):
+        # samplers like DPM2 call the model twice per step, so steps past the last boundary are covered too
+        sampling_steps = range(self.steps * 2)
+
+        expected = [(prompt_parser.reconstruct_multicond_batch(self.cond, step), prompt_parser.reconstruct_cond_batch(self.uncond, step)) for step in sampling_steps]
+
+        reconstructed = []
+
+        def reconstruct_multicond_batch(c, current_step):
+            reconstructed.append(current_step)
+            return prompt_parser.reconstruct_multicond_batch(c, current_step)
+
+        cond_table = uncond_table = None
+        actual = []
+        for step in sampling_steps:
+            previous_table = cond_table
+            cond_table = prompt_parser.cond_batch_table(cond_table, self.cond, reconstruct_multicond_batch)
+            uncond_table = prompt_parser.cond_batch_table(uncond_table, self.uncond, prompt_parser.reconstruct_cond_batch)
+            actual.append((cond_table.get(step), uncond_table.get(step)))
+
+            if previous_table is not None:
+                self.assertIs(cond_table, previous_table)
+
+        for ((conds_list, tensor), uncond), ((expected_conds_list, expected_tensor), expected_uncond) in zip(actual, expected):
+            self.assertEqual(conds_list, expected_conds_list)
+            self.assertTrue(torch.equal(tensor, expected_tensor))
+            self.assertTrue(torch.equal(uncond, expected_uncond))
+
+        # one batch is built for each segment between schedule boundaries, and one for steps past the last boundary
+        self.assertEqual(len(reconstructed), len(cond_table.boundaries) + 1)
+
+        self.assertIsNot(prompt_parser.cond_batch_table(cond_table, self.uncond, reconstruct_multicond_batch), cond_table)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from modules import rng_philox
+
+
+class PhiloxTest(unittest.TestCase):
+    def test_known_answers(self):
+        """known answer tests for Philox4x32-10 from Random123"""
+
+        cases = [
+            ([0, 0, 0, 0], [0, 0], [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]),
+            ([0xffffffff] * 4, [0xffffffff] * 2, [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd]),
+            ([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344], [0xa4093822, 0x299f31d0], [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]),
+        ]
+
+        for counter, key, expected in cases:
+            res = rng_philox.philox4x32(np.array(counter, dtype=np.uint32), np.array(key, dtype=np.uint32))
+            self.assertEqual(res.tolist(), expected)
+
+    def test_batch_same_as_single(self):
+        seeds = [100, 101, 5, 2 ** 32 + 7]
+        shape = (4, 8, 12)
+
+        batch = rng_philox.randn(seeds, shape, offset=3)
+        for i, seed in enumerate(seeds):
+            self.assertTrue(np.array_equal(batch[i], rng_philox.randn([seed], shape, offset=3)[0]))
+
+    def test_distribution(self):
+        x = rng_philox.randn([1], (4, 64, 64))
+
+        self.assertEqual(x.dtype, np.float32)
+        self.assertAlmostEqual(float(x.mean()), 0.0, delta=0.02)
+        self.assertAlmostEqual(float(x.std()), 1.0, delta=0.02)
+        self.assertFalse(np.array_equal(x, rng_philox.randn([1], (4, 64, 64), offset=1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
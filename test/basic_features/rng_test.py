@@ -0,0 +1,113 @@
+import unittest
+
+import torch
+
+from modules import devices, rng, rng_philox
+
+
+def preallocated_noises(seeds, shape, count, eta_noise_seed_delta=0):
+    """noise for samplers as it was made before rng.SamplerNoise: all steps for all seeds drawn in advance from the global generator"""
+
+    sampler_noises = [[] for _ in range(count)]
+
+    for seed in seeds:
+        devices.randn(seed, shape)
+
+        if eta_noise_seed_delta > 0:
+            torch.manual_seed(seed + eta_noise_seed_delta)
+
+        for j in range(count):
+            sampler_noises[j].append(devices.randn_without_seed(shape))
+
+    return [torch.stack(n).to(devices.device) for n in sampler_noises]
+
+
+def sampler_noise(seeds, shape, count, eta_noise_seed_delta=0):
+    sampler_noises = rng.SamplerNoise(count, shape)
+
+    for seed in seeds:
+        devices.randn(seed, shape)
+
+        if eta_noise_seed_delta > 0:
+            torch.manual_seed(seed + eta_noise_seed_delta)
+
+        sampler_noises.add_seed()
+
+    return sampler_noises
+
+
+class SamplerNoiseTest(unittest.TestCase):
+    def setUp(self):
+        self.device = devices.device
+        devices.device = devices.cpu
+
+        self.seeds = [100, 101, 5, 12345]
+        self.shape = (4, 16, 24)
+        self.count = 20
+
+    def tearDown(self):
+        devices.device = self.device
+
+    def test_same_as_preallocated(self):
+        for eta_noise_seed_delta in [0, 31337]:
+            expected = preallocated_noises(self.seeds, self.shape, self.count, eta_noise_seed_delta)
+            actual = sampler_noise(self.seeds, self.shape, self.count, eta_noise_seed_delta)
+
+            self.assertEqual(len(actual), self.count)
+
+            for expected_noise in expected:
+                self.assertTrue(torch.equal(actual.popleft(), expected_noise))
+
+            self.assertEqual(len(actual), 0)
+
+    def test_global_generator_after_finish(self):
+        preallocated_noises(self.seeds, self.shape, self.count)
+        expected = torch.randn(self.shape)
+
+        actual = sampler_noise(self.seeds, self.shape, self.count)
+        for _ in range(self.count // 2):
+            actual.popleft()
+
+        torch.manual_seed(0)
+        actual.finish()
+
+        self.assertTrue(torch.equal(torch.randn(self.shape), expected))
+
+    def test_global_state_same_as_preallocated(self):
+        for eta_noise_seed_delta in [0, 31337]:
+            preallocated_noises(self.seeds, self.shape, self.count, eta_noise_seed_delta)
+            expected = torch.random.get_rng_state()
+
+            # as create_random_tensors does before returning
+            sampler_noise(self.seeds, self.shape, self.count, eta_noise_seed_delta).finish()
+
+            self.assertTrue(torch.equal(torch.random.get_rng_state(), expected))
+
+
+class PhiloxSamplerNoiseTest(unittest.TestCase):
+    def setUp(self):
+        self.device = devices.device
+        devices.device = devices.cpu
+
+    def tearDown(self):
+        devices.device = self.device
+
+    def test_fallback_uses_philox(self):
+        seeds = [100, 101]
+        sampler_noises = rng.PhiloxSamplerNoise(2, (4, 8, 8))
+        for seed in seeds:
+            sampler_noises.add_seed(seed)
+
+        first = sampler_noises.popleft()
+        sampler_noises.popleft()
+
+        self.assertEqual(len(sampler_noises), 0)
+        self.assertTrue(torch.equal(first, torch.from_numpy(rng_philox.randn(seeds, (4, 8, 8), offset=1))))
+
+        x = torch.zeros(2, 4, 16, 16)
+        for offset in [3, 4]:
+            self.assertTrue(torch.equal(sampler_noises.randn_like(x), torch.from_numpy(rng_philox.randn(seeds, (4, 16, 16), offset=offset))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Counts UNet evaluations and time per sampling step of CFGDenoiser at several cfg scales and guidance cutoffs. Uses a stand-in UNet
+made of a few convolutions, so that only the work CFGDenoiser asks for is measured, and the Euler sampler over a Karras schedule.
+
+    python test/benchmark_cfg_denoiser.py --steps 20 --batch-size 4 --device cuda
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from benchmark_utils import root, synchronize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CFGDenoiser benchmark")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64, help="latent width and height")
+    parser.add_argument("--channels", type=int, default=320)
+    parser.add_argument("--cfg-scales", type=float, nargs="+", default=[7.0, 1.0])
+    parser.add_argument("--cutoffs", type=float, nargs="+", default=[0.0, 0.5, 0.8])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+class CountingUnet(torch.nn.Module):
+    """stands in for k-diffusion's model wrapper; counts images it was asked to denoise"""
+
+    def __init__(self, channels):
+        super().__init__()
+        self.conv_in = torch.nn.Conv2d(4, channels, 3, padding=1)
+        self.conv_mid = torch.nn.Conv2d(channels, channels, 3, padding=1)
+        self.conv_out = torch.nn.Conv2d(channels, 4, 3, padding=1)
+        self.evaluations = 0
+
+    def forward(self, x, sigma, cond):
+        self.evaluations += x.shape[0]
+        crossattn = cond["c_crossattn"][0].mean(dim=(1, 2)).view(-1, 1, 1, 1)
+
+        h = torch.nn.functional.silu(self.conv_in(x))
+        h = torch.nn.functional.silu(self.conv_mid(h)) + crossattn
+
+        return x - self.conv_out(h) * sigma.view(-1, 1, 1, 1) * 0.01
+
+
+def make_conds(prompt_parser, batch_size, steps, device):
+    cond = [[prompt_parser.ComposableScheduledPromptConditioning([prompt_parser.ScheduledPromptConditioning(steps, torch.randn(77, 768, device=device))])] for _ in range(batch_size)]
+    uncond = [[prompt_parser.ScheduledPromptConditioning(steps, torch.randn(77, 768, device=device))] for _ in range(batch_size)]
+
+    return prompt_parser.MulticondLearnedConditioning(shape=(batch_size,), batch=cond), uncond
+
+
+def main():
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+    sys.path.insert(0, root)
+
+    import k_diffusion.sampling
+    from modules import prompt_parser, sd_samplers
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    unet = CountingUnet(args.channels).to(device)
+    cond, uncond = make_conds(prompt_parser, args.batch_size, args.steps, device)
+    sigmas = k_diffusion.sampling.get_sigmas_karras(n=args.steps, sigma_min=0.03, sigma_max=14.6, device=device)
+    x = torch.randn(args.batch_size, 4, args.size, args.size, device=device) * sigmas[0]
+    image_cond = torch.zeros(args.batch_size, 5, 1, 1, device=device)
+
+    print(f"{'cfg scale':>9} {'cutoff':>6} {'UNet images/step':>16} {'ms/step':>8} {'max diff':>9}")
+
+    for cfg_scale in args.cfg_scales:
+        reference = None
+
+        for cutoff in args.cutoffs:
+            denoiser = sd_samplers.CFGDenoiser(unet)
+            denoiser.guidance_cutoff_sigma = sd_samplers.guidance_cutoff_sigma(cutoff, sigmas)
+            extra_args = {"cond": cond, "uncond": uncond, "cond_scale": cfg_scale, "image_cond": image_cond}
+
+            unet.evaluations = 0
+            synchronize(device)
+            t0 = time.perf_counter()
+
+            with torch.no_grad():
+                samples = k_diffusion.sampling.sample_euler(denoiser, x, sigmas, extra_args=extra_args, disable=True)
+
+            synchronize(device)
+            seconds = time.perf_counter() - t0
+
+            reference = samples if reference is None else reference
+            diff = (samples - reference).abs().max().item()
+
+            print(f"{cfg_scale:>9.1f} {cutoff:>6.2f} {unet.evaluations / args.steps:>16.1f} {seconds / args.steps * 1000:>8.1f} {diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
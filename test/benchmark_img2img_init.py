@@ -0,0 +1,65 @@
+"""
+Reports time of encoding img2img init images with SD VAE when one image is repeated for the whole batch: encoding every copy,
+as it was done before, and encoding distinct images once and repeating their latent distributions. Uses VAE with random weights
+built from v1-inference.yaml.
+
+    python test/benchmark_img2img_init.py --batch-sizes 1 2 4 8 16 --device cuda
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from benchmark_utils import load_vae, root, timed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="img2img init image encoding benchmark")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float16" if torch.cuda.is_available() else "float32")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+    sys.path.insert(0, root)
+
+    from modules import processing
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    model = load_vae(device, dtype)
+
+    img = np.random.RandomState(0).rand(3, args.size, args.size).astype(np.float32)
+
+    def to_device(imgs):
+        return (2. * torch.from_numpy(np.array(imgs)) - 1.).to(device, dtype)
+
+    print(f"{'batch size':>10} {'every copy ms':>14} {'distinct ms':>12} {'speedup':>8} {'max diff':>9}")
+
+    for batch_size in args.batch_sizes:
+        imgs = [img] * batch_size
+
+        def encode_all():
+            return model.first_stage_model.encode(to_device(imgs))
+
+        def encode_distinct():
+            indexes, positions = processing.unique_images(imgs)
+            encoding = model.first_stage_model.encode(to_device([imgs[i] for i in indexes]))
+            return processing.repeat_first_stage_encoding(encoding, torch.tensor(positions, device=device))
+
+        expected, every_copy = timed(device, args.repeats, encode_all)
+        actual, distinct = timed(device, args.repeats, encode_distinct)
+        diff = (expected.mean - actual.mean).abs().max().item()
+
+        print(f"{batch_size:>10} {every_copy * 1000:>14.1f} {distinct * 1000:>12.1f} {every_copy / distinct:>7.1f}x {diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Compares ways of applying Lora to linear layers, set by lora_apply_mode setting: RAM taken by backups of original weights,
+time to switch between combinations of Loras, forward time at several batch sizes, and how far weights drift from
+originals after many switches. Uses synthetic layers and Loras of the size of SD1 UNet attention layers.
+
+    python test/benchmark_lora_modes.py --layers 64 --dim 1280 --rank 16 --device cuda --dtype float16
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from benchmark_utils import root, synchronize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Lora apply mode benchmark")
+    parser.add_argument("--layers", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=1280)
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--switches", type=int, default=20)
+    parser.add_argument("--unmerged-max-batch-size", type=int, default=8, help="lora_unmerged_max_batch_size setting: larger batches are merged in unmerged mode")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float16" if torch.cuda.is_available() else "float32")
+    return parser.parse_args()
+
+
+def make_lora(lora, name, layer_names, dim, rank):
+    module = lora.LoraModule(name)
+    module.mtime = 0
+
+    for layer_name in layer_names:
+        updown = lora.LoraUpDownModule()
+        updown.down = torch.nn.Linear(dim, rank, bias=False)
+        updown.up = torch.nn.Linear(rank, dim, bias=False)
+        torch.nn.init.normal_(updown.up.weight, std=0.02)
+        updown.alpha = rank
+        module.modules[layer_name] = updown
+
+    return module
+
+
+def run_layers(layers, x):
+    with torch.no_grad():
+        for layer in layers:
+            layer(x)
+
+    synchronize(x.device)
+
+
+def benchmark_mode(lora, shared, mode, args):
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    shared.opts.data["lora_apply_mode"] = mode
+    shared.opts.data["lora_weights_cache_size"] = 0
+    shared.opts.data["lora_unmerged_max_batch_size"] = args.unmerged_max_batch_size
+
+    torch.manual_seed(0)
+    layers = [torch.nn.Linear(args.dim, args.dim).to(device, dtype) for _ in range(args.layers)]
+    for i, layer in enumerate(layers):
+        layer.lora_layer_name = f"layer_{i}"
+        lora.lora_reset_cached_weight(layer)
+
+    originals = [layer.weight.detach().clone() for layer in layers]
+    layer_names = [layer.lora_layer_name for layer in layers]
+    combinations = [[make_lora(lora, "a", layer_names, args.dim, args.rank)], [make_lora(lora, "b", layer_names, args.dim, args.rank)]]
+
+    x = torch.randn(1, args.tokens, args.dim, device=device, dtype=dtype)
+
+    lora.loaded_loras[:] = combinations[0]
+    run_layers(layers, x)
+
+    t0 = time.perf_counter()
+    for i in range(args.switches):
+        lora.loaded_loras[:] = combinations[(i + 1) % 2]
+        run_layers(layers, x)
+    switch = (time.perf_counter() - t0) / args.switches
+
+    forward = {}
+    for batch_size in args.batch_sizes:
+        xb = x.expand(batch_size, -1, -1).contiguous()
+        run_layers(layers, xb)
+
+        t0 = time.perf_counter()
+        for _ in range(3):
+            run_layers(layers, xb)
+        forward[batch_size] = (time.perf_counter() - t0) / 3
+
+    backup = sum(layer.lora_weights_backup.element_size() * layer.lora_weights_backup.nelement() for layer in layers if getattr(layer, "lora_weights_backup", None) is not None)
+
+    lora.loaded_loras.clear()
+    run_layers(layers, x)
+    drift = max((layer.weight - original).abs().max().item() for layer, original in zip(layers, originals))
+
+    return backup, switch, forward, drift
+
+
+def main():
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+
+    sys.path.insert(0, root)
+    sys.path.insert(0, os.path.join(root, "extensions-builtin", "Lora"))
+
+    import lora
+    from modules import shared
+
+    if not hasattr(torch.nn, 'Linear_forward_before_lora'):
+        torch.nn.Linear_forward_before_lora = torch.nn.Linear.forward
+    torch.nn.Linear.forward = lora.lora_Linear_forward
+
+    print(f"{'mode':>28} {'backup MB':>10} {'switch ms':>10} " + " ".join(f"{f'batch {n} ms':>11}" for n in args.batch_sizes) + f" {'drift':>9}")
+    for mode in ["merge, keep backup", "merge, subtract to restore", "unmerged"]:
+        backup, switch, forward, drift = benchmark_mode(lora, shared, mode, args)
+        print(f"{mode:>28} {backup / 1024 / 1024:>10.1f} {switch * 1000:>10.1f} " + " ".join(f"{forward[n] * 1000:>11.1f}" for n in args.batch_sizes) + f" {drift:>9.2e}")
+
+    torch.nn.Linear.forward = torch.nn.Linear_forward_before_lora
+
+
+if __name__ == "__main__":
+    main()
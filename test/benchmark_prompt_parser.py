@@ -0,0 +1,96 @@
+"""
+Measures prompt schedule parsing with and without the parse and schedule caches, and building conditioning batches per sampling
+step with and without the per-run table of batches.
+
+    python test/benchmark_prompt_parser.py --prompts 50 --steps 150
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from benchmark_utils import root
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="prompt parser benchmark")
+    parser.add_argument("--prompts", type=int, default=50)
+    parser.add_argument("--steps", type=int, default=150)
+    parser.add_argument("--batch-size", type=int, default=8)
+    return parser.parse_args()
+
+
+def benchmark_schedules(prompt_parser, count):
+    prompts = [
+        f"a [photo:painting:{i % 7 + 1}] of a [cat|dog|fox] in the [forest:city:0.{i % 9 + 1}], (detailed:1.{i % 5}), [[old]] [house:{i % 11 + 2}] variant {i}"
+        for i in range(count)
+    ]
+
+    prompt_parser.parse_schedule.cache_clear()
+    prompt_parser.get_schedule.cache_clear()
+
+    t0 = time.perf_counter()
+    prompt_parser.get_learned_conditioning_prompt_schedules(prompts, 30)
+    uncached = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    prompt_parser.get_learned_conditioning_prompt_schedules(prompts, 30)
+    cached = time.perf_counter() - t0
+
+    prompt_parser.get_schedule.cache_clear()
+
+    t0 = time.perf_counter()
+    prompt_parser.get_learned_conditioning_prompt_schedules(prompts, 20)
+    cached_trees = time.perf_counter() - t0
+
+    print(f"prompt schedules: {count / uncached:.0f}/s parsed, {count / cached_trees:.0f}/s from cached trees, {count / cached:.0f}/s from cached schedules")
+
+
+def benchmark_cond_batches(prompt_parser, steps, batch_size):
+    def schedule(n, vary_length=False):
+        return [prompt_parser.ScheduledPromptConditioning(end_at, torch.randn(77 * (1 + end_at % 2 * vary_length), 64)) for end_at in range(steps // n, steps + 1, steps // n)]
+
+    uncond = [schedule(3) for _ in range(batch_size)]
+    cond = prompt_parser.MulticondLearnedConditioning(shape=(batch_size,), batch=[
+        [prompt_parser.ComposableScheduledPromptConditioning(schedule(5 + i, vary_length=True), 1.0), prompt_parser.ComposableScheduledPromptConditioning(schedule(2), 0.5)]
+        for i in range(batch_size)
+    ])
+
+    # samplers like DPM2 call the model twice per step
+    sampling_steps = range(steps * 2)
+
+    t0 = time.perf_counter()
+    for step in sampling_steps:
+        prompt_parser.reconstruct_multicond_batch(cond, step)
+        prompt_parser.reconstruct_cond_batch(uncond, step)
+    rebuilt = (time.perf_counter() - t0) / len(sampling_steps)
+
+    cond_table = uncond_table = None
+    t0 = time.perf_counter()
+    for step in sampling_steps:
+        cond_table = prompt_parser.cond_batch_table(cond_table, cond, prompt_parser.reconstruct_multicond_batch)
+        uncond_table = prompt_parser.cond_batch_table(uncond_table, uncond, prompt_parser.reconstruct_cond_batch)
+        cond_table.get(step)
+        uncond_table.get(step)
+    looked_up = (time.perf_counter() - t0) / len(sampling_steps)
+
+    print(f"conditioning per sampling step: {rebuilt * 1e6:.0f}us rebuilt, {looked_up * 1e6:.0f}us with table")
+
+
+def main():
+    args = parse_args()
+    sys.argv = sys.argv[:1]
+    sys.path.insert(0, root)
+
+    from modules import prompt_parser
+
+    torch.manual_seed(0)
+
+    benchmark_schedules(prompt_parser, args.prompts)
+    benchmark_cond_batches(prompt_parser, args.steps, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
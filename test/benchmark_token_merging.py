@@ -0,0 +1,64 @@
+"""
+Reports txt2img speed-up from token merging against ratio at several resolutions.
+
+Needs a running server with API enabled:
+    python test/benchmark_token_merging.py --url http://localhost:7860 --sizes 512 768 1024 --ratios 0 0.3 0.5
+"""
+
+import argparse
+import time
+
+import requests
+
+
+def generate(url, size, ratio, args):
+    payload = {
+        "prompt": args.prompt,
+        "seed": 1,
+        "steps": args.steps,
+        "cfg_scale": 7,
+        "width": size,
+        "height": size,
+        "batch_size": 1,
+        "n_iter": 1,
+        "sampler_index": args.sampler,
+        "override_settings": {"token_merging_ratio": ratio},
+    }
+
+    t0 = time.perf_counter()
+    response = requests.post(f"{url}/sdapi/v1/txt2img", json=payload)
+    elapsed = time.perf_counter() - t0
+
+    response.raise_for_status()
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="token merging benchmark")
+    parser.add_argument("--url", type=str, default="http://localhost:7860")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 768, 1024])
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.0, 0.3, 0.5, 0.7])
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--sampler", type=str, default="Euler a")
+    parser.add_argument("--prompt", type=str, default="a photo of a mountain lake at sunrise")
+    args = parser.parse_args()
+
+    ratios = sorted(set([0.0] + args.ratios))
+
+    print(f"{'size':>6} {'ratio':>6} {'seconds':>9} {'speed-up':>9}")
+    for size in args.sizes:
+        generate(args.url, size, 0.0, args)  # warm-up
+
+        baseline = None
+        for ratio in ratios:
+            elapsed = min(generate(args.url, size, ratio, args) for _ in range(args.repeats))
+            if baseline is None:
+                baseline = elapsed
+
+            print(f"{size:>6} {ratio:>6.2f} {elapsed:>9.2f} {baseline / elapsed:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Helpers shared by benchmarks in this directory; benchmarks are run as scripts, so this is imported as a top-level module.
+"""
+
+import os
+import sys
+import time
+import types
+
+import torch
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_vae(device, dtype):
+    """returns a stand-in for SD model with only first_stage_model, a VAE with random weights built from v1-inference.yaml"""
+
+    sys.argv = sys.argv[:1]
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+    import modules.paths  # noqa: F401 - puts ldm on sys.path
+    from ldm.util import instantiate_from_config
+    from omegaconf import OmegaConf
+
+    config = OmegaConf.load(os.path.join(root, "v1-inference.yaml"))
+    first_stage_model = instantiate_from_config(config.model.params.first_stage_config).to(device, dtype).eval()
+
+    return types.SimpleNamespace(first_stage_model=first_stage_model, scale_factor=config.model.params.scale_factor)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timed(device, repeats, fn):
+    """returns result of fn and seconds it takes on average over repeats calls, after one warm-up call"""
+
+    with torch.no_grad():
+        fn()
+        synchronize(device)
+
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            res = fn()
+        synchronize(device)
+
+    return res, (time.perf_counter() - t0) / repeats
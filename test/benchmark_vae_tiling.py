@@ -0,0 +1,95 @@
+"""
+Reports peak memory and time of passing images through SD VAE whole and in tiles. Uses VAE with random weights built from
+v1-inference.yaml; each measurement runs in its own process so that peak RAM of one does not hide another's on CPU.
+
+    python test/benchmark_vae_tiling.py --sizes 1024 2048 --device cuda
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+from benchmark_utils import load_vae, synchronize
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="tiled VAE benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048])
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--tile-overlap", type=int, default=64)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float16" if torch.cuda.is_available() else "float32")
+    parser.add_argument("--run", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def measure(args, direction, size, tiled):
+    """runs in a child process; prints peak memory in bytes and seconds taken as JSON"""
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    model = load_vae(device, dtype)
+
+    from modules import sd_vae_tiled
+
+    tile, overlap = args.tile_size // 8, args.tile_overlap // 8
+
+    if direction == "decode":
+        x = torch.randn(1, 4, size // 8, size // 8, device=device, dtype=dtype)
+        run = (lambda: sd_vae_tiled.decode(model, x, tile, overlap)) if tiled else (lambda: model.first_stage_model.decode(x / model.scale_factor))
+    else:
+        x = torch.rand(1, 3, size, size, device=device, dtype=dtype) * 2 - 1
+        run = (lambda: sd_vae_tiled.encode(model, x, tile, overlap)) if tiled else (lambda: model.first_stage_model.encode(x))
+
+    synchronize(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        run()
+
+    synchronize(device)
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    print(json.dumps({"peak": peak, "seconds": time.perf_counter() - t0}))
+
+
+def main():
+    args = parse_args()
+
+    if args.run:
+        direction, size, tiled = args.run.split(",")
+        measure(args, direction, int(size), tiled == "tiled")
+        return
+
+    memory = "VRAM" if args.device.startswith("cuda") else "peak RSS"
+    print(f"{'direction':>9} {'size':>6} {'mode':>7} {memory + ' MB':>12} {'seconds':>9}")
+
+    for direction in ["decode", "encode"]:
+        for size in args.sizes:
+            for mode in ["whole", "tiled"]:
+                command = [sys.executable, os.path.abspath(__file__), "--run", f"{direction},{size},{mode}", "--tile-size", str(args.tile_size), "--tile-overlap", str(args.tile_overlap), "--device", args.device, "--dtype", args.dtype]
+                result = subprocess.run(command, capture_output=True, text=True)
+
+                if result.returncode != 0:
+                    error = "out of memory" if "out of memory" in result.stderr else result.stderr.strip().splitlines()[-1]
+                    print(f"{direction:>9} {size:>6} {mode:>7} {error}")
+                    continue
+
+                res = json.loads(result.stdout.strip().splitlines()[-1])
+                print(f"{direction:>9} {size:>6} {mode:>7} {res['peak'] / 1024 / 1024:>12.0f} {res['seconds']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
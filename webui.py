@@ -22,6 +22,7 @@ from collections import OrderedDict
 
 from modules import shared, sd_samplers, upscaler, extensions, localization, ui_tempdir, ui_extra_networks
 import modules.codeformer_model as codeformer
+import modules.cpu_profile
 import modules.extras
 import modules.face_restoration
 import modules.gfpgan_model as gfpgan
@@ -86,6 +87,7 @@ def initialize():
         return
    
     modelloader.cleanup_models()
+    modules.cpu_profile.setup()
     modules.sd_models.setup_model()
     codeformer.setup_model(cmd_opts.codeformer_models_path)
     gfpgan.setup_model(cmd_opts.gfpgan_models_path)